@@ -0,0 +1,76 @@
+""" Saturation throughput of the LiveQA answer server with and without micro-batching of concurrent questions """
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.cascade import sample_questions
+from contest_interface import LiveQAAnswerer
+from models.gensim_models import TfidfRetrieval, LsiRetrieval, LdaRetrieval
+from models.mixture_of_experts import MixtureOfExperts
+from serialization.dictionary import CorpusDictionary
+
+EXPERTS = {'tfidf': TfidfRetrieval, 'lsi': LsiRetrieval, 'lda': LdaRetrieval}
+
+
+def saturate(answerer, questions, clients):
+    """ Answer every question with `clients` concurrent clients, each sending its next question when answered """
+    remaining = list(enumerate(questions))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if len(remaining) == 0:
+                    return
+                i, question = remaining.pop()
+            answerer.answer('q%d' % i, question, '')
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(questions) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--prefix', default='v20000', help='dictionary prefix (default=%(default)s)')
+    parser.add_argument('--experts', default='tfidf,lda,lsi', help='comma-separated experts (default=%(default)s)')
+    parser.add_argument('--questions', type=int, default=500, help='number of questions to sample (default=%(default)s)')
+    parser.add_argument('--clients', type=int, default=64, help='concurrent clients (default=%(default)s)')
+    parser.add_argument('--compute-workers', type=int, default=2,
+                        help='batches retrieved at once (default=%(default)s)')
+    parser.add_argument('--max-batch', type=int, default=32, help='questions per batch (default=%(default)s)')
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='seconds a batch waits for more questions (default=%(default)s)')
+    args = parser.parse_args()
+
+    dic = CorpusDictionary(prefix=args.prefix)
+    moe = MixtureOfExperts(dic, [EXPERTS[name] for name in args.experts.split(',')],
+                           workers_per_expert=args.compute_workers, default_deadline=60.)
+    questions = sample_questions(args.questions)
+
+    # warm up the models and the database before timing
+    moe.top_n_batch(questions[:10], 1)
+
+    for name, max_batch in [('unbatched', 1), ('batched', args.max_batch)]:
+        answerer = LiveQAAnswerer(moe, 'benchmark', args.compute_workers, max_batch=max_batch, max_wait=args.max_wait)
+        throughput = saturate(answerer, questions, args.clients)
+        sizes = np.asarray(answerer.batcher.batch_sizes)
+        answerer.close()
+
+        print('%-10s %8.1f questions/s   %8.1f per compute worker   mean batch %5.1f' % (
+            name, throughput, throughput / args.compute_workers, sizes.mean()))
+
+    moe.close()
+
+
+if __name__ == '__main__':
+    main()
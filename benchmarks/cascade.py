@@ -0,0 +1,60 @@
+""" Compare full and cascade retrieval latency, and report the recall of the cascade's first stage """
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+from sqlalchemy import func
+
+from models.gensim_models import TfidfRetrieval, LsiRetrieval, LdaRetrieval
+from models.mixture_of_experts import MixtureOfExperts
+from serialization.dictionary import CorpusDictionary
+from serialization.sqldb import DBSession, Question
+
+
+def sample_questions(num):
+    session = DBSession()
+    questions = [q.title for q in session.query(Question).order_by(func.random()).limit(num)]
+    session.close()
+    return questions
+
+
+def time_queries(moe, questions, n):
+    latencies = []
+    for question in questions:
+        start = time.time()
+        moe.top_n_documents(question, n)
+        latencies.append(time.time() - start)
+    return np.asarray(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--prefix', default='v20000', help='dictionary prefix (default=%(default)s)')
+    parser.add_argument('--questions', type=int, default=100, help='number of questions to sample (default=%(default)s)')
+    parser.add_argument('--candidates', type=int, default=2000, help='first-stage candidates (default=%(default)s)')
+    parser.add_argument('-n', type=int, default=5, help='documents to retrieve per question (default=%(default)s)')
+    args = parser.parse_args()
+
+    dic = CorpusDictionary(prefix=args.prefix)
+    moe = MixtureOfExperts(dic, [TfidfRetrieval, LdaRetrieval, LsiRetrieval],
+                           n_candidates=args.candidates)
+    questions = sample_questions(args.questions)
+
+    for cascade in (False, True):
+        moe.cascade = cascade
+        latencies = time_queries(moe, questions, args.n)
+        print('%-8s mean %8.2f ms   p50 %8.2f ms   p95 %8.2f ms' % ('cascade' if cascade else 'full',
+                                                                     latencies.mean(),
+                                                                     np.percentile(latencies, 50),
+                                                                     np.percentile(latencies, 95)))
+
+    print('first-stage recall@%d with %d candidates: %.3f' % (moe.num_best, args.candidates,
+                                                              moe.first_stage_recall(questions)))
+    moe.close()
+
+
+if __name__ == '__main__':
+    main()
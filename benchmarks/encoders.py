@@ -0,0 +1,73 @@
+""" Time the batch character and token encoders against per-character / per-token Python loops """
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import timeit
+
+import gensim
+import numpy as np
+
+from models.deep_models import CharIndex, max_len
+from models.lstm_for_nonfactoid_qa import TokenEncoder, ac_len
+from models.qa_data import pad
+
+
+def synthetic_docs(n_docs, n_words, vocab_size, seed=0):
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = [''.join(rng.choice(letters, rng.randint(2, 10))) for _ in range(vocab_size)]
+
+    # zipfian word frequencies, like real text
+    p = 1.0 / np.arange(1, vocab_size + 1)
+    p /= p.sum()
+    return [' '.join(words[i] for i in rng.choice(vocab_size, rng.randint(1, 2 * n_words), p=p)).capitalize() + '.'
+            for _ in range(n_docs)]
+
+
+def loop_encode_chars(char_index, docs):
+    d = np.zeros((len(docs), max_len-1), dtype=np.int32)
+    for i, doc in enumerate(docs):
+        d[i, 0] = 1
+        for p, j in enumerate(doc.lower()[:max_len-2]):
+            d[i, p+1] = char_index.char_to_idx.get(j, 0)
+    return d
+
+
+def loop_encode_tokens(encoder, docs, length):
+    return pad([np.asarray([encoder.vocab.token2id.get(c, encoder.default_id)
+                            for c in itertools.islice(gensim.utils.tokenize(doc, to_lower=True), length)])
+                for doc in docs], length)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--docs', type=int, default=1000, help='documents per batch (default=%(default)s)')
+    parser.add_argument('--words', type=int, default=60, help='mean words per document (default=%(default)s)')
+    parser.add_argument('--vocab', type=int, default=20000, help='distinct words (default=%(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions (default=%(default)s)')
+    args = parser.parse_args()
+
+    docs = synthetic_docs(args.docs, args.words, args.vocab)
+
+    char_index = CharIndex({}, {}, {})
+    char_index.add_chars(set().union(*[doc.lower() for doc in docs]))
+    encoder = TokenEncoder(gensim.corpora.Dictionary(gensim.utils.tokenize(doc, to_lower=True) for doc in docs))
+
+    assert (loop_encode_chars(char_index, docs) == char_index.encode(docs)).all()
+    assert (loop_encode_tokens(encoder, docs, ac_len) == encoder.encode(docs, ac_len)).all()
+
+    def time_ms(fn):
+        return min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1000
+
+    for name, loop, batch in [
+            ('characters', lambda: loop_encode_chars(char_index, docs), lambda: char_index.encode(docs)),
+            ('tokens', lambda: loop_encode_tokens(encoder, docs, ac_len), lambda: encoder.encode(docs, ac_len))]:
+        loop_ms, batch_ms = time_ms(loop), time_ms(batch)
+        print('%-10s %d docs: %.1f ms per-item loop, %.1f ms batch (%.1fx)' % (
+            name, len(docs), loop_ms, batch_ms, loop_ms / batch_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+""" Time ScoreFusion on synthetic expert results of configurable size """
+
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from models.fusion import ScoreFusion, as_arrays
+
+
+def synthetic_results(n_experts, n_candidates, n_docs, seed=0):
+    rng = np.random.RandomState(seed)
+    results = []
+    for i in range(n_experts):
+        ids = rng.choice(n_docs, n_candidates, replace=False)
+        scores = np.sort(rng.rand(n_candidates))[::-1]
+        results.append(('expert%d' % i, ids, scores))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--experts', type=int, default=4, help='number of experts (default=%(default)s)')
+    parser.add_argument('--candidates', type=int, default=5000, help='results per expert (default=%(default)s)')
+    parser.add_argument('--docs', type=int, default=1000000, help='corpus size (default=%(default)s)')
+    parser.add_argument('--repeat', type=int, default=200, help='timing repetitions (default=%(default)s)')
+    args = parser.parse_args()
+
+    results = synthetic_results(args.experts, args.candidates, args.docs)
+    pairs = [(name, list(zip(ids.tolist(), scores.tolist()))) for name, ids, scores in results]
+
+    def time_ms(fn):
+        return min(timeit.repeat(fn, number=args.repeat, repeat=5)) / args.repeat * 1000
+
+    for method in ScoreFusion.METHODS:
+        fusion = ScoreFusion(method)
+        arrays = time_ms(lambda: fusion.fuse(results, 10))
+        # experts that return (doc_id, score) pairs pay for the conversion as well
+        converted = time_ms(lambda: fusion.fuse([(name,) + as_arrays(docs) for name, docs in pairs], 10))
+        print('%-8s %d experts x %d candidates: %.3f ms from arrays, %.3f ms from pairs' % (
+            method, args.experts, args.candidates, arrays, converted))
+
+
+if __name__ == '__main__':
+    main()
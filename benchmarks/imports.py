@@ -0,0 +1,74 @@
+"""
+Import time of the modules on the serving path, each measured in fresh interpreters, and the heavy dependencies each
+one pulls in. Exits with an error if a module imports a forbidden dependency or takes longer than `--max-seconds`, so
+CI can track it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+MODULES = ('serialization.sqldb', 'serialization.dictionary', 'models.interfaces', 'models.gensim_models',
+           'models.mixture_of_experts', 'contest_interface')
+
+# dependencies reported when loaded
+HEAVY = ('theano', 'keras', 'tensorflow', 'gensim', 'scipy', 'sqlalchemy', 'numpy')
+
+MEASURE = """
+import json, sys, time
+start = time.time()
+import %s
+print(json.dumps({'seconds': time.time() - start, 'loaded': [name for name in %r if name in sys.modules]}))
+"""
+
+
+def measure(module, repeats):
+    """ Seconds to import `module` in each of `repeats` new interpreters, and the heavy dependencies it loaded """
+    seconds, loaded = [], []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE % (module, HEAVY)])
+        result = json.loads(output.strip().splitlines()[-1])
+        seconds.append(result['seconds'])
+        loaded = result['loaded']
+    return np.asarray(seconds), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modules', default=','.join(MODULES), help='comma-separated modules (default=%(default)s)')
+    parser.add_argument('--repeats', type=int, default=5, help='interpreters per module (default=%(default)s)')
+    parser.add_argument('--forbid', default='theano,keras,tensorflow',
+                        help='comma-separated dependencies the modules must not import (default=%(default)s)')
+    parser.add_argument('--max-seconds', type=float, help='maximum median import time of any module')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    args = parser.parse_args()
+
+    forbidden = set(name for name in args.forbid.split(',') if name)
+    results, failures = {}, []
+    for module in args.modules.split(','):
+        seconds, loaded = measure(module, args.repeats)
+        results[module] = {'median': float(np.median(seconds)), 'min': float(seconds.min()),
+                           'max': float(seconds.max()), 'loaded': loaded}
+        print('%-30s median %7.3f s   min %7.3f s   loads %s' % (module, np.median(seconds), seconds.min(),
+                                                                 ', '.join(loaded) or '-'))
+
+        if forbidden & set(loaded):
+            failures.append('%s imports %s' % (module, ', '.join(sorted(forbidden & set(loaded)))))
+        if args.max_seconds is not None and np.median(seconds) > args.max_seconds:
+            failures.append('%s takes %.3f s to import' % (module, np.median(seconds)))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'modules': results, 'failures': failures, 'args': vars(args)}, f, indent=2, sort_keys=True)
+
+    if len(failures) > 0:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Replay questions sampled from the database against a running answer server (`contest_interface.py`), and report
+throughput, latency percentiles and error, discard and deadline-miss rates.
+
+Closed loop: `--concurrency` clients each send their next question as soon as the last one is answered, which measures
+the throughput the server sustains. Open loop: questions arrive at `--qps` whatever the server does (as contest
+questions would), and latencies are counted from when each question was due, so a server that falls behind shows it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import httplib
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib
+import urlparse
+
+import numpy as np
+from sqlalchemy import func
+
+from serialization.sqldb import DBSession, Question
+
+# request outcomes (dropped: not sent, with too many open-loop questions waiting for an answer)
+OK, DISCARD, ERROR, DROPPED = 'ok', 'discard', 'error', 'dropped'
+
+
+def sample_questions(num):
+    """ (title, body, category) of random questions """
+    session = DBSession()
+    try:
+        return [(q.title or u'', q.content or u'', q.category.text if q.category is not None else u'')
+                for q in session.query(Question).order_by(func.random()).limit(num)]
+    finally:
+        session.close()
+
+
+def revision():
+    """ The git commit of the code under test, to compare reports of different builds """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadGenerator(object):
+    def __init__(self, url, questions, timeout=70.):
+        """
+        :param url: URL the answer server receives questions on
+        :param questions: (title, body, category) triples, sent in turn (from the start again once all were sent)
+        :param timeout: Seconds after which a request is abandoned and counted as an error
+        """
+        parsed = urlparse.urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.path = parsed.path or '/'
+        self.questions = questions
+        self.timeout = timeout
+
+        self.results = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _question(self):
+        with self._lock:
+            i = self._next
+            self._next += 1
+        title, body, category = self.questions[i % len(self.questions)]
+        return 'load-%d' % i, title, body, category
+
+    def send(self, due=None):
+        """ Send the next question and record (due time, latency, outcome), with the latency counted from `due` """
+        qid, title, body, category = self._question()
+        data = urllib.urlencode({'qid': qid, 'title': title.encode('utf-8'), 'body': body.encode('utf-8'),
+                                 'category': category.encode('utf-8')})
+        start = time.time()
+        due = due if due is not None else start
+        try:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            conn.request('POST', self.path, data, {'Content-Type': 'application/x-www-form-urlencoded'})
+            response = conn.getresponse()
+            content = response.read()
+            conn.close()
+            if response.status != 200:
+                outcome = ERROR
+            else:
+                outcome = DISCARD if 'answered="no"' in content else OK
+        except Exception:
+            outcome = ERROR
+        with self._lock:
+            self.results.append((due, time.time() - due, outcome))
+
+    def closed_loop(self, concurrency, duration, think_time=0.):
+        """ `concurrency` clients each sending a question as soon as their last one is answered """
+        end = time.time() + duration
+
+        def client():
+            while time.time() < end:
+                self.send()
+                if think_time > 0:
+                    time.sleep(think_time)
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, qps, duration, poisson=True, max_outstanding=1000):
+        """
+        Questions sent at `qps` on average (with exponential gaps if `poisson`, else evenly), each on its own thread.
+        Questions due while `max_outstanding` are waiting for an answer are dropped.
+        """
+        threads = []
+        start = due = time.time()
+        while due < start + duration:
+            time.sleep(max(0, due - time.time()))
+            threads = [thread for thread in threads if thread.is_alive()]
+            if len(threads) < max_outstanding:
+                thread = threading.Thread(target=self.send, args=(due,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            else:
+                with self._lock:
+                    self.results.append((due, 0., DROPPED))
+            due += random.expovariate(qps) if poisson else 1. / qps
+
+        for thread in threads:
+            thread.join()
+
+
+def report(results, start, duration, deadline):
+    """
+    Statistics of the requests due from `start` to `start + duration`. Errors and dropped requests count as deadline
+    misses, and only the sent requests count in the latencies.
+    """
+    measured = [(latency, outcome) for due, latency, outcome in results if start <= due < start + duration]
+    counts = dict((outcome, sum(1 for _, o in measured if o == outcome)) for outcome in (OK, DISCARD, ERROR, DROPPED))
+    stats = {'requests': len(measured), 'dropped': counts[DROPPED],
+             'throughput': (counts[OK] + counts[DISCARD]) / float(duration)}
+
+    latencies = np.asarray([latency for latency, outcome in measured if outcome != DROPPED]) * 1000
+    if len(latencies) > 0:
+        stats['latency_ms'] = dict([('mean', latencies.mean()), ('max', latencies.max())] +
+                                   [('p%d' % p, np.percentile(latencies, p)) for p in (50, 95, 99)])
+
+    if len(measured) > 0:
+        late = sum(1 for latency, outcome in measured if outcome in (OK, DISCARD) and latency > deadline)
+        stats['error_rate'] = float(counts[ERROR] + counts[DROPPED]) / len(measured)
+        stats['discard_rate'] = float(counts[DISCARD]) / len(measured)
+        stats['deadline_miss_rate'] = float(late + counts[ERROR] + counts[DROPPED]) / len(measured)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='http://127.0.0.1:8080/', help='answer server (default=%(default)s)')
+    parser.add_argument('--questions', type=int, default=1000, help='number of questions to sample (default=%(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the open-loop arrivals (default=%(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='clients in closed loop, ignored with --qps (default=%(default)s)')
+    parser.add_argument('--think-time', type=float, default=0.,
+                        help='seconds a closed-loop client waits between questions (default=%(default)s)')
+    parser.add_argument('--qps', type=float, help='questions per second, in open loop (default: closed loop)')
+    parser.add_argument('--uniform', action='store_true', help='evenly spaced open-loop arrivals instead of Poisson')
+    parser.add_argument('--max-outstanding', type=int, default=1000,
+                        help='open-loop questions waiting for an answer at most, more are dropped as errors '
+                             '(default=%(default)s)')
+    parser.add_argument('--duration', type=float, default=60., help='seconds of load (default=%(default)s)')
+    parser.add_argument('--warmup', type=float, default=5.,
+                        help='seconds at the start not counted in the report (default=%(default)s)')
+    parser.add_argument('--deadline', type=float, default=60.,
+                        help='seconds within which a question must be answered (default=%(default)s)')
+    parser.add_argument('--output', help='file to write the report to, as JSON')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    generator = LoadGenerator(args.url, sample_questions(args.questions), timeout=args.deadline + 10)
+
+    start = time.time()
+    if args.qps is not None:
+        generator.open_loop(args.qps, args.warmup + args.duration, not args.uniform, args.max_outstanding)
+    else:
+        generator.closed_loop(args.concurrency, args.warmup + args.duration, args.think_time)
+
+    results = dict(report(generator.results, start + args.warmup, args.duration, args.deadline),
+                   mode='open' if args.qps is not None else 'closed', revision=revision(), time=start,
+                   args=vars(args))
+
+    print('%s loop: %d requests, %.1f answered/s' % (results['mode'], results['requests'], results['throughput']))
+    if 'latency_ms' in results:
+        print('latency   mean %8.1f ms   p50 %8.1f ms   p95 %8.1f ms   p99 %8.1f ms   max %8.1f ms' % tuple(
+            results['latency_ms'][key] for key in ('mean', 'p50', 'p95', 'p99', 'max')))
+    if results['requests'] > 0:
+        print('errors %.2f%%   discards %.2f%%   deadline misses %.2f%%   dropped %d' % (
+            results['error_rate'] * 100, results['discard_rate'] * 100, results['deadline_miss_rate'] * 100,
+            results['dropped']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
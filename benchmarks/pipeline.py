@@ -0,0 +1,202 @@
+"""
+Time every stage of the offline pipeline on a synthetic (or sampled) Yahoo QA XML file, from an empty data directory:
+database ingest, dictionary build, and the model and index of each expert, then the per-question and batched retrieval
+latency of each expert and of the mixture of experts. Reports the peak resident memory after each stage.
+
+Everything is written to a temporary directory (or `--workdir`), never to the configured data directory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import config
+
+EXPERTS = ('tfidf', 'lsi', 'lda')
+
+
+def synthetic_xml(path, questions, answers=3, vocabulary=5000, categories=20, seed=0):
+    """
+    Write a Yahoo QA XML file of random questions and answers, with Zipf-distributed words
+
+    :param questions: Number of questions
+    :param answers: Number of answers per question (the first is the best answer)
+    :param vocabulary: Number of distinct words
+    :param categories: Number of distinct categories
+    """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = sorted(set(''.join(rng.choice(letters, rng.randint(3, 10))) for _ in range(vocabulary)))
+    probabilities = 1. / np.arange(1, len(words) + 1)
+    probabilities /= probabilities.sum()
+
+    def text(length):
+        return ' '.join(words[i] for i in rng.choice(len(words), rng.randint(1, 2 * length), p=probabilities))
+
+    with open(path, 'w') as f:
+        f.write('<ystfeed>\n')
+        for i in range(questions):
+            document = ET.Element('document', type='wisdom')
+            for tag, value in [('subject', text(8)), ('content', text(30)), ('bestanswer', text(50))]:
+                ET.SubElement(document, tag).text = value
+            nbest = ET.SubElement(document, 'nbestanswers')
+            for _ in range(answers - 1):
+                ET.SubElement(nbest, 'answer_item').text = text(50)
+            ET.SubElement(document, 'cat').text = 'category %s' % words[rng.randint(categories)]
+            for tag in ('date', 'res_date', 'vot_date'):
+                ET.SubElement(document, tag).text = str(rng.randint(1e9, 1.2e9))
+            ET.SubElement(document, 'id').text = 'q%d' % i
+            ET.SubElement(document, 'best_id').text = 'u%d' % i
+            f.write(ET.tostring(document, encoding='utf-8') + '\n')
+        f.write('</ystfeed>\n')
+
+
+def peak_rss():
+    """ Peak resident memory of this process so far, in MB (Linux reports kB) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Stages(object):
+    def __init__(self):
+        """ Seconds and peak memory of each stage, in the order they ran """
+        self.stages = []
+
+    def time(self, name, function, *args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        self.record(name, time.time() - start)
+        return result
+
+    def record(self, name, seconds, **extra):
+        self.stages.append(dict(extra, name=name, seconds=seconds, peak_rss_mb=peak_rss()))
+        print('%-28s %9.2f s   peak RSS %8.1f MB' % (name, seconds, peak_rss()))
+
+    def wrap(self, cls, method, name):
+        """ Record the time spent in `cls.method` as stage `name` (until `unwrap`) """
+        original = cls.__dict__[method]
+
+        def timed(*args, **kwargs):
+            return self.time(name, original, *args, **kwargs)
+
+        setattr(cls, method, timed)
+        return lambda: setattr(cls, method, original)
+
+
+def latencies(function, items):
+    """ Milliseconds per call of `function` on each item """
+    result = []
+    for item in items:
+        start = time.time()
+        function(item)
+        result.append((time.time() - start) * 1000)
+    return np.asarray(result)
+
+
+def summary(milliseconds):
+    return dict([('mean', milliseconds.mean())] + [('p%d' % p, np.percentile(milliseconds, p)) for p in (50, 95, 99)])
+
+
+def time_queries(stages, name, single, batch, questions, batch_size):
+    """ Per-question latency of `single(question)`, and per-question latency of `batch(questions)` by batches """
+    per_query = latencies(single, questions)
+    batches = [questions[i:i + batch_size] for i in range(0, len(questions), batch_size)]
+    per_batch = latencies(batch, batches)
+
+    for mode, total, milliseconds in [('query', per_query.sum(), per_query),
+                                      ('batched', per_batch.sum(), per_batch / [len(b) for b in batches])]:
+        stats = summary(milliseconds)
+        stages.record('%s %s' % (name, mode), total / 1000, latency_ms=stats)
+        print('%28s mean %8.2f ms   p50 %8.2f ms   p95 %8.2f ms   p99 %8.2f ms' % (
+            '', stats['mean'], stats['p50'], stats['p95'], stats['p99']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--xml', help='Yahoo QA XML file to use (default: a synthetic one)')
+    parser.add_argument('--questions', type=int, default=5000,
+                        help='questions in the synthetic XML (default=%(default)s)')
+    parser.add_argument('--answers', type=int, default=3, help='answers per synthetic question (default=%(default)s)')
+    parser.add_argument('--vocabulary', type=int, default=5000,
+                        help='distinct words in the synthetic XML (default=%(default)s)')
+    parser.add_argument('--experts', default=','.join(EXPERTS), help='comma-separated experts (default=%(default)s)')
+    parser.add_argument('--queries', type=int, default=200, help='questions to time retrieval on (default=%(default)s)')
+    parser.add_argument('--batch-size', type=int, default=16, help='questions per batch (default=%(default)s)')
+    parser.add_argument('-n', type=int, default=10, help='documents to retrieve per question (default=%(default)s)')
+    parser.add_argument('--workdir', help='directory for the data (default: a temporary one, removed at the end)')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    if not os.path.isdir(os.path.join(workdir, 'dicts')):
+        os.makedirs(os.path.join(workdir, 'dicts'))
+
+    # the pipeline reads its paths from the configuration, so point it at the work directory before importing it
+    config.BASE_DATA_PATH = workdir
+    config.DATABASES = dict(config.DATABASES, yahoo=os.path.join(workdir, 'yahoo.sqlite3'))
+    config.MODELS = dict(getattr(config, 'MODELS', {}), **dict((name, os.path.join(workdir, name))
+                                                               for name in EXPERTS))
+
+    from benchmarks.loadgen import revision
+    from models.gensim_models import GensimInterface, TfidfRetrieval, LsiRetrieval, LdaRetrieval
+    from models.mixture_of_experts import MixtureOfExperts
+    from serialization.convert_to_sqlite_db import convert
+    from serialization.dictionary import CorpusDictionary
+    from serialization.sqldb import DBSession, Question
+
+    classes = {'tfidf': TfidfRetrieval, 'lsi': LsiRetrieval, 'lda': LdaRetrieval}
+    stages = Stages()
+    try:
+        xml = args.xml
+        if xml is None:
+            xml = os.path.join(workdir, 'synthetic.xml')
+            stages.time('synthetic xml', synthetic_xml, xml, args.questions, args.answers, args.vocabulary)
+
+        stages.time('ingest', convert, xml, test=False)
+        dic = stages.time('dictionary', CorpusDictionary)
+
+        session = DBSession()
+        questions = [q.title for q in session.query(Question.title).limit(args.queries)]
+        session.close()
+        random.Random(0).shuffle(questions)
+
+        experts = []
+        for name in args.experts.split(','):
+            unwrap = [stages.wrap(classes[name], 'generate_model', '%s model' % name),
+                      stages.wrap(GensimInterface, 'generate_index', '%s index' % name)]
+            try:
+                expert = classes[name](dic, num_best=args.n)
+            finally:
+                for restore in unwrap:
+                    restore()
+            experts.append(classes[name])
+
+            time_queries(stages, name, lambda q: expert.top_n_documents(dic.doc2vec(q), args.n),
+                         lambda qs: expert.top_n_batch_arrays([dic.doc2vec(q) for q in qs], args.n),
+                         questions, args.batch_size)
+
+        moe = MixtureOfExperts(dic, experts, default_deadline=60.)
+        time_queries(stages, 'mixture of experts', lambda q: moe.top_n_documents(q, args.n),
+                     lambda qs: moe.top_n_batch(qs, args.n), questions, args.batch_size)
+        moe.close()
+
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump({'stages': stages.stages, 'peak_rss_mb': peak_rss(), 'revision': revision(),
+                           'time': time.time(), 'args': vars(args)}, f, indent=2)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+""" Measure the per-query preprocessing saved by sharing a QueryPlan across experts """
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.cascade import sample_questions
+from models.gensim_models import TfidfRetrieval, LsiRetrieval, LdaRetrieval
+from models.mixture_of_experts import MixtureOfExperts
+from models.query_plan import QueryPlan
+from serialization.dictionary import CorpusDictionary
+
+
+def per_expert_preprocessing(moe, question):
+    """ What each expert did on its own before query plans: tokenize, encode and transform the question """
+    for expert in moe.experts:
+        expert.transform(moe.dictionary.vocab.doc2bow(CorpusDictionary.tokenize(question)))
+
+
+def shared_preprocessing(moe, question):
+    plan = QueryPlan(moe.dictionary, question)
+    for expert in moe.experts:
+        plan.vector(expert)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--prefix', default='v20000', help='dictionary prefix (default=%(default)s)')
+    parser.add_argument('--questions', type=int, default=100, help='number of questions to sample (default=%(default)s)')
+    args = parser.parse_args()
+
+    dic = CorpusDictionary(prefix=args.prefix)
+    moe = MixtureOfExperts(dic, [TfidfRetrieval, LdaRetrieval, LsiRetrieval])
+    questions = sample_questions(args.questions)
+
+    results = {}
+    for name, preprocess in (('per-expert', per_expert_preprocessing), ('query plan', shared_preprocessing)):
+        latencies = []
+        for question in questions:
+            start = time.time()
+            preprocess(moe, question)
+            latencies.append(time.time() - start)
+        results[name] = np.asarray(latencies) * 1000
+        print('%-10s %8.3f ms / query' % (name, results[name].mean()))
+
+    print('saved      %8.3f ms / query' % (results['per-expert'].mean() - results['query plan'].mean()))
+    moe.close()
+
+
+if __name__ == '__main__':
+    main()
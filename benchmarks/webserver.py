@@ -0,0 +1,115 @@
+""" Load test `server/demo/webserver.py`: requests per second and latency for pages, small and large files and 304s """
+
+from __future__ import print_function
+
+import argparse
+import httplib
+import imp
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+WEBSERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server', 'demo', 'webserver.py')
+
+
+def run_server(script, rootdir, port):
+    """ Serve `rootdir` with the web server in `script` (in a separate process, without request logs) """
+    devnull = open(os.devnull, 'w')
+    os.dup2(devnull.fileno(), sys.stderr.fileno())
+
+    webserver = imp.load_source('webserver_under_test', script)
+    opts = argparse.Namespace(host='127.0.0.1', port=port, rootdir=rootdir, no_dirlist=False, level='warning',
+                              keep_alive=15.0, cache_max_file=256 * 1024, cache_size=32 * 1024 * 1024)
+    webserver.httpd(opts)
+
+
+def client(args):
+    """ Closed-loop client: request `path` as fast as possible for `duration` seconds, return the latencies """
+    port, path, headers, keep_alive, duration = args
+    latencies = []
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.time()
+        if not keep_alive:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', path, headers=dict(headers, **({} if keep_alive else {'Connection': 'close'})))
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.time() - start)
+        if not keep_alive:
+            conn.close()
+    conn.close()
+    return latencies
+
+
+def cpu_seconds(pid):
+    """ User and system CPU time used so far by a process (Linux only) """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def load(pool, port, path, clients, duration, keep_alive=True, headers=None):
+    results = pool.map(client, [(port, path, headers or {}, keep_alive, duration)] * clients)
+    latencies = np.concatenate([np.asarray(r) for r in results]) * 1000
+    return len(latencies) / float(duration), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--script', default=WEBSERVER, help='web server to test (default=%(default)s)')
+    parser.add_argument('--port', type=int, default=18080, help='port to serve on (default=%(default)s)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes (default=%(default)s)')
+    parser.add_argument('--duration', type=float, default=5., help='seconds per scenario (default=%(default)s)')
+    parser.add_argument('--large', type=int, default=8, help='size of the large file, in MB (default=%(default)s)')
+    args = parser.parse_args()
+
+    rootdir = tempfile.mkdtemp()
+    demo = os.path.dirname(WEBSERVER)
+    shutil.copy(os.path.join(demo, 'webserver.css'), rootdir)
+    shutil.copy(os.path.join(demo, 'webserver.png'), rootdir)
+    with open(os.path.join(rootdir, 'large.txt'), 'wb') as f:
+        f.write(os.urandom(args.large * 1024 * 1024))
+
+    server = multiprocessing.Process(target=run_server, args=(args.script, rootdir, args.port))
+    server.daemon = True
+    server.start()
+    time.sleep(1)
+
+    conn = httplib.HTTPConnection('127.0.0.1', args.port)
+    conn.request('GET', '/webserver.css')
+    response = conn.getresponse()
+    response.read()
+    conditional = {'If-None-Match': response.getheader('etag', '')}
+
+    pool = multiprocessing.Pool(args.clients)
+    scenarios = [('info page', '/info', True, None),
+                 ('small file', '/webserver.css', True, None),
+                 ('small file, new connections', '/webserver.css', False, None),
+                 ('small file, conditional', '/webserver.css', True, conditional),
+                 ('image (39 KB)', '/webserver.png', True, None),
+                 ('large file (%d MB)' % args.large, '/large.txt', True, None)]
+    try:
+        for name, path, keep_alive, headers in scenarios:
+            cpu = cpu_seconds(server.pid)
+            throughput, latencies = load(pool, args.port, path, args.clients, args.duration, keep_alive, headers)
+            cpu = cpu_seconds(server.pid) - cpu
+
+            # the clients are Python too and may saturate first: the server's CPU time per request is the fairer cost
+            print('%-30s %8.0f requests/s   p50 %7.2f ms   p99 %7.2f ms   server CPU %7.1f us/request' % (
+                name, throughput, np.percentile(latencies, 50), np.percentile(latencies, 99),
+                cpu / len(latencies) * 1e6))
+    finally:
+        pool.terminate()
+        server.terminate()
+        shutil.rmtree(rootdir)
+
+
+if __name__ == '__main__':
+    main()
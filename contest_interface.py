@@ -1,4 +1,545 @@
-""" Communication with the contest infrastructure """
+"""
+Communication with the contest infrastructure: an HTTP server that answers LiveQA questions.
 
-### TODO
-# See here for Java implementation https://github.com/yuvalpinter/LiveQAServerDemo
+The contest POSTs each question as a form (`qid`, `title`, `body` and `category`) and expects an XML answer within a
+minute (see the Java implementation at https://github.com/yuvalpinter/LiveQAServerDemo). Requests are handled by a
+pool of front-end threads, which only parse questions and write answers; retrieval runs on a separate, smaller compute
+pool, so a slow question ties up one compute worker and the front end keeps accepting and answering the others.
+
+Questions reach the compute pool through a `MicroBatcher`: while every compute worker is busy, concurrent questions
+queue up and are retrieved together as one batch, so the experts score them with matrix-matrix instead of
+matrix-vector products.
+
+GET /metrics exports counters and latency histograms for every stage of answering a question, in the Prometheus text
+format (see `models.metrics`). With several processes, each scrape gets the metrics of the worker that accepted it.
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import os
+import Queue
+import threading
+import time
+import urlparse
+import xml.etree.ElementTree as ET
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy.orm import configure_mappers
+
+from models.gensim_models import TfidfRetrieval, LsiRetrieval, LdaRetrieval
+from models.metrics import REGISTRY, Timer, stage_histogram
+from models.mixture_of_experts import MixtureOfExperts
+from serialization.dictionary import CorpusDictionary
+from serialization.sqldb import DBSession, Answer
+from server.prefork import PreforkSupervisor, daemonize
+
+import logging
+logger = logging.getLogger(__name__)
+
+PARSE_SECONDS = stage_histogram('parse')
+FETCH_SECONDS = stage_histogram('fetch')
+WRITE_SECONDS = stage_histogram('write')
+QUESTION_SECONDS = REGISTRY.histogram('liveqa_question_seconds', 'Seconds from receiving a question to its answer')
+
+
+class PendingResult(object):
+    """ The result of an item submitted to a `MicroBatcher`, available once its batch is done """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set(self, value=None, error=None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class MicroBatcher(object):
+    def __init__(self, function, workers=4, max_batch=16, max_wait=0.005):
+        """
+        Gathers items submitted concurrently into batches for a function that processes a list of items at once.
+
+        A batch is started as soon as a worker is free and an item is waiting, and takes the items submitted within
+        `max_wait` seconds of the first one, up to `max_batch`. Batches therefore stay small when the workers keep up,
+        and grow under load while the workers are busy.
+
+        :param function: Maps a list of items to the list of their results
+        :param workers: Number of batches processed at once
+        :param max_batch: Maximum number of items per batch (1 to process every item on its own)
+        :param max_wait: Seconds to wait for more items once a batch has its first one
+        """
+        self.function = function
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queue = Queue.Queue()
+        self.pool = ThreadPool(workers)
+        self.free_workers = threading.Semaphore(workers)
+        self.batch_sizes = collections.deque(maxlen=1000)
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='micro-batcher')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def submit(self, item):
+        """ Queue an item for the next batch and return its `PendingResult` """
+        result = PendingResult()
+        self.queue.put((item, result))
+        return result
+
+    def _dispatch(self):
+        while True:
+            self.free_workers.acquire()
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                return
+
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+                if batch[-1] is None:
+                    self.queue.put(None)
+                    batch.pop()
+                    break
+
+            self.batch_sizes.append(len(batch))
+            self.pool.apply_async(self._run, (batch,))
+
+    def _run(self, batch):
+        try:
+            values = self.function([item for item, _ in batch])
+            for (_, result), value in zip(batch, values):
+                result.set(value)
+        except Exception as e:
+            logger.exception('Failed to process a batch of %d items' % len(batch))
+            for _, result in batch:
+                result.set(error=e)
+        finally:
+            self.free_workers.release()
+
+    def close(self):
+        """ Process the queued items and stop the workers """
+        self.queue.put(None)
+        self._dispatcher.join()
+        self.pool.close()
+        self.pool.join()
+
+
+class AnswerCache(object):
+    def __init__(self, size=10000, min_similarity=0.5):
+        """
+        The answers to recent questions, keyed by their words, to fall back on for a similar question when there is
+        no time to retrieve one.
+
+        :param size: Number of answers to keep (the least recently used are evicted)
+        :param min_similarity: Minimum Jaccard similarity of the words of two questions to reuse an answer
+        """
+        self.size = size
+        self.min_similarity = min_similarity
+        self.answers = collections.OrderedDict()
+        self.postings = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.0
+
+    def add(self, words, answer):
+        """
+        :param words: The (vocabulary ids of the) words of the question
+        :param answer: Its answer
+        """
+        key = frozenset(words)
+        if len(key) == 0:
+            return
+
+        with self._lock:
+            self.answers.pop(key, None)
+            self.answers[key] = answer
+            for word in key:
+                self.postings[word].add(key)
+
+            while len(self.answers) > self.size:
+                evicted, _ = self.answers.popitem(last=False)
+                for word in evicted:
+                    self.postings[word].discard(evicted)
+                    if len(self.postings[word]) == 0:
+                        del self.postings[word]
+
+    def get(self, words):
+        """ The answer of the most similar cached question, or `None` if none is similar enough """
+        key = frozenset(words)
+        with self._lock:
+            candidates = set().union(*[self.postings.get(word, ()) for word in key])
+            scored = [(float(len(key & other)) / len(key | other), other) for other in candidates]
+            if len(scored) == 0 or max(scored)[0] < self.min_similarity:
+                self.misses += 1
+                return None
+
+            best = max(scored)[1]
+            self.hits += 1
+            self.answers[best] = self.answers.pop(best)
+            return self.answers[best]
+
+
+class LiveQAAnswerer(object):
+    # how a question was answered, from best to worst
+    OUTCOMES = ('experts', 'fallback', 'cache', 'discard')
+
+    def __init__(self, moe, participant_id, compute_workers=4, timeout=50., max_length=1000, max_batch=16,
+                 max_wait=0.005, fetch_time=1., fallback_expert='tfidf', cache=None):
+        """
+        Answers LiveQA questions with the best answer in the database according to a `MixtureOfExperts`.
+
+        Every question has a deadline, `timeout` seconds after it arrives, and is always answered by then. The
+        experts get the time left minus `fetch_time` (the scheduler picks the ones that fit and late experts are
+        dropped); a question that still has no answer falls back to `fallback_expert` alone if there is time left,
+        then to the cached answer of a similar question, and is discarded only if there is none.
+
+        :param moe: The `MixtureOfExperts` used to retrieve answers
+        :param participant_id: Our participant id, sent back with every answer
+        :param compute_workers: Number of batches of questions retrieved at once (later questions wait for a worker)
+        :param timeout: Seconds after which a question must be answered
+        :param max_length: Maximum number of characters of an answer (longer answers are cut)
+        :param max_batch: Maximum number of questions retrieved together (1 to retrieve every question on its own)
+        :param max_wait: Seconds a batch waits for more questions once it has its first one
+        :param fetch_time: Seconds kept from the experts for fetching the answer texts and responding
+        :param fallback_expert: Name of the (cheap) expert to fall back on when the others found nothing in time
+        :param cache: The `AnswerCache` of recent answers
+        """
+        self.moe = moe
+        self.participant_id = participant_id
+        self.timeout = timeout
+        self.max_length = max_length
+        self.fetch_time = fetch_time
+        self.fallback_expert = fallback_expert if fallback_expert in [e.name for e in moe.experts] else None
+        self.cache = cache if cache is not None else AnswerCache()
+        self.batcher = MicroBatcher(self.retrieve_batch, compute_workers, max_batch, max_wait)
+
+        # number of questions answered each way
+        self.outcomes = dict((outcome, 0) for outcome in LiveQAAnswerer.OUTCOMES)
+        self._outcomes_lock = threading.Lock()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        for outcome in LiveQAAnswerer.OUTCOMES:
+            REGISTRY.callback('liveqa_questions_total', 'Questions answered, by how they were answered',
+                              lambda outcome=outcome: self.outcomes[outcome], 'counter', outcome=outcome)
+        REGISTRY.callback('liveqa_answer_cache_lookups_total', 'Lookups in the cache of recent answers, by result',
+                          lambda: self.cache.hits, 'counter', result='hit')
+        REGISTRY.callback('liveqa_answer_cache_lookups_total', 'Lookups in the cache of recent answers, by result',
+                          lambda: self.cache.misses, 'counter', result='miss')
+        REGISTRY.callback('liveqa_answer_cache_hit_rate', 'Fraction of the lookups in the answer cache that hit',
+                          self.cache.hit_rate)
+        REGISTRY.callback('liveqa_answer_cache_size', 'Answers in the cache of recent answers',
+                          lambda: len(self.cache.answers))
+        REGISTRY.callback('liveqa_queue_depth', 'Items waiting in each queue', self.batcher.queue.qsize,
+                          queue='batcher')
+        REGISTRY.callback('liveqa_batch_size_mean', 'Mean number of questions in the last 1000 batches',
+                          lambda: (float(sum(self.batcher.batch_sizes)) / len(self.batcher.batch_sizes)
+                                   if len(self.batcher.batch_sizes) > 0 else 0.0))
+
+    def _budget(self, deadline):
+        return deadline - self.fetch_time - time.time()
+
+    def _positions(self, plans, deadline, experts=None):
+        """ The best document of each question (or `None`), retrieved within the budget left before `deadline` """
+        budget = self._budget(deadline)
+        if budget <= 0:
+            return [None] * len(plans)
+        return [positions[0] if len(positions) > 0 else None
+                for positions in self.moe.top_n_batch(plans, 1, budget=budget, experts=experts)]
+
+    def retrieve_batch(self, questions):
+        """
+        The best answer to each of several questions.
+
+        :param questions: (title, body, deadline) triples; the experts get the time left before the earliest deadline
+                          of the batch, and questions already past theirs are skipped
+        :return: For each question, `None` if nothing was retrieved in time, or the content of the answer, its
+                 resources (the Yahoo id of the question it was given for) and the outcome ('experts' or 'fallback')
+        """
+        live = [i for i, (_, _, deadline) in enumerate(questions) if self._budget(deadline) > 0]
+        if len(live) == 0:
+            return [None] * len(questions)
+
+        plans = dict((i, self.moe.plan(u'%s %s' % questions[i][:2])) for i in live)
+        deadline = min(questions[i][2] for i in live)
+
+        positions = dict(zip(live, self._positions([plans[i] for i in live], deadline)))
+        outcomes = dict((i, 'experts') for i in live if positions[i] is not None)
+
+        missing = [i for i in live if positions[i] is None]
+        if len(missing) > 0 and self.fallback_expert is not None:
+            positions.update(zip(missing, self._positions([plans[i] for i in missing], deadline,
+                                                           [self.fallback_expert])))
+            outcomes.update((i, 'fallback') for i in missing if positions[i] is not None)
+
+        answer_ids = dict((i, int(self.moe.dictionary.answer_ids[positions[i]])) for i in outcomes)
+
+        # the answers of the whole batch with a single query
+        session = DBSession()
+        try:
+            with Timer(FETCH_SECONDS):
+                query = session.query(Answer).filter(Answer.id.in_(answer_ids.values()))
+                answers = dict((answer.id, (answer.content, answer.question.yahoo_id or '')) for answer in query)
+        finally:
+            session.close()
+
+        return [answers[answer_ids[i]] + (outcomes[i],) if answer_ids.get(i) in answers else None
+                for i in range(len(questions))]
+
+    def retrieve(self, title, body, deadline=None):
+        """ The best answer to a question (see `retrieve_batch`) """
+        deadline = deadline if deadline is not None else time.time() + self.timeout
+        return self.retrieve_batch([(title, body, deadline)])[0]
+
+    def record(self, outcome):
+        with self._outcomes_lock:
+            self.outcomes[outcome] += 1
+
+    def answer(self, qid, title, body, category=''):
+        """
+        Answer a question before its deadline
+
+        :return: The LiveQA XML response
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        logger.info('Question %s (%s): "%s"' % (qid, category, title))
+
+        result = self.batcher.submit((title, body, deadline))
+        try:
+            answer, reason = result.get(timeout=max(0, deadline - time.time())), 'nothing retrieved'
+        except TimeoutError:
+            answer, reason = None, 'no answer within %.1fs' % self.timeout
+        except Exception as e:
+            logger.exception('Failed to answer question %s' % qid)
+            answer, reason = None, 'error: %s' % e
+
+        tokens = CorpusDictionary.tokenize(u'%s %s' % (title, body))
+        words = [word for word, _ in self.moe.dictionary.vocab.doc2bow(tokens)]
+        if answer is not None:
+            content, resources, outcome = answer
+            answer = content, resources
+            self.cache.add(words, answer)
+        else:
+            answer = self.cache.get(words)
+            outcome = 'cache' if answer is not None else 'discard'
+        self.record(outcome)
+        QUESTION_SECONDS.observe(time.time() - start)
+
+        elapsed = int((time.time() - start) * 1000)
+        if outcome == 'fallback':
+            logger.warning('Answered question %s with <%s> after %d ms: the experts found nothing in time' % (
+                qid, self.fallback_expert, elapsed))
+        elif outcome == 'cache':
+            logger.warning('Answered question %s from the cache after %d ms: %s' % (qid, elapsed, reason))
+        elif outcome == 'discard':
+            logger.warning('Discarding question %s after %d ms: %s' % (qid, elapsed, reason))
+        return self.to_xml(qid, answer, reason, elapsed)
+
+    def to_xml(self, qid, answer, reason, elapsed):
+        root = ET.Element('xml')
+        node = ET.SubElement(root, 'answer', answered='yes' if answer is not None else 'no', pid=self.participant_id,
+                             qid=qid, time=str(elapsed))
+
+        if answer is not None:
+            content, resources = answer
+            ET.SubElement(node, 'content').text = content[:self.max_length]
+            ET.SubElement(node, 'resources').text = resources
+        else:
+            ET.SubElement(node, 'discard-reason').text = reason
+
+        return ET.tostring(root, encoding='utf-8')
+
+    def close(self):
+        """ Stop the compute workers """
+        self.batcher.close()
+        logger.info('Questions answered by outcome: %r' % self.outcomes)
+
+
+def make_request_handler_class(answerer):
+    """ Factory to make a request handler that answers questions with `answerer` """
+    class LiveQARequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            with Timer(PARSE_SECONDS):
+                length = int(self.headers.getheader('content-length', 0))
+                form = urlparse.parse_qs(self.rfile.read(length))
+                qid, title, body, category = [form.get(name, [''])[0].decode('utf-8', 'replace')
+                                              for name in ('qid', 'title', 'body', 'category')]
+
+            if not qid:
+                self.send_error(400, 'Missing qid')
+                return
+
+            response = answerer.answer(qid, title, body, category)
+            with Timer(WRITE_SECONDS):
+                self.send(response, 'application/xml; charset=utf-8')
+
+        def do_GET(self):
+            if urlparse.urlparse(self.path).path != '/metrics':
+                self.send_error(404)
+                return
+            self.send(REGISTRY.export(), 'text/plain; version=0.0.4')
+
+        def send(self, response, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, fmt, *args):
+            logger.debug('%s - %s' % (self.client_address[0], fmt % args))
+
+    return LiveQARequestHandler
+
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+    """ HTTP server that handles requests on a fixed pool of threads instead of one at a time """
+
+    def __init__(self, server_address, handler_class, workers=32):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self.workers = workers
+        self.pool = None
+
+        # connections accepted, and taken by a thread
+        self.accepted = 0
+        self.started = 0
+        self._started_lock = threading.Lock()
+        REGISTRY.callback('liveqa_queue_depth', 'Items waiting in each queue', lambda: self.accepted - self.started,
+                          queue='requests')
+
+    def serve_forever(self, poll_interval=0.5):
+        # the threads are started by the process that serves, which is not the one that bound the socket when forking
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        BaseHTTPServer.HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self.accepted += 1
+        self.pool.apply_async(self._process_request, (request, client_address))
+
+    def _process_request(self, request, client_address):
+        with self._started_lock:
+            self.started += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def serve(answerer, host='', port=8080, workers=32):
+    """ Answer questions until interrupted """
+    server = PooledHTTPServer((host, port), make_request_handler_class(answerer), workers)
+    logger.info('Answering questions on %s:%d' % (host or '0.0.0.0', port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        answerer.close()
+
+
+def serve_prefork(moe, make_answerer, host='', port=8080, workers=32, processes=4):
+    """
+    Answer questions with several processes until stopped: this process keeps the experts it loaded and the
+    listening socket, and forks `processes` workers that share them (see `server.prefork`).
+
+    :param moe: The loaded `MixtureOfExperts`
+    :param make_answerer: Makes each worker's `LiveQAAnswerer` from `moe`
+    """
+    server = PooledHTTPServer((host, port), None, workers)
+    logger.info('Answering questions on %s:%d with %d processes' % (host or '0.0.0.0', port, processes))
+
+    # every worker waits for connections on the shared socket: the ones that lose the race must not block in accept
+    server.socket.setblocking(0)
+
+    # load the indexes and set up the database mappings once, to share them, and let the workers start their own
+    # threads
+    moe.preload()
+    configure_mappers()
+    moe.close()
+
+    def run_worker(number):
+        moe.start_workers()
+        answerer = make_answerer(moe)
+        server.RequestHandlerClass = make_request_handler_class(answerer)
+        try:
+            server.serve_forever()
+        finally:
+            answerer.close()
+            moe.close()
+
+    try:
+        PreforkSupervisor(run_worker, processes).run()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer LiveQA questions over HTTP')
+    parser.add_argument('--host', default='', help='address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default=%(default)s)')
+    parser.add_argument('--pid', default='emory-ir', help='participant id (default=%(default)s)')
+    parser.add_argument('--prefix', default='v20000', help='dictionary prefix (default=%(default)s)')
+    parser.add_argument('--workers', type=int, default=32, help='front-end threads (default=%(default)s)')
+    parser.add_argument('--compute-workers', type=int, default=4,
+                        help='batches of questions retrieved at once (default=%(default)s)')
+    parser.add_argument('--timeout', type=float, default=50., help='seconds per question (default=%(default)s)')
+    parser.add_argument('--fetch-time', type=float, default=1.,
+                        help='seconds kept for fetching answers and responding (default=%(default)s)')
+    parser.add_argument('--max-batch', type=int, default=16,
+                        help='questions retrieved together, 1 to disable batching (default=%(default)s)')
+    parser.add_argument('--max-wait', type=float, default=0.005,
+                        help='seconds a batch waits for more questions (default=%(default)s)')
+    parser.add_argument('--cascade', action='store_true', help='retrieve in cascade mode')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='worker processes sharing the loaded indexes, 1 to serve from this process '
+                             '(default=%(default)s)')
+    parser.add_argument('--daemonize', metavar='DIR', help='run in the background, with logs and pid file in DIR')
+    args = parser.parse_args()
+
+    pidfile = daemonize(args.daemonize, 'answer-server-%d' % args.port) if args.daemonize else None
+    logging.basicConfig(format='%(asctime)s %(process)d [%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+
+    def make_answerer(moe):
+        return LiveQAAnswerer(moe, args.pid, args.compute_workers, args.timeout, max_batch=args.max_batch,
+                              max_wait=args.max_wait, fetch_time=args.fetch_time)
+
+    dic = CorpusDictionary(prefix=args.prefix)
+    moe = MixtureOfExperts(dic, [TfidfRetrieval, LdaRetrieval, LsiRetrieval], cascade=args.cascade,
+                           workers_per_expert=args.compute_workers)
+    try:
+        if args.processes > 1:
+            serve_prefork(moe, make_answerer, args.host, args.port, args.workers, args.processes)
+        else:
+            serve(make_answerer(moe), args.host, args.port, args.workers)
+    finally:
+        if pidfile is not None:
+            os.remove(pidfile)
@@ -1,125 +1,228 @@
+"""
+Character-level language model over the Reuters corpus.
+
+This module defines the model and loads trained weights for inference. Importing it is cheap: NLTK is only imported
+to build the character set, Keras (and Theano) when a model is built. Training lives in `models/train_deep_models.py`.
+"""
+
 from __future__ import print_function
 
 import os
-from collections import defaultdict
+import pickle
 
-from keras.models import Sequential
-from keras.layers import *
-from nltk.corpus import reuters
 import numpy as np
-import pickle
 
 import config
 import logging
 
 logger = logging.getLogger(__name__)
 
-reuters_enc_path = os.path.join(config.BASE_DATA_PATH, 'reuters_enc.npz')
-char_idx_path = os.path.join(config.BASE_DATA_PATH, 'char_idx.pkl')
+reuters_enc_path = os.path.join(config.BASE_DATA_PATH, 'reuters_chars.npz')
+char_idx_path = os.path.join(config.BASE_DATA_PATH, 'char_index.pkl')
+model_save_location = os.path.join(config.BASE_DATA_PATH, 'language_model.h5')
 max_len = 1000
 max_char = 256
+embedding_dims = 64
+
+# reserved character ids, the corpus characters follow
+pad_char = 0
+start_char = 1
+end_char = 2
+n_reserved = 3
+
+
+def code_points(text):
+    """ The code points of a string (or the bytes of a byte string) as an array """
+    if isinstance(text, bytes):
+        return np.frombuffer(text, dtype=np.uint8)
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+class CharIndex(object):
+    def __init__(self, idx_to_char, char_to_idx, cat_enc):
+        """
+        Character and category encodings of the Reuters corpus. Id 0 is padding (and unknown characters), 1 and 2 the
+        start and end of a document, and the characters that occur in the corpus follow.
+
+        Documents are encoded through a lookup table indexed by code point, so a whole batch is encoded with a few
+        numpy operations instead of a dictionary lookup per character.
+        """
+        self.idx_to_char = idx_to_char
+        self.char_to_idx = char_to_idx
+        self.cat_enc = cat_enc
+        self._build_table()
+
+    @property
+    def n_chars(self):
+        return len(self.char_to_idx) + n_reserved
+
+    def _build_table(self):
+        # one entry past the largest known code point stays `pad_char`, every unknown character is clipped onto it
+        size = max([ord(c) for c in self.char_to_idx] or [0]) + 2
+        self.table = np.zeros(size, dtype=np.int16)
+        for c, i in self.char_to_idx.items():
+            self.table[ord(c)] = i
+
+    def add_chars(self, chars):
+        """ Give the characters that aren't in the index yet the next free ids """
+        new = sorted(set(chars).difference(self.char_to_idx))
+        for c in new:
+            i = len(self.char_to_idx) + n_reserved
+            self.char_to_idx[c] = i
+            self.idx_to_char[i] = c
+        if len(new) > 0:
+            self._build_table()
+
+    @staticmethod
+    def load(fname=char_idx_path):
+        """ Load the character encodings, or create them (with the corpus encodings) if they don't exist """
+        if not os.path.exists(fname):
+            return encode_reuters(fname)[0]
+
+        with open(fname, 'rb') as f:
+            logger.info('Loading character encodings from "%s"' % fname)
+            idx_to_char = pickle.load(f)
+            char_to_idx = pickle.load(f)
+            cat_enc = pickle.load(f)
+        return CharIndex(idx_to_char, char_to_idx, cat_enc)
+
+    def save(self, fname=char_idx_path):
+        with open(fname, 'wb') as f:
+            logger.info('Saving character encodings to "%s"' % fname)
+            pickle.dump(self.idx_to_char, f)
+            pickle.dump(self.char_to_idx, f)
+            pickle.dump(self.cat_enc, f)
+
+    def encode(self, docs, length=max_len-1, end=False):
+        """
+        Encode a batch of documents: the start character, the (lowercased) characters of each document and
+        optionally the end character, padded to `length`.
+
+        :param docs: The documents (strings)
+        :param length: Length of each encoded row
+        :param end: Whether to close each document with the end character
+        :return: A (len(docs), length) int32 array of character ids
+        """
+        n_text = length - 1 - int(end)
+        codes = [code_points(doc.lower()[:n_text]) for doc in docs]
+        lengths = np.fromiter((len(c) for c in codes), dtype=np.int64, count=len(codes))
+
+        x = np.zeros((len(docs), length), dtype=np.int32)
+        x[:, 0] = start_char
+
+        if lengths.sum() > 0:
+            flat = np.concatenate(codes)
+            ids = self.table[np.minimum(flat, len(self.table) - 1)]
+            rows = np.repeat(np.arange(len(docs)), lengths)
+            cols = 1 + np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            x[rows, cols] = ids
+        if end:
+            x[np.arange(len(docs)), lengths + 1] = end_char
+        return x
+
+    def encode_doc(self, doc):
+        """ The model input for `doc`: its character ids after the start character, padded to the model length """
+        return self.encode([doc])
+
+
+def encode_reuters(char_idx_fname=char_idx_path, enc_fname=reuters_enc_path, chunk_size=1000):
+    """
+    Build the character vocabulary and encode the Reuters corpus in a single pass over it, caching both.
+
+    Documents are stored as rows of character ids (start character, at most `max_len` characters, end character,
+    then padding) rather than one-hot vectors, which is `n_chars` times smaller; the one-hot targets are only built
+    per batch.
+
+    :param chunk_size: Number of documents to encode at once
+    :return: The `CharIndex`, the (n_docs, n_categories) category indicators and the (n_docs, max_len+2) documents
+    """
+    from nltk.corpus import reuters
+
+    fids = reuters.fileids()
+    cat_enc = dict((x, i+1) for i, x in enumerate(set(reuters.categories())))
+    char_index = CharIndex({}, {}, cat_enc)
 
+    cats = np.zeros((len(fids), max(cat_enc.values())), dtype=np.bool)
+    docs = np.zeros((len(fids), max_len+2), dtype=np.int16)
 
-def encode_doc(doc):
-    d = np.zeros((1, max_len-1, n_chars), dtype=np.bool)
-    for p, j in enumerate(doc.lower()[:max_len]):
-        d[0, p, char_to_idx[j]] = 1
-    return d
-
-# load or create the character encoding dictionaries
-if os.path.exists(char_idx_path):
-    with open(char_idx_path, 'rb') as f:
-        logger.info('Loading character encodings from "%s"' % char_idx_path)
-        idx_to_char = pickle.load(f)
-        char_to_idx = pickle.load(f)
-        cat_enc = pickle.load(f)
-else:
-    n_docs = len(reuters.fileids())
-    cat_enc = dict((x, i+1) for i, x in enumerate(set(reuters.categories())))
+    for start in range(0, len(fids), chunk_size):
+        chunk = fids[start:start+chunk_size]
+        for i, fid in enumerate(chunk):
+            for cat in reuters.categories(fid):
+                cats[start+i, cat_enc[cat]-1] = 1
 
-    chars = set()
-    for fid in reuters.fileids():
-        chars = chars.union(set(reuters.raw(fid).lower()))
-
-    idx_to_char = dict((i, c) for i, c in enumerate(chars))
-    char_to_idx = dict((c, i) for i, c in enumerate(chars))
-
-    with open(char_idx_path, 'wb') as f:
-        logger.info('Saving character encodings to "%s"' % char_idx_path)
-        pickle.dump(idx_to_char, f)
-        pickle.dump(char_to_idx, f)
-        pickle.dump(cat_enc, f)
-
-if os.path.exists(reuters_enc_path):
-    logging.info('Loading reuters encodings from "%s"' % reuters_enc_path)
-    np_file = np.load(reuters_enc_path)
-    cats = np_file['arr_0']
-    docs = np_file['arr_1']
-else:
-    n_docs = len(reuters.fileids())
-
-    chars = set()
-    for fid in reuters.fileids():
-        chars = chars.union(set(reuters.raw(fid).lower()))
-
-    n_chars = len(chars)
-
-    # encode the categories
-    cats_enc = [[cat_enc[i] for i in reuters.categories(fid)] for fid in reuters.fileids()]
-    cats = np.zeros((len(cats_enc), max([max(i) for i in cats_enc])), dtype=np.bool)
-    for i, cat in enumerate(cats_enc):
-        for j in cat:
-            cats[i,j-1] = 1
-
-    # encode the documents
-    docs = np.zeros((n_docs, max_len+2, n_chars), dtype=np.bool)
-    for i, fid in enumerate(reuters.fileids()):
-        r = reuters.raw(fid).lower()[:max_len]
-        l = len(r)
-        docs[i, 0, start_char] = 1
-        for p, j in enumerate(r):
-            docs[i, p+1, char_to_idx[j]] = 1
-        docs[i, l+1, end_char] = 1
-
-    # save the output
-    logging.info('Saving reuters encodings to "%s"' % reuters_enc_path)
-    np.savez(reuters_enc_path, cats, docs)
-
-n_chars = len(char_to_idx)
-
-X = docs[:, :max_len-1, :]
-y = docs[:, 1:, :]
-
-logging.info('Building model...')
-model = Sequential()
-model.add(LSTM(256, return_sequences=True, input_shape=(max_len-1, n_chars), activation='tanh'))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-
-model.add(LSTM(n_chars, return_sequences=True))
-model.add(Activation('sigmoid'))
-
-logging.info('Compiling model...')
-model.compile(loss='categorical_crossentropy', optimizer='rmsprop')
+        # new characters get the next free ids before the chunk is encoded
+        raws = [reuters.raw(fid).lower() for fid in chunk]
+        char_index.add_chars(set().union(*raws))
+        docs[start:start+len(chunk)] = char_index.encode(raws, max_len+2, end=True)
 
-model_save_location = os.path.join(config.BASE_DATA_PATH, 'language_model.h5')
+    char_index.save(char_idx_fname)
+
+    logger.info('Saving reuters encodings to "%s"' % enc_fname)
+    np.savez(enc_fname, cats, docs)
+
+    return char_index, cats, docs
+
+
+def build_model(n_chars):
+    """
+    Define the (uncompiled) language model: compile it with an optimizer to train it, or just load weights into it
+    for inference.
+
+    :param n_chars: Number of character ids (including the reserved ones)
+    :return: The Keras `Sequential` model, mapping (batch, max_len-1) character ids to next-character distributions
+    """
+    from keras.models import Sequential
+    from keras.layers import Embedding, LSTM, BatchNormalization, Dropout, Activation
+
+    logging.info('Building model...')
+    model = Sequential()
+    model.add(Embedding(n_chars, embedding_dims, input_length=max_len-1))
+    model.add(LSTM(256, return_sequences=True, activation='tanh'))
+    model.add(BatchNormalization())
+    model.add(Dropout(0.2))
+
+    model.add(LSTM(n_chars, return_sequences=True))
+    model.add(Activation('sigmoid'))
+
+    return model
 
-if os.path.exists(model_save_location):
-    model.load_weights(model_save_location)
 
 def sample(a, temperature=1.0):
     a = np.log(a) / temperature
     a = np.exp(a) / np.sum(np.exp(a))
     return np.argmax(np.random.multinomial(1, a, 1))
 
-def evaluate():
-    p = model.predict(encode_doc('what is my name? '))
-    for t in np.arange(0.1, 2, 0.1):
-        print(str(t))
-        print(''.join([idx_to_char[sample(i, t)] for i in p[0, :, :]]).replace('\n', ''))
-
-logging.info('Fitting model...')
-for i in range(10):
-    evaluate()
-    model.fit(X, y, batch_size=128, nb_epoch=10, verbose=True)
-    model.save_weights(model_save_location, overwrite=True)
+
+class CharLanguageModel(object):
+    def __init__(self, model, char_index):
+        """
+        Inference with the language model: next-character distributions and sampled continuations.
+
+        :param model: The Keras model from `build_model` (its weights are shared, so training it updates this too)
+        :param char_index: The `CharIndex` the model was trained with
+        """
+        from keras import backend as K
+
+        self.model = model
+        self.char_index = char_index
+        self._predict = K.function([model.get_input(train=False)], [model.get_output(train=False)])
+
+    @staticmethod
+    def load(weights=model_save_location):
+        """ Build the model and load trained weights into it, without compiling an optimizer or loss """
+        char_index = CharIndex.load()
+        model = build_model(char_index.n_chars)
+        logger.info('Loading weights from "%s"' % weights)
+        model.load_weights(weights)
+        return CharLanguageModel(model, char_index)
+
+    def predict(self, doc):
+        """ The distribution of the next character at every position of `doc` """
+        return self._predict([self.char_index.encode_doc(doc)])[0]
+
+    def evaluate(self, doc='what is my name? '):
+        p = self.predict(doc)
+        for t in np.arange(0.1, 2, 0.1):
+            print(str(t))
+            print(''.join([self.char_index.idx_to_char.get(sample(i, t), '') for i in p[0, :, :]]).replace('\n', ''))
@@ -0,0 +1,134 @@
+""" Fusion of the rankings returned by several experts """
+
+import threading
+
+import cPickle as pickle
+import numpy as np
+
+
+def as_arrays(docs):
+    """
+    Convert the (doc_id, score) pairs returned by `top_n_documents` into arrays.
+
+    :param docs: A list of (doc_id, score) pairs
+    :return: An array of ids and an array of scores
+    """
+    ids = np.fromiter((doc[0] for doc in docs), dtype=np.int64, count=len(docs))
+    scores = np.fromiter((doc[1] for doc in docs), dtype=np.float64, count=len(docs))
+    return ids, scores
+
+
+def top_n(scores, n):
+    """ Indices of the `n` largest scores, best first """
+    if n < len(scores):
+        idx = np.argpartition(-scores, n)[:n]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind='mergesort')]
+
+
+class ScoreFusion(object):
+    METHODS = ('rrf', 'combsum')
+
+    def __init__(self, method='rrf', weights=None, k=60):
+        """
+        Combines the results of several experts into a single ranking
+
+        :param method: 'rrf' for reciprocal-rank fusion, 'combsum' for the sum of min-max normalized scores
+        :param weights: Weight of each expert, keyed by expert name (defaults to 1, see `calibrate`)
+        :param k: Rank offset for reciprocal-rank fusion
+        """
+        assert method in ScoreFusion.METHODS, 'Unknown fusion method "%s", expected one of %r' % (method,
+                                                                                                ScoreFusion.METHODS)
+        self.method = method
+        self.weights = weights if weights is not None else {}
+        self.k = k
+        self._local = threading.local()
+        self._rrf = np.zeros(0)
+
+    def contribution(self, scores):
+        """ What each document adds to its fused score, given an expert's raw scores """
+        if self.method == 'rrf':
+            if len(scores) < 2 or np.all(scores[:-1] >= scores[1:]):
+                # experts return their results best first, so the ranks are just the positions
+                return self._reciprocal_ranks(len(scores))
+            ranks = np.empty(len(scores))
+            ranks[np.argsort(-scores, kind='mergesort')] = np.arange(1, len(scores) + 1)
+            return 1.0 / (self.k + ranks)
+
+        low, high = scores.min(), scores.max()
+        if high - low <= 0:
+            return np.ones(len(scores))
+        return (scores - low) / (high - low)
+
+    def _reciprocal_ranks(self, length):
+        """ 1 / (k + rank) for ranks 1 to `length`, computed once for the longest result list seen """
+        if len(self._rrf) < length:
+            self._rrf = 1.0 / (self.k + np.arange(1, max(length, 2 * len(self._rrf)) + 1))
+        return self._rrf[:length]
+
+    def _accumulator(self, size):
+        """ A zeroed array with room for document ids below `size`, reused by the calling thread """
+        acc = getattr(self._local, 'acc', None)
+        if acc is None or len(acc) < size:
+            acc = self._local.acc = np.zeros(max(size, 2 * len(acc) if acc is not None else 0))
+        return acc
+
+    def fuse(self, results, n):
+        """
+        Fuse expert results over the union of their candidates.
+
+        :param results: A list of (expert_name, ids, scores), with `ids` and `scores` as arrays (each expert's ids
+                        must be unique)
+        :param n: Number of documents to return
+        :return: The ids and fused scores of the best `n` documents, best first
+        """
+        results = [(name, ids, scores) for name, ids, scores in results if len(ids) > 0]
+        if len(results) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # sum the contributions in a dense array indexed by document id instead of sorting the ids: within an expert
+        # the ids are unique, so a fancy-indexed += adds every contribution
+        ids = np.concatenate([ids for _, ids, _ in results])
+        acc = self._accumulator(ids.max() + 1)
+        for name, expert_ids, scores in results:
+            acc[expert_ids] += self.weights.get(name, 1.0) * self.contribution(scores)
+        fused = acc[ids]
+        acc[ids] = 0
+
+        # an id occurs at most once per expert, so the best n ids are among the best n * len(results) entries
+        best = top_n(fused, n * len(results))
+        _, first = np.unique(ids[best], return_index=True)
+        best = best[np.sort(first)][:n]
+        return ids[best], fused[best]
+
+    def calibrate(self, results, relevant):
+        """
+        Learn per-expert weights from judged questions: each expert is weighted by the mean reciprocal rank of the
+        first relevant document it returns, normalized so that the weights average to 1.
+
+        :param results: For each question, a list of (expert_name, ids, scores) as passed to `fuse`
+        :param relevant: For each question, the set of relevant document ids
+        :return: The learned weights (also stored in `self.weights`)
+        """
+        reciprocal_ranks = {}
+        for question_results, question_relevant in zip(results, relevant):
+            for name, ids, scores in question_results:
+                ranked = ids[np.argsort(-scores, kind='mergesort')]
+                hits = np.flatnonzero(np.isin(ranked, list(question_relevant)))
+                reciprocal_ranks.setdefault(name, []).append(1.0 / (hits[0] + 1) if len(hits) > 0 else 0.0)
+
+        mrr = dict((name, np.mean(rr)) for name, rr in reciprocal_ranks.items())
+        total = sum(mrr.values())
+        if total > 0:
+            self.weights = dict((name, len(mrr) * value / total) for name, value in mrr.items())
+
+        return self.weights
+
+    def save(self, fname):
+        pickle.dump((self.method, self.weights, self.k), open(fname, 'wb'))
+
+    @staticmethod
+    def load(fname):
+        method, weights, k = pickle.load(open(fname, 'rb'))
+        return ScoreFusion(method, weights=weights, k=k)
@@ -5,9 +5,14 @@ import os
 
 import gensim
 import itertools
+import numpy
+import threading
 
 import config
+from models.fusion import top_n
 from models.interfaces import RetrievalInterface
+from models.query_plan import QueryPlan
+from models.tracing import span
 from serialization.dictionary import CorpusDictionary
 
 import logging
@@ -15,43 +20,260 @@ logger = logging.getLogger(__name__)
 
 
 class GensimInterface(RetrievalInterface):
-    def __init__(self, dictionary, name, num_features, num_best=None):
+    def __init__(self, dictionary, name, num_features, num_best=None, max_delta_size=1000):
         assert name in config.MODELS, '"%s" not found in models, please specify in config.py' % name
         self.name = name
         self.index_name = config.MODELS[name] + '.index'
         self.num_features = num_features
         self.num_best = num_best
 
+        # the trained model is needed both to build the index and to transform new documents and queries
+        self.model = self.get_model(dictionary)
+
         if os.path.exists(self.index_name):
             logger.info('Loading matrix similarities for <%s>' % name)
             self.index = gensim.similarities.Similarity.load(self.index_name)
+
+            # queries must match the dimension the index was built with
+            self.num_features = self.index.num_features
         else:
             logger.info('Generating matrix similarities for <%s>' % name)
-            self.index = self.generate_index(dictionary, name)
-            self.index.save(self.index_name)
+            with span('generate_index', expert=name):
+                self.index = self.generate_index(dictionary, name)
+                self.index.save(self.index_name)
 
-    def generate_index(self, dictionary, name):
+        # results are ranked here (see `top_n_arrays`), the index always returns every similarity
+        self.index.num_best = None
+
+        # documents added later live in segments appended after the main index, written by compaction ...
+        self.segments = [self.index]
+        if os.path.exists(self.index_name + '.segments'):
+            self.segments += [gensim.similarities.Similarity.load(prefix)
+                              for prefix in gensim.utils.unpickle(self.index_name + '.segments')]
+
+        # ... and, until then, in a small in-memory shard
+        self.max_delta_size = max_delta_size
+        self.delta_docs = []
+        self.delta_index = None
+        self._lock = threading.RLock()
+        self._compaction = None
+
+    def get_model(self, dictionary):
 
         # make sure the model exists, otherwise generate it
-        if not os.path.exists(config.MODELS[name]):
-            logger.info('Generating <%s> model at "%s"' % (name, config.MODELS[name]))
-            model = self.generate_model(dictionary)
-            model.save(config.MODELS[name])
+        if not os.path.exists(config.MODELS[self.name]):
+            logger.info('Generating <%s> model at "%s"' % (self.name, config.MODELS[self.name]))
+            with span('generate_model', expert=self.name):
+                model = self.generate_model(dictionary)
+                model.save(config.MODELS[self.name])
         else:
-            logger.info('Loading <%s> model from "%s"' % (name, config.MODELS[name]))
-            model = self.load_model(config.MODELS[name])
+            logger.info('Loading <%s> model from "%s"' % (self.name, config.MODELS[self.name]))
+            model = self.load_model(config.MODELS[self.name])
 
+        return model
+
+    def generate_index(self, dictionary, name):
         index = gensim.similarities.Similarity(self.index_name,
-                                               model[dictionary.mm_answer_corpus],
-                                               self.num_features,
-                                               num_best=self.num_best)
+                                               self.model[dictionary.mm_answer_corpus],
+                                               self.num_features)
 
         return index
 
-    def top_n_documents(self, document, n):
+    def transform(self, document):
+        """
+        Transform a bag-of-words document into the vector space of this model.
+
+        :param document: A bag-of-words document (from `CorpusDictionary.doc2vec`)
+        :return: The document vector, as used by the similarity index
+        """
+        return self.model[document]
+
+    def _vector(self, document):
+        """ The query vector for either a `QueryPlan` (transformed once per question) or a bag-of-words document """
+        if isinstance(document, QueryPlan):
+            return document.vector(self)
+        return self.transform(document)
+
+    def preload(self):
+        """ Load (or memory-map) every shard of the index now, rather than on its first query """
+        segments, _ = self._snapshot()
+        for segment in segments:
+            for shard in segment.shards:
+                shard.get_index()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(segment) for segment in self.segments) + len(self.delta_docs)
+
+    def add_documents(self, documents):
+        """
+        Add new documents to the index without rebuilding it. Documents are searchable as soon as this returns; they
+        are written to a new on-disk segment by a background compaction once `max_delta_size` documents have
+        accumulated.
+
+        :param documents: An iterable of bag-of-words documents
+        :return: The ids assigned to the new documents (continuing from the end of the index)
+        """
+        vectors = [self.transform(document) for document in documents]
+
+        with self._lock:
+            first_id = len(self)
+            self.delta_docs.extend(vectors)
+            self.delta_index = None
+
+            if len(self.delta_docs) >= self.max_delta_size:
+                self.compact(block=False)
+
+        return range(first_id, first_id + len(vectors))
+
+    def compact(self, block=True):
+        """
+        Write the in-memory delta shard to a new on-disk segment of the index.
+
+        :param block: `False` to do the merge in a background thread
+        """
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                if block:
+                    self._compaction.join()
+                return
+
+            self._compaction = threading.Thread(target=self._compact, name='compact-%s' % self.name)
+            self._compaction.daemon = True
+            self._compaction.start()
+
+        if block:
+            self._compaction.join()
+
+    def _compact(self):
+        with self._lock:
+            docs = list(self.delta_docs)
+            prefix = '%s.segment%d' % (self.index_name, len(self.segments))
+        if len(docs) == 0:
+            return
+
+        # queries keep using the delta shard while the segment is built and saved: the live shards are never rewritten
+        logger.info('Compacting %d documents into <%s> segment "%s"' % (len(docs), self.name, prefix))
+        segment = gensim.similarities.Similarity(prefix, docs, self.num_features)
+        segment.save(prefix)
+
+        with self._lock:
+            # documents keep their ids: the segment follows the existing ones in the order they were added
+            self.segments = self.segments + [segment]
+            del self.delta_docs[:len(docs)]
+            self.delta_index = None
+            gensim.utils.pickle([s.output_prefix for s in self.segments[1:]], self.index_name + '.segments')
+
+    def _snapshot(self):
+        """ The index segments and the delta shard, as they are right now """
+        with self._lock:
+            if self.delta_index is None and len(self.delta_docs) > 0:
+                self.delta_index = gensim.similarities.SparseMatrixSimilarity(self.delta_docs,
+                                                                              num_features=self.num_features)
+            return self.segments, self.delta_index
+
+    def top_n_arrays(self, document, n):
+        """
+        Like `top_n_documents`, but returns the ids and scores as arrays.
+        """
         assert self.num_best is None or n >= self.num_best, 'num_best must be at least number of requested docs'
-        sims = sorted(enumerate(self.index[document]), key=lambda item: -item[1])
-        return sims[:n]
+        with span('top_n', expert=self.name, n=n):
+            vector = self._vector(document)
+            segments, delta_index = self._snapshot()
+
+            sims = [segment[vector] for segment in segments]
+            if delta_index is not None:
+                sims.append(delta_index[vector])
+            sims = numpy.concatenate(sims)
+
+            best = top_n(sims, n)
+            return best, sims[best]
+
+    def _shards(self, segments, delta_index):
+        """ The similarity indexes to query for full score arrays, in document id order: every shard, then the delta """
+        shards = []
+        for segment in segments:
+            segment.close_shard()
+            for shard in segment.shards:
+                # the settings `Similarity.__getitem__` would give the shard
+                shard.num_best, shard.normalize = None, segment.norm
+                shards.append(shard)
+        if delta_index is not None:
+            shards.append(delta_index)
+        return shards
+
+    def top_n_batch_arrays(self, documents, n):
+        """
+        Like `top_n_arrays` for several queries at once: each shard is scored with one matrix-matrix product for all
+        of them instead of a matrix-vector product per query. Only the best `n` documents of each query are kept
+        between shards, so memory is bounded by the scores of one shard (`batch x shardsize`), not of the corpus.
+
+        :param documents: A list of bag-of-words queries or `QueryPlan`s
+        :param n: Number of documents to return per query
+        :return: For each query, the ids and scores of its best `n` documents
+        """
+        if len(documents) == 0:
+            return []
+
+        with span('top_n_batch', expert=self.name, n=n, batch=len(documents)):
+            vectors = [self._vector(document) for document in documents]
+            segments, delta_index = self._snapshot()
+
+            best_ids = [numpy.zeros(0, dtype=numpy.int64)] * len(vectors)
+            best_scores = [numpy.zeros(0, dtype=numpy.float32)] * len(vectors)
+            offset = 0
+            for shard in self._shards(segments, delta_index):
+                sims = numpy.asarray(shard[vectors]).reshape(len(vectors), -1)
+                for i, row in enumerate(sims):
+                    # merge the best of this shard into the best so far (earlier shards first, so ties keep id order)
+                    best = top_n(row, n)
+                    ids = numpy.concatenate((best_ids[i], best + offset))
+                    scores = numpy.concatenate((best_scores[i], row[best]))
+                    best = top_n(scores, n)
+                    best_ids[i], best_scores[i] = ids[best], scores[best]
+                offset += sims.shape[1]
+
+            return zip(best_ids, best_scores)
+
+    def top_n_documents(self, document, n):
+        ids, scores = self.top_n_arrays(document, n)
+        return zip(ids.tolist(), scores.tolist())
+
+    def score_candidates(self, document, candidates):
+        """
+        Score a query against a subset of the indexed documents only. Uses the (normalized, memory-mapped) document
+        vectors already stored in the index shards, so the cost is proportional to the number of candidates rather
+        than the size of the corpus.
+
+        :param document: A bag-of-words query or `QueryPlan`
+        :param candidates: Ids of the documents to score (e.g. from a cheaper first-stage model)
+        :return: A list of (doc_id, score) pairs, in the order of `candidates`
+        """
+        ids, scores = self.score_candidate_arrays(document, candidates)
+        return zip(ids.tolist(), scores.tolist())
+
+    def score_candidate_arrays(self, document, candidates):
+        """
+        Like `score_candidates`, but returns the ids and scores as arrays.
+        """
+        with span('score_candidates', expert=self.name, candidates=len(candidates)):
+            vector = gensim.matutils.unitvec(gensim.matutils.sparse2full(self._vector(document), self.num_features))
+            candidates = numpy.asarray(candidates, dtype=numpy.int64)
+            scores = numpy.zeros(len(candidates), dtype=numpy.float32)
+            segments, delta_index = self._snapshot()
+
+            matrices = [shard.get_index().index for segment in segments for shard in segment.shards]
+            if delta_index is not None:
+                matrices.append(delta_index.index)
+
+            offset = 0
+            for matrix in matrices:
+                mask = (candidates >= offset) & (candidates < offset + matrix.shape[0])
+                if mask.any():
+                    scores[mask] = numpy.asarray(matrix[candidates[mask] - offset].dot(vector)).ravel()
+                offset += matrix.shape[0]
+
+            return candidates, scores
 
     @abc.abstractmethod
     def generate_model(self, dictionary):
@@ -64,7 +286,7 @@ class GensimInterface(RetrievalInterface):
 
 class TfidfRetrieval(GensimInterface):
     def __init__(self, dictionary, num_best=None):
-        GensimInterface.__init__(self, dictionary=dictionary, name='tfidf', num_features=dictionary.vocab.num_docs, num_best=num_best)
+        GensimInterface.__init__(self, dictionary=dictionary, name='tfidf', num_features=len(dictionary.vocab), num_best=num_best)
 
     def generate_model(self, dictionary):
         return gensim.models.TfidfModel(dictionary.mm_answer_corpus)
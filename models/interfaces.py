@@ -6,6 +6,9 @@ import abc
 class RetrievalInterface(object):
     __metaclass__ = abc.ABCMeta
 
+    # whether `transform` takes the question text (models of word order) rather than its bag of words
+    transforms_text = False
+
     @abc.abstractmethod
     def top_n_documents(self, document, n):
         return
@@ -1,27 +1,28 @@
 """
 LSTM model for non-factoid question answering (sort of my interpretation on the theme)
 
+This module defines the model and loads trained weights for inference. Importing it is cheap: Keras (and Theano) are
+only imported when a model is built. Training lives in `models/train_lstm_for_nonfactoid_qa.py`.
+
 Notes:
     - Character-level modeling did not converge (might be improved somehow, not sure how though)
 
 """
 
-import random
+import itertools
+import os
+import re
 
 import gensim
 import numpy as np
-from gensim.corpora import Dictionary
-from keras.layers import Embedding, Convolution1D, MaxPooling1D, LSTM, Merge, Dense, Dropout, AveragePooling1D, Flatten, \
-    RepeatVector
-from keras.models import Graph
-from keras.preprocessing.sequence import pad_sequences
-from sqlalchemy import func
-
-import itertools
-import os
 
 import config
-from serialization.sqldb import DBSession, Answer, Question
+from models.fusion import top_n
+from models.interfaces import RetrievalInterface
+from models.qa_data import bucket_length, pad_flat
+from models.query_plan import QueryPlan
+from models.tracing import span
+from serialization.sqldb import DBSession, Answer
 
 import logging
 logger = logging.getLogger(__name__)
@@ -34,151 +35,428 @@ qc_len = 10
 # qt_len = config.STRING_LENGTHS['question_title']
 # qc_len = config.STRING_LENGTHS['question_content']
 
-# generate document encodings
-vocab = Dictionary.load(os.path.join(config.BASE_DATA_PATH, 'dicts', 'v20000_vocab.dict'))
-
-max_char = len(vocab.token2id) + 1
-default_id = max_char - 1 # unknown token
-# max_char = 256
-
+max_lens = {'answer': ac_len, 'question_title': qt_len, 'question_content': qc_len}
 
-def encode_doc(doc, max_len):
-    if doc is None:
-        return np.asarray([])
+# the length-bucketed variant (see `build_model`) pads each batch to a multiple of this instead of the lengths above
+bucket_width = 10
 
-    # enc = np.asarray([max(min(ord(c), max_char-1), 0) for c in doc[:max_len]])
-    enc = np.asarray([vocab.token2id.get(c, default_id) for c in itertools.islice(gensim.utils.tokenize(doc, to_lower=True), max_len)])
-    return enc
-
-
-###################
-# build the model #
-###################
+vocab_path = os.path.join(config.BASE_DATA_PATH, 'dicts', 'v20000_vocab.dict')
+bucketed_weights_path = os.path.splitext(config.MODELS['lstm_cnn'])[0] + '_bucketed.h5'
 
 embedding_dims = 256
 lstm_dims = 128
 pool_length = 5
 encode_dims = 1000
 
-logger.info('Building model')
-
-model = Graph()
-
-model.add_input('question_title', input_shape=(qt_len,), dtype=int)
-model.add_node(Embedding(max_char, embedding_dims, input_length=qt_len), name='qt_emb', input='question_title')
-model.add_input('question_content', input_shape=(qc_len,), dtype=int)
-model.add_node(Embedding(max_char, embedding_dims, input_length=qc_len), name='qc_emb', input='question_content')
-model.add_node(LSTM(lstm_dims, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='q_flstm1',
-               inputs=['qt_emb', 'qc_emb'], merge_mode='concat', concat_axis=1)
-model.add_node(LSTM(lstm_dims, go_backwards=True, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='q_blstm1',
-               inputs=['qt_emb', 'qc_emb'], merge_mode='concat', concat_axis=1)
-model.add_node(MaxPooling1D(pool_length=pool_length), name='q_mp', inputs=['q_flstm1', 'q_blstm1'], merge_mode='ave')
-model.add_node(AveragePooling1D(pool_length=pool_length), name='q_ap', inputs=['q_flstm1', 'q_blstm1'],
-               merge_mode='ave')
-model.add_node(Flatten(), name='q_flat', inputs=['q_mp', 'q_ap'], merge_mode='concat')
-model.add_node(Dense(encode_dims, activation='tanh'), name='q_out', input='q_flat')
-
-# attention model part
-# model.add_node(Dense(embedding_dims, activation='tanh'), name='q_dense', input='q_flat')
-# model.add_node(RepeatVector(ac_len), name='q_rep', input='q_dense')
 
-model.add_input(name='answer', input_shape=(ac_len,), dtype=int)
-model.add_node(Embedding(max_char, embedding_dims, input_length=ac_len), name='a_emb', input='answer')
-model.add_node(LSTM(lstm_dims, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='a_flstm1', input='a_emb')
-model.add_node(LSTM(lstm_dims, go_backwards=True, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='a_blstm1', input='a_emb')
-model.add_node(MaxPooling1D(pool_length=2), name='a_mp', inputs=['a_flstm1', 'a_blstm1'], merge_mode='ave')
-model.add_node(AveragePooling1D(pool_length=2), name='a_ap', inputs=['a_flstm1', 'a_blstm1'], merge_mode='ave')
-model.add_node(Flatten(), name='a_flat', inputs=['a_mp', 'a_ap'], merge_mode='concat')
-model.add_node(Dense(encode_dims, activation='tanh'), name='a_out', input='a_flat')
+# the tokens of `gensim.utils.tokenize` (maximal runs of word characters other than digits), as a character class
+# rather than its per-character lookahead, and without capturing groups so `findall` returns the tokens
+TOKEN_PATTERN = re.compile(r'[^\W\d]+', re.UNICODE)
 
-model.add_output(name='output', inputs=['q_out', 'a_out'], merge_mode='cos', dot_axes=1)
 
-logger.info('Compiling...')
-model.compile(optimizer='rmsprop', loss={'output': 'mean_squared_error'})
+class TokenEncoder(object):
+    def __init__(self, vocab):
+        """
+        Maps documents to the token ids the model is trained on
 
-logger.info('Done!')
+        :param vocab: The gensim `Dictionary` of the corpus
+        """
+        self.vocab = vocab
+        self.max_char = len(vocab.token2id) + 1
+        self.default_id = self.max_char - 1  # unknown token
 
-#################################
-# generate training set from db #
-#################################
+    @staticmethod
+    def load(fname=vocab_path):
+        return TokenEncoder(gensim.corpora.Dictionary.load(fname))
 
+    def tokens(self, doc, max_len):
+        """ The first `max_len` lowercased tokens of `doc`, as `gensim.utils.tokenize` would produce them """
+        if doc is None:
+            return []
+        return TOKEN_PATTERN.findall(gensim.utils.to_unicode(doc).lower())[:max_len]
 
-def generate_data(generate_every=50):
-    assert generate_every % 2 == 0, 'Must provide an even number of points to generate'
+    def encode_doc(self, doc, max_len):
+        get = self.vocab.token2id.get
+        default_id = self.default_id
+        return np.asarray([get(token, default_id) for token in self.tokens(doc, max_len)], dtype=np.int32)
 
-    logger.info('Generating QA sessions')
+    def encode(self, docs, max_len, bucket_width=None):
+        """
+        Encode several documents into one (front-)padded array of token ids: every token of the batch is looked up in
+        one pass and the ids are scattered into the padded array at once (see `pad_flat`).
 
-    answers = []
-    question_titles = []
-    question_contents = []
+        :param docs: The documents (strings, or `None`)
+        :param max_len: Maximum number of tokens per document
+        :param bucket_width: Pad only to the bucket of the longest document instead of `max_len` (see `bucket_length`)
+        """
+        return self.encode_tokens([self.tokens(doc, max_len) for doc in docs], max_len, bucket_width)
 
-    session = DBSession()
+    def encode_tokens(self, tokens, max_len, bucket_width=None):
+        """ Like `encode` for already tokenized documents (see `tokens`) """
+        lengths = np.fromiter((len(doc) for doc in tokens), dtype=np.int64, count=len(tokens))
+        if bucket_width is not None:
+            max_len = bucket_length(lengths.max() if len(lengths) > 0 else 0, max_len, bucket_width)
 
-    while True:
-        for i, answer in enumerate(session.query(Answer).order_by(func.random()).yield_per(generate_every)):
-            if i > 0 and i % (generate_every / 2) == 0:
-                targets = [1] * len(answers) + [-1] * len(answers)
-                question_titles = question_titles + question_titles[1:] + [question_titles[0]]
-                question_contents = question_contents + question_contents[1:] + [question_contents[0]]
-                answers = answers + answers
+        get = self.vocab.token2id.get
+        default_id = self.default_id
+        ids = np.fromiter((get(token, default_id) for token in itertools.chain.from_iterable(tokens)),
+                          dtype=np.int32, count=lengths.sum())
+        return pad_flat(ids, lengths, max_len)
 
-                combined = zip(targets, question_titles, question_contents, answers)
-                random.shuffle(combined)
-                targets[:], question_titles[:], question_contents[:], answers[:] = zip(*combined)
 
-                yield {'question_title': pad_sequences(question_titles, maxlen=qt_len),
-                       'question_content': pad_sequences(question_contents, maxlen=qc_len),
-                       'answer': pad_sequences(answers, maxlen=ac_len),
-                       'output': np.asarray(targets)}
-
-                question_titles = []
-                question_contents = []
-                answers = []
-
-            # positive training sample
-            answers.append(encode_doc(answer.content, ac_len))
-            question_titles.append(encode_doc(answer.question.title, qt_len))
-            question_contents.append(encode_doc(answer.question.content, qc_len))
-
-    session.close()
-
-
-def test():
-    logger.info('Starting session...')
-    session = DBSession()
-
-    for question in session.query(Question).order_by(func.random()).limit(5 ):
-
-        print('\n\nQUESTION\n--------')
-        print('Question title: {}'.format(question.title))
-        print('Question content: {}'.format(question.content))
-
-        for answer in session.query(Answer).filter(Answer.question_id == question.id):
-            print('ANSWER\n------\n{}'.format(answer.content))
-            print(model.predict({'question_title': pad_sequences([encode_doc(question.title, qt_len)], maxlen=qt_len),
-                                 'question_content': pad_sequences([encode_doc(question.content, qc_len)], maxlen=qc_len),
-                                 'answer': pad_sequences([encode_doc(answer.content, ac_len)], maxlen=ac_len)}))
-
-        for answer in session.query(Answer).filter(Answer.question_id != question.id).order_by(func.random()).limit(5):
-            print('BAD ANSWER\n----------\n{}'.format(answer.content))
-            print(model.predict({'question_title': pad_sequences([encode_doc(question.title, qt_len)], maxlen=qt_len),
-                                 'question_content': pad_sequences([encode_doc(question.content, qc_len)], maxlen=qc_len),
-                                 'answer': pad_sequences([encode_doc(answer.content, ac_len)], maxlen=ac_len)}))
-
-    session.close()
-
-samples_per_epoch = 1000
-nb_epoch = 1000
-
-# 10 * 100 * 1000 = 1,000,000
-# looks at every data set at least once
-
-for i in range(3):
-    model.fit_generator(generate_data(), samples_per_epoch, nb_epoch, validation_data=generate_data(), nb_val_samples=10)
-    model.save_weights(config.MODELS['lstm_cnn'], overwrite=True)
-    test()
+###################
+# build the model #
+###################
 
-logger.info('Done training')
 
-# logger.info('Loading weights...')
-# model.load_weights(config.MODELS['lstm_cnn'])
\ No newline at end of file
+def build_model(max_char, bucketed=False):
+    """
+    Define the (uncompiled) two-tower model: compile it with an optimizer to train it, or just load weights into it
+    for inference.
+
+    The default model takes inputs of exactly `max_lens` tokens: the towers are pooled in windows and flattened into
+    their dense layers. The `bucketed` variant takes inputs of any length (so batches can be padded only as far as
+    their longest sample needs, see `bucket_length`): each tower is max- and average-pooled over all its time steps
+    instead, and the question is a single 'question' input (see `QAModel.encode_questions`). The two variants have
+    different weights, so they are trained and saved separately.
+
+    :param max_char: Number of token ids (the vocabulary plus the unknown token)
+    :param bucketed: Build the variable-length variant
+    :return: The Keras `Graph`
+    """
+    from keras import backend as K
+    from keras.layers import Embedding, LSTM, Dense, AveragePooling1D, MaxPooling1D, Flatten, Lambda, \
+        TimeDistributedMerge
+    from keras.models import Graph
+
+    logger.info('Building model')
+
+    def pool(tower, forward, backward, pool_length):
+        """ Pool the averaged forward and backward LSTM outputs into the tower's encoding """
+        if bucketed:
+            model.add_node(Lambda(lambda x: K.max(x, axis=1), output_shape=lambda shape: (shape[0], shape[2])),
+                           name=tower + '_mp', inputs=[forward, backward], merge_mode='ave')
+            model.add_node(TimeDistributedMerge(mode='ave'), name=tower + '_ap', inputs=[forward, backward],
+                           merge_mode='ave')
+            model.add_node(Dense(encode_dims, activation='tanh'), name=tower + '_out',
+                           inputs=[tower + '_mp', tower + '_ap'], merge_mode='concat')
+        else:
+            model.add_node(MaxPooling1D(pool_length=pool_length), name=tower + '_mp', inputs=[forward, backward],
+                           merge_mode='ave')
+            model.add_node(AveragePooling1D(pool_length=pool_length), name=tower + '_ap', inputs=[forward, backward],
+                           merge_mode='ave')
+            model.add_node(Flatten(), name=tower + '_flat', inputs=[tower + '_mp', tower + '_ap'], merge_mode='concat')
+            model.add_node(Dense(encode_dims, activation='tanh'), name=tower + '_out', input=tower + '_flat')
+
+    def length(max_len):
+        return None if bucketed else max_len
+
+    model = Graph()
+
+    if bucketed:
+        # Keras can't concatenate sequences of unknown length, so this variant reads each question as one sequence:
+        # its title followed by its content
+        model.add_input('question', input_shape=(None,), dtype=int)
+        model.add_node(Embedding(max_char, embedding_dims), name='q_emb', input='question')
+        question = dict(input='q_emb')
+    else:
+        model.add_input('question_title', input_shape=(qt_len,), dtype=int)
+        model.add_node(Embedding(max_char, embedding_dims, input_length=qt_len), name='qt_emb',
+                       input='question_title')
+        model.add_input('question_content', input_shape=(qc_len,), dtype=int)
+        model.add_node(Embedding(max_char, embedding_dims, input_length=qc_len), name='qc_emb',
+                       input='question_content')
+        question = dict(inputs=['qt_emb', 'qc_emb'], merge_mode='concat', concat_axis=1)
+
+    model.add_node(LSTM(lstm_dims, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='q_flstm1', **question)
+    model.add_node(LSTM(lstm_dims, go_backwards=True, return_sequences=True, dropout_U=0.1, dropout_W=0.1),
+                   name='q_blstm1', **question)
+    pool('q', 'q_flstm1', 'q_blstm1', pool_length)
+
+    # attention model part
+    # model.add_node(Dense(embedding_dims, activation='tanh'), name='q_dense', input='q_flat')
+    # model.add_node(RepeatVector(ac_len), name='q_rep', input='q_dense')
+
+    model.add_input(name='answer', input_shape=(length(ac_len),), dtype=int)
+    model.add_node(Embedding(max_char, embedding_dims, input_length=length(ac_len)), name='a_emb', input='answer')
+    model.add_node(LSTM(lstm_dims, return_sequences=True, dropout_U=0.1, dropout_W=0.1), name='a_flstm1',
+                   input='a_emb')
+    model.add_node(LSTM(lstm_dims, go_backwards=True, return_sequences=True, dropout_U=0.1, dropout_W=0.1),
+                   name='a_blstm1', input='a_emb')
+    pool('a', 'a_flstm1', 'a_blstm1', 2)
+
+    model.add_output(name='output', inputs=['q_out', 'a_out'], merge_mode='cos', dot_axes=1)
+
+    return model
+
+
+#############################
+# run each tower on its own #
+#############################
+
+
+def tower_function(model, inputs, output):
+    """
+    Compile a function that computes a single node of the model from the inputs it depends on, so each tower can be
+    run without the other one (and without the loss or optimizer).
+
+    :param model: The Keras `Graph` (compiled or not)
+    :param inputs: Names of the graph inputs the node depends on
+    :param output: Name of the node to compute
+    :return: A function taking a list of input arrays and returning a list with the node's output
+    """
+    from keras import backend as K
+    return K.function([model.inputs[name].input for name in inputs], [model.nodes[output].get_output(train=False)])
+
+
+def normalize_rows(x):
+    norms = np.sqrt((x * x).sum(axis=1, keepdims=True))
+    return x / np.maximum(norms, 1e-8)
+
+
+class QAModel(object):
+    def __init__(self, model, encoder, weights=config.MODELS['lstm_cnn'], bucket_width=None):
+        """
+        Inference with the two towers of a model: encode questions and answers, and rank answers for a question.
+
+        :param model: The Keras `Graph` from `build_model` (its weights are shared, so training it updates this too)
+        :param encoder: The `TokenEncoder` the model was trained with
+        :param weights: Where the model's weights are saved (its answer encodings are cached next to them)
+        :param bucket_width: For the bucketed model, pad each batch only to the bucket of its longest document; answers
+                             are then encoded in order of length so that batches need little padding
+        """
+        self.model = model
+        self.encoder = encoder
+        self.weights = weights
+        self.bucket_width = bucket_width
+
+        # whether the question is a single input (the bucketed model) or its title and content
+        self.joined = 'question' in model.inputs
+        self.question_tower = tower_function(
+            model, ['question'] if self.joined else ['question_title', 'question_content'], 'q_out')
+        self.answer_tower = tower_function(model, ['answer'], 'a_out')
+
+    @staticmethod
+    def load(weights=None, vocab=vocab_path, bucketed=False):
+        """
+        Build the model and load trained weights into it, without compiling an optimizer or loss
+
+        :param weights: The saved weights (defaults to those of the chosen variant)
+        :param vocab: The vocabulary the model was trained with
+        :param bucketed: Load the length-bucketed variant (see `build_model`)
+        """
+        if weights is None:
+            weights = bucketed_weights_path if bucketed else config.MODELS['lstm_cnn']
+        encoder = TokenEncoder.load(vocab)
+        model = build_model(encoder.max_char, bucketed=bucketed)
+        logger.info('Loading weights from "%s"' % weights)
+        model.load_weights(weights)
+        return QAModel(model, encoder, weights=weights, bucket_width=bucket_width if bucketed else None)
+
+    def encode_questions(self, titles, contents):
+        if self.joined:
+            questions = [self.encoder.tokens(title, qt_len) + self.encoder.tokens(content, qc_len)
+                         for title, content in zip(titles, contents)]
+            return self.question_tower([self.encoder.encode_tokens(questions, qt_len + qc_len, self.bucket_width)])[0]
+        return self.question_tower([self.encoder.encode(titles, qt_len, self.bucket_width),
+                                    self.encoder.encode(contents, qc_len, self.bucket_width)])[0]
+
+    def encode_answers(self, contents, batch_size=256):
+        """
+        Encode answers with the answer tower, `batch_size` at a time
+
+        :param contents: The answers (strings)
+        :param batch_size: Number of answers to encode at once
+        :return: The (len(contents), encode_dims) encodings, in the order of `contents`
+        """
+        tokens = [self.encoder.tokens(content, ac_len) for content in contents]
+        encodings = np.empty((len(contents), encode_dims), dtype=np.float32)
+
+        # answers of similar length share a batch, so that each is padded only to its bucket
+        order = np.arange(len(tokens))
+        if self.bucket_width is not None:
+            order = np.argsort([len(doc) for doc in tokens], kind='mergesort')
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            answers = self.encoder.encode_tokens([tokens[i] for i in batch], ac_len, self.bucket_width)
+            encodings[batch] = self.answer_tower([answers])[0]
+        return encodings
+
+    def rank(self, title, content, candidates, batch_size=256):
+        """
+        Score one question against many candidate answers: the question tower runs once, the answer tower on
+        `batch_size` candidates per call.
+
+        :param title: The question title
+        :param content: The question content (may be `None`)
+        :param candidates: The candidate answers (strings)
+        :param batch_size: Number of candidates to encode at once
+        :return: The cosine similarity of each candidate, in the order of `candidates`
+        """
+        question = normalize_rows(self.encode_questions([title], [content]))[0]
+        return np.dot(normalize_rows(self.encode_answers(candidates, batch_size)), question)
+
+
+def load_qa_model(bucketed=False):
+    """
+    The saved model for inference: the pure-numpy engine if its weights have been exported (see `models.numpy_qa`),
+    which starts instantly and needs neither Keras nor Theano, otherwise the Keras model.
+
+    :param bucketed: Load the length-bucketed variant
+    """
+    from models.numpy_qa import NumpyQAModel, npz_path
+
+    if os.path.exists(npz_path(bucketed_weights_path if bucketed else config.MODELS['lstm_cnn'])):
+        return NumpyQAModel.load(bucketed=bucketed)
+    return QAModel.load(bucketed=bucketed)
+
+
+class AnswerEncodingCache(object):
+    def __init__(self, path=config.MODELS['lstm_cnn'] + '.answers'):
+        """
+        Precomputed (normalized) answer-tower encodings of every answer in the database, memory-mapped from disk.
+        Ranking a question then costs one question-tower pass and one matrix-vector product.
+
+        :param path: Prefix of the files holding the encodings and the matching answer ids
+        """
+        self.enc_path = path + '.enc.npy'
+        self.ids_path = path + '.ids.npy'
+        self.encodings = None
+        self.answer_ids = None
+
+        if self.exists():
+            self.load()
+
+    def exists(self):
+        return os.path.exists(self.enc_path) and os.path.exists(self.ids_path)
+
+    def load(self):
+        logger.info('Loading answer encodings from "%s"' % self.enc_path)
+        self.encodings = np.load(self.enc_path, mmap_mode='r')
+        self.answer_ids = np.load(self.ids_path, mmap_mode='r')
+
+    def build(self, qa_model, batch_size=1024, yield_per=1000):
+        """
+        Encode every answer with the model's current weights (rebuild after training).
+
+        :param qa_model: The `QAModel` whose answer tower encodes the answers
+        :param batch_size: Number of answers to encode together (see `QAModel.encode_answers`)
+        :param yield_per: Number of answers to retrieve from the database at once
+        """
+        session = DBSession()
+        n_answers = session.query(Answer).count()
+
+        logger.info('Encoding %d answers to "%s"' % (n_answers, self.enc_path))
+        encodings = np.lib.format.open_memmap(self.enc_path, mode='w+', dtype=np.float32,
+                                              shape=(n_answers, encode_dims))
+        answer_ids = np.zeros(n_answers, dtype=np.int64)
+
+        rows = iter(session.query(Answer.id, Answer.content).order_by(Answer.id).yield_per(yield_per))
+        for start in itertools.count(0, batch_size):
+            batch = list(itertools.islice(rows, batch_size))
+            if len(batch) == 0:
+                break
+
+            answer_ids[start:start + len(batch)] = [row[0] for row in batch]
+            encodings[start:start + len(batch)] = normalize_rows(qa_model.encode_answers([row[1] for row in batch]))
+
+            if (start // batch_size) % 100 == 0:
+                logger.info('Encoded %d / %d answers' % (start + len(batch), n_answers))
+
+        session.close()
+
+        encodings.flush()
+        del encodings
+        np.save(self.ids_path, answer_ids)
+        self.load()
+
+    def rank(self, qa_model, title, content, n):
+        """
+        Rank all answers for a question.
+
+        :param qa_model: The `QAModel` the encodings were built with
+        :param title: The question title
+        :param content: The question content (may be `None`)
+        :param n: Number of answers to return
+        :return: A list of (answer_id, cosine similarity) pairs, best first. These are database `Answer.id` values,
+                 not positions in the answer corpus like the gensim experts return (see
+                 `CorpusDictionary.answer_positions`)
+        """
+        assert self.encodings is not None, 'No answer encodings at "%s", call build() first' % self.enc_path
+        question = normalize_rows(qa_model.encode_questions([title], [content]))[0]
+        scores = np.dot(self.encodings, question)
+
+        best = np.argpartition(-scores, n)[:n] if n < len(scores) else np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return zip(self.answer_ids[best].tolist(), scores[best].tolist())
+
+
+class LstmRetrieval(RetrievalInterface):
+    transforms_text = True
+
+    def __init__(self, dictionary, num_best=None, qa_model=None, cache=None, bucketed=False):
+        """
+        The LSTM model as a `MixtureOfExperts` expert, scoring the cached answer encodings (see `AnswerEncodingCache`).
+        Mostly useful as a re-ranker of first-stage candidates (`score_candidate_arrays`). Ids are positions in the
+        answer corpus, like those of the gensim experts; answers added since the cache was built score -1.
+
+        :param dictionary: The `CorpusDictionary` whose answer positions are used as ids
+        :param num_best: Unused, for compatibility with the other experts
+        :param qa_model: The `QAModel` that encodes questions (defaults to the saved model, see `load_qa_model`)
+        :param cache: The `AnswerEncodingCache` to score (defaults to the one of the model)
+        :param bucketed: Use the saved length-bucketed model by default
+        """
+        self.name = 'lstm_cnn'
+        self.num_best = num_best
+        self.qa_model = qa_model if qa_model is not None else load_qa_model(bucketed=bucketed)
+        self.cache = cache if cache is not None else AnswerEncodingCache(self.qa_model.weights + '.answers')
+        assert self.cache.encodings is not None, 'No answer encodings at "%s", build them first' % self.cache.enc_path
+
+        # cache row of the answer at each corpus position (the cache holds every answer, in id order)
+        rows = np.minimum(np.searchsorted(self.cache.answer_ids, dictionary.answer_ids), len(self.cache.answer_ids) - 1)
+        self.rows = np.where(self.cache.answer_ids[rows] == dictionary.answer_ids, rows, -1)
+
+    def transform(self, text):
+        return normalize_rows(self.qa_model.encode_questions([text], [None]))[0]
+
+    def _vector(self, document):
+        if isinstance(document, QueryPlan):
+            return document.vector(self)
+        return self.transform(document)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add_documents(self, documents):
+        # not encoded until the cache is rebuilt, but they keep the ids in step with the other experts
+        first_id = len(self.rows)
+        self.rows = np.concatenate([self.rows, -np.ones(len(documents), dtype=self.rows.dtype)])
+        return range(first_id, len(self.rows))
+
+    def _scores(self, rows, question):
+        scores = -np.ones(len(rows), dtype=np.float32)
+        found = rows >= 0
+        scores[found] = np.dot(self.cache.encodings[rows[found]], question)
+        return scores
+
+    def top_n_arrays(self, document, n):
+        with span('top_n', expert=self.name, n=n):
+            question = self._vector(document)
+            sims = np.dot(self.cache.encodings, question)
+            scores = np.where(self.rows >= 0, sims[self.rows], -1)
+            best = top_n(scores, n)
+            return best, scores[best]
+
+    def top_n_documents(self, document, n):
+        ids, scores = self.top_n_arrays(document, n)
+        return zip(ids.tolist(), scores.tolist())
+
+    def score_candidate_arrays(self, document, candidates):
+        with span('score_candidates', expert=self.name, candidates=len(candidates)):
+            candidates = np.asarray(candidates, dtype=np.int64)
+            return candidates, self._scores(self.rows[candidates], self._vector(document))
+
+    def score_candidates(self, document, candidates):
+        ids, scores = self.score_candidate_arrays(document, candidates)
+        return zip(ids.tolist(), scores.tolist())
@@ -0,0 +1,150 @@
+"""
+Counters and latency histograms for the answering pipeline, exported in the Prometheus text format.
+
+Recording is meant for the hot path: a histogram observation is a bisection over fixed bucket bounds and two additions
+(no locks, so concurrent observations may very rarely lose an increment), and values that already exist elsewhere
+(queue sizes, cache hits) are only read, through callbacks, when the metrics are exported.
+"""
+
+import bisect
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# 0.25 ms to about 65 s, doubling
+LATENCY_BOUNDS = tuple(0.00025 * 2 ** i for i in range(19))
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in sorted(labels))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        return ['%s%s %s' % (name, _labels(labels), self.value)]
+
+
+class Callback(object):
+    def __init__(self, function, kind):
+        """ A counter or gauge whose value is read from `function` when the metrics are exported """
+        self.function = function
+        self.kind = kind
+
+    def samples(self, name, labels):
+        return ['%s%s %s' % (name, _labels(labels), self.function())]
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        Cumulative-free histogram: each observation is counted in its own bucket, the cumulative counts that
+        Prometheus expects are only computed on export.
+
+        :param bounds: Upper bounds of the buckets, increasing (values above the last go in an overflow bucket)
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        lines, total = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', '%g' % bound if bound != float('inf')
+                                                                          else '+Inf'),)), total))
+        lines.append('%s_sum%s %f' % (name, _labels(labels), self.sum))
+        lines.append('%s_count%s %d' % (name, _labels(labels), total))
+        return lines
+
+
+class Timer(object):
+    """ Context manager that observes the seconds spent in its block """
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Registry(object):
+    def __init__(self):
+        """ The metrics of a process, keyed by name and labels """
+        self.metrics = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, help_text, labels, make):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(key, make())
+                self.help.setdefault(name, help_text)
+        return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._get(name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text, bounds=LATENCY_BOUNDS, **labels):
+        return self._get(name, help_text, labels, lambda: Histogram(bounds))
+
+    def callback(self, name, help_text, function, kind='gauge', **labels):
+        """ Export the value of `function()` (replacing any earlier callback with the same name and labels) """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.metrics[key] = Callback(function, kind)
+            self.help.setdefault(name, help_text)
+
+    def timer(self, name, help_text, **labels):
+        return Timer(self.histogram(name, help_text, **labels))
+
+    def export(self):
+        """ All the metrics in the Prometheus text format """
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+
+        lines, described = [], set()
+        for (name, labels), metric in metrics:
+            if name not in described:
+                lines.append('# HELP %s %s' % (name, self.help[name]))
+                lines.append('# TYPE %s %s' % (name, metric.kind))
+                described.add(name)
+            try:
+                lines.extend(metric.samples(name, labels))
+            except Exception:
+                logger.exception('Failed to export metric "%s"' % name)
+        return '\n'.join(lines) + '\n'
+
+
+# the registry the pipeline records into
+REGISTRY = Registry()
+
+
+def stage_histogram(stage):
+    """ The histogram of the seconds spent in a stage of answering a question (e.g. 'tokenize' or 'fusion') """
+    return REGISTRY.histogram('pipeline_stage_seconds', 'Seconds spent in each stage of answering a question',
+                              stage=stage)
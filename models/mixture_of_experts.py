@@ -1,39 +1,397 @@
 """ Mixture of experts (experts here being gensim models) """
+import collections
 import operator
+import os
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
+from sqlalchemy import func
+
+import config
+from models.fusion import ScoreFusion, top_n
 from models.gensim_models import TfidfRetrieval, LsiRetrieval, LdaRetrieval, Word2VecRetrieval
 from models.interfaces import RetrievalInterface
+from models.metrics import REGISTRY, stage_histogram
+from models.query_plan import QueryPlan
+from models.scheduler import ExpertScheduler
+from models.tracing import span, traced
 from serialization.dictionary import CorpusDictionary
+from serialization.sqldb import DBSession, Answer, Question
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class MixtureOfExperts(RetrievalInterface):
 
-    def __init__(self, dictionary, experts):
+    def __init__(self, dictionary, experts, deadlines=None, default_deadline=1.0, latency_window=1000,
+                 workers_per_expert=2, cascade=False, first_stage='tfidf', n_candidates=2000, fusion=None, scheduler=None,
+                 fusion_path=os.path.join(config.BASE_DATA_PATH, 'fusion_weights.pkl')):
+        """
+        Retrieval model that fuses the rankings of several experts, which are queried concurrently
+
+        :param dictionary: The `CorpusDictionary` used to encode questions
+        :param experts: The retrieval classes to use as experts
+        :param deadlines: Seconds each expert has to answer, keyed by expert name (experts that miss it are dropped)
+        :param default_deadline: Deadline (in seconds) for experts not in `deadlines`
+        :param latency_window: Number of recent latencies to keep for each expert
+        :param workers_per_expert: Number of questions each expert can work on at once (more are skipped, not queued)
+        :param cascade: `True` to only score the candidates of the first-stage expert with the other experts
+        :param first_stage: Name of the (cheap) expert that generates candidates in cascade mode
+        :param n_candidates: Number of first-stage candidates to re-score in cascade mode
+        :param fusion: The `ScoreFusion` used to combine the experts (defaults to the one saved by `calibrate`, or to
+                       unweighted reciprocal-rank fusion)
+        :param scheduler: The `ExpertScheduler` used to answer within a time budget
+        :param fusion_path: Where `calibrate` saves the fusion weights
+        """
         self.num_best = 10
 
         self.dictionary = dictionary
         self.experts = [expert(self.dictionary, num_best=self.num_best) for expert in experts]
 
-    def heuristic(self, i, score):
-        return (self.num_best - i) ** 1.5
+        self.deadlines = deadlines if deadlines is not None else {}
+        self.default_deadline = default_deadline
+
+        # per-expert latencies (in seconds, including waiting for a worker) and the number of times each expert was
+        # dropped for being late, skipped because all of its workers were still busy with earlier questions, or failed
+        self.latencies = dict((expert.name, collections.deque(maxlen=latency_window)) for expert in self.experts)
+        self.dropped = dict((expert.name, 0) for expert in self.experts)
+        self.skipped = dict((expert.name, 0) for expert in self.experts)
+        self.errors = dict((expert.name, 0) for expert in self.experts)
+        self._register_metrics()
+
+        # scoring is numpy / BLAS bound and releases the GIL, so threads are enough to run the experts in parallel.
+        # each expert has its own workers, so a slow expert's stragglers never hold up the others
+        self.workers_per_expert = workers_per_expert
+        self.start_workers()
+
+        # cascade mode (and scheduling at a limited depth) needs an expert to generate the candidates
+        if first_stage not in [expert.name for expert in self.experts]:
+            assert not cascade, 'Cascade mode needs the first-stage expert "%s"' % first_stage
+            first_stage = None
+
+        self.cascade = cascade
+        self.first_stage = first_stage
+        self.n_candidates = n_candidates
 
-    def top_n_documents(self, document, n):
-        scores = {}
+        self.fusion_path = fusion_path
+        if fusion is None:
+            fusion = ScoreFusion.load(fusion_path) if os.path.exists(fusion_path) else ScoreFusion()
+        self.fusion = fusion
+        self._add_lock = threading.Lock()
+        self._catch_up()
+        if scheduler is None:
+            scheduler = ExpertScheduler([expert.name for expert in self.experts], first_stage=first_stage,
+                                        depths=ExpertScheduler.DEPTHS if first_stage is not None else
+                                        (ExpertScheduler.FULL,), corpus_size=len(self.experts[0]))
+        self.scheduler = scheduler
 
+    def _register_metrics(self):
+        """ Export the experts' latencies, drops, skips, errors and busy workers (see `models.metrics`) """
+        self._expert_seconds = {}
         for expert in self.experts:
-            print('A')
-            docs = expert.top_n_documents(self.dictionary.vocab.doc2bow(CorpusDictionary.tokenize(document)), self.num_best)
-            print('B')
-            for i, doc in enumerate(docs):
-                doc_id, score = doc[0], doc[1]
-                if doc_id in scores:
-                    scores[doc_id] += self.heuristic(i, score)
-                else:
-                    scores[doc_id] = self.heuristic(i, score)
-            print(expert)
-            print(scores)
+            name = expert.name
+            self._expert_seconds[name] = REGISTRY.histogram(
+                'pipeline_expert_seconds', 'Seconds each expert took to answer, including waiting for a worker',
+                expert=name)
+            REGISTRY.callback('pipeline_expert_dropped_total', 'Questions an expert was dropped from for being late',
+                              lambda name=name: self.dropped[name], 'counter', expert=name)
+            REGISTRY.callback('pipeline_expert_skipped_total', 'Questions an expert skipped with all its workers busy',
+                              lambda name=name: self.skipped[name], 'counter', expert=name)
+            REGISTRY.callback('pipeline_expert_errors_total', 'Questions an expert was dropped from for failing',
+                              lambda name=name: self.errors[name], 'counter', expert=name)
+            REGISTRY.callback('pipeline_expert_in_flight', 'Tasks running on the workers of each expert',
+                              lambda name=name: self.in_flight[name], expert=name)
+        self._fusion_seconds = stage_histogram('fusion')
+
+    def start_workers(self):
+        """
+        Start the expert worker threads. The constructor starts them; call this again after `close` to restart them,
+        e.g. in a process forked from the one that loaded the experts (threads do not survive a fork).
+        """
+        self.pools = dict((expert.name, ThreadPool(self.workers_per_expert)) for expert in self.experts)
+        self.in_flight = dict((expert.name, 0) for expert in self.experts)
+        self._submit_lock = threading.Lock()
+
+    def preload(self):
+        """
+        Load every expert's index and model now, rather than on their first query: the shards are loaded, and a
+        question made of the first words of the vocabulary is searched and re-scored by every expert
+        """
+        vocab = self.dictionary.vocab
+        question = self.plan(u' '.join(vocab[i] for i in range(min(20, len(vocab)))))
+        for expert in self.experts:
+            if hasattr(expert, 'preload'):
+                expert.preload()
+            ids, _ = expert.top_n_arrays(question, self.num_best)
+            if hasattr(expert, 'score_candidate_arrays'):
+                expert.score_candidate_arrays(question, ids)
+
+    def deadline(self, expert):
+        return self.deadlines.get(expert.name, self.default_deadline)
+
+    def get_expert(self, name):
+        for expert in self.experts:
+            if expert.name == name:
+                return expert
+        raise KeyError('No expert named "%s"' % name)
+
+    def _submit(self, expert, depth, method, *args):
+        """ Run `method` on one of the expert's workers, or return `None` if they are all busy """
+        with self._submit_lock:
+            if self.in_flight[expert.name] >= self.workers_per_expert:
+                self.skipped[expert.name] += 1
+                return None
+            self.in_flight[expert.name] += 1
+
+        return self.pools[expert.name].apply_async(self._timed, (expert, depth, time.time(), method) + args)
+
+    def _timed(self, expert, depth, submitted, method, *args):
+        try:
+            with span('expert', expert=expert.name, depth=depth, wait=time.time() - submitted):
+                docs = method(*args)
+        finally:
+            with self._submit_lock:
+                self.in_flight[expert.name] -= 1
+
+        elapsed = time.time() - submitted
+        self.latencies[expert.name].append(elapsed)
+        self._expert_seconds[expert.name].observe(elapsed)
+        self.scheduler.record(expert.name, depth, elapsed)
+        return docs
+
+    def _rescore(self, expert, plans, candidates):
+        results = []
+        for plan, (ids, _) in zip(plans, candidates):
+            ids, scores = expert.score_candidate_arrays(plan, ids)
+            best = top_n(scores, self.num_best)
+            results.append((ids[best], scores[best]))
+        return results
+
+    @staticmethod
+    def _top_n_batch(expert, plans, n):
+        """ An expert's best `n` documents for each question, with a single call if it can score a batch at once """
+        if len(plans) > 1 and hasattr(expert, 'top_n_batch_arrays'):
+            return expert.top_n_batch_arrays(plans, n)
+        return [expert.top_n_arrays(plan, n) for plan in plans]
+
+    def _candidates(self, plans, depth):
+        expert = self.get_expert(self.first_stage)
+        return self._submit(expert, depth, self._top_n_batch, expert, plans, max(depth, self.num_best))
+
+    def _wait(self, expert, result, start, budget):
+        """ An expert's results, or `None` if it was skipped, failed or missed its deadline (counted from `start`) """
+        if result is None:
+            logger.warning('Skipping <%s>: all of its workers are busy' % expert.name)
+            return None
+
+        deadline = self.deadline(expert) if budget is None else min(self.deadline(expert), budget)
+        try:
+            return result.get(timeout=max(0, start + deadline - time.time()))
+        except TimeoutError:
+            logger.warning('Dropping <%s>: no answer within %.3fs' % (expert.name, deadline))
+            self.dropped[expert.name] += 1
+            return None
+        except Exception:
+            # a failing expert is dropped like a late one: the question is answered by the others
+            logger.exception('Dropping <%s>: it raised an error' % expert.name)
+            self.errors[expert.name] += 1
+            return None
+
+    def plan(self, document):
+        return document if isinstance(document, QueryPlan) else QueryPlan(self.dictionary, document)
+
+    def top_n_documents(self, document, n, budget=None):
+        """
+        Retrieve the best documents for a question according to the fused experts.
+
+        :param document: The question, as a string or `QueryPlan`
+        :param n: Number of documents to return
+        :param budget: Seconds available to answer; if given, only the experts and candidate depth that the scheduler
+                       expects to fit in it are run
+        :return: The ids of the best `n` documents, best first
+        """
+        # the question is tokenized, encoded and transformed once for all experts
+        plan = self.plan(document)
+
+        if budget is None:
+            return self._top_n([plan], n, self.experts, self.n_candidates if self.cascade else ExpertScheduler.FULL)[0]
+
+        names, depth = self.scheduler.schedule(budget)
+        return self._top_n([plan], n, [self.get_expert(name) for name in names], depth, budget)[0]
+
+    def top_n_batch(self, documents, n, budget=None, experts=None):
+        """
+        Like `top_n_documents` for several questions at once. Each expert gets the whole batch as one task, and
+        experts with a `top_n_batch_arrays` score all the questions with one matrix product. The experts' deadlines
+        and the budget apply to the whole batch.
 
-        return sorted(scores, key=scores.get)[:n]
+        :param documents: The questions, as strings or `QueryPlan`s
+        :param n: Number of documents to return per question
+        :param budget: Seconds available to answer the questions (see `top_n_documents`)
+        :param experts: Names of the only experts to run, over the whole corpus, instead of all or the scheduled ones
+        :return: For each question, the ids of its best `n` documents, best first (none if every expert was late)
+        """
+        plans = [self.plan(document) for document in documents]
+
+        if experts is not None:
+            return self._top_n(plans, n, [self.get_expert(name) for name in experts], ExpertScheduler.FULL, budget)
+        if budget is None:
+            return self._top_n(plans, n, self.experts, self.n_candidates if self.cascade else ExpertScheduler.FULL)
+
+        names, depth = self.scheduler.schedule(budget)
+        return self._top_n(plans, n, [self.get_expert(name) for name in names], depth, budget)
+
+    @traced('MixtureOfExperts.top_n')
+    def _top_n(self, plans, n, experts, depth, budget=None):
+        start = time.time()
+        if depth is not ExpertScheduler.FULL:
+            # cheap first stage over the whole corpus, then the other experts only score its candidates. the first
+            # stage counts against every expert's deadline, since they cannot start before it is done
+            first_stage = self.get_expert(self.first_stage)
+            candidates = self._wait(first_stage, self._candidates(plans, depth), start, budget)
+            if candidates is None:
+                return [[] for _ in plans]
+
+            pending = [(expert, self._submit(expert, depth, self._rescore, expert, plans, candidates))
+                       for expert in experts if expert.name != self.first_stage]
+            results = [[(first_stage, (ids[:self.num_best], scores[:self.num_best]))] for ids, scores in candidates]
+        else:
+            pending = [(expert, self._submit(expert, depth, self._top_n_batch, expert, plans, self.num_best))
+                       for expert in experts]
+            results = [[] for _ in plans]
+
+        for expert, result in pending:
+            docs = self._wait(expert, result, start, budget)
+            if docs is not None:
+                for plan_results, plan_docs in zip(results, docs):
+                    plan_results.append((expert, plan_docs))
+
+        fusion_start = time.time()
+        with span('fusion', experts=len(experts), batch=len(plans)):
+            fused = [self.fusion.fuse([(e.name, ids, scores) for e, (ids, scores) in plan_results], n)[0].tolist()
+                     for plan_results in results]
+        self._fusion_seconds.observe(time.time() - fusion_start)
+        return fused
+
+    def first_stage_recall(self, documents):
+        """
+        Fraction of each expert's full-corpus top `num_best` documents that are among the first-stage candidates,
+        i.e. how much the cascade loses compared to letting every expert score the whole corpus.
+
+        :param documents: Questions (strings) to measure the recall on
+        :return: The mean recall over all documents and experts
+        """
+        assert self.first_stage is not None, 'There is no first-stage expert'
+        hits, total = 0, 0
+
+        for document in documents:
+            plan = self.plan(document)
+            first_stage = self.get_expert(self.first_stage)
+            candidate_ids = set(doc_id for doc_id, _ in first_stage.top_n_documents(plan, self.n_candidates))
+
+            for expert in self.experts:
+                if expert.name == self.first_stage:
+                    continue
+                docs = expert.top_n_documents(plan, self.num_best)
+                hits += sum(1 for doc_id, _ in docs if doc_id in candidate_ids)
+                total += len(docs)
+
+        return float(hits) / total if total > 0 else 1.0
+
+    def calibrate(self, n_questions=200, depth=100):
+        """
+        Learn the fusion weights of the experts from questions in the database (an answer is relevant to the question
+        it was given for), and save them to `fusion_path`.
+
+        :param n_questions: Number of questions to sample
+        :param depth: Number of documents each expert retrieves per question
+        :return: The learned weights, keyed by expert name
+        """
+        session = DBSession()
+        questions = session.query(Question.id, Question.title).order_by(func.random()).limit(n_questions).all()
+
+        results, relevant = [], []
+        for question_id, title in questions:
+            answer_ids = [answer_id for answer_id, in session.query(Answer.id).filter(Answer.question_id == question_id)]
+            positions = self.dictionary.answer_positions(answer_ids)
+            if not (positions >= 0).any():
+                continue
+
+            plan = self.plan(title)
+            results.append([(expert.name,) + expert.top_n_arrays(plan, depth) for expert in self.experts])
+            relevant.append(set(positions[positions >= 0].tolist()))
+
+        session.close()
+
+        weights = self.fusion.calibrate(results, relevant)
+        logger.info('Calibrated fusion weights on %d questions: %r' % (len(results), weights))
+        self.fusion.save(self.fusion_path)
+        return weights
+
+    def add_documents(self, answers):
+        """
+        Store new answers and make them searchable by every expert without rebuilding their indexes.
+
+        :param answers: A list of `Answer` objects
+        :return: The ids assigned to the new answers (positions in `dictionary.answer_ids`)
+        """
+        bows = [self.dictionary.doc2vec(answer.content) for answer in answers]
+
+        # the answer store and every expert must append the answers in the same order. the answer store is written
+        # first and is the reference: an expert that fails here is caught up on the next add (or restart)
+        with self._add_lock:
+            ids = list(self.dictionary.add_answers(answers))
+            for expert in self.experts:
+                try:
+                    self._catch_up(experts=[expert], end=ids[0] if len(ids) > 0 else None)
+                    expert_ids = list(expert.add_documents(bows))
+                    assert expert_ids == ids, '<%s> assigned ids %r, expected %r' % (expert.name, expert_ids, ids)
+                except Exception:
+                    logger.exception('<%s> failed to add %d answers, it will be caught up later' % (
+                        expert.name, len(answers)))
+
+        return ids
+
+    def _catch_up(self, experts=None, end=None, batch_size=500):
+        """
+        Add to the experts the answers of the answer store they do not have yet. Answers are stored before the experts
+        add them, and the experts only persist them when they compact, so after a restart (or a failed add) an expert
+        can be behind the store, never ahead.
+
+        :param experts: The experts to catch up (default: all)
+        :param end: Position in the answer store to catch up to (default: its end)
+        :param batch_size: Number of answers fetched from the database at once
+        """
+        end = len(self.dictionary.answer_ids) if end is None else end
+        for expert in experts if experts is not None else self.experts:
+            start = len(expert)
+            if start > end:
+                logger.error('<%s> has %d documents, more than the %d answers stored' % (expert.name, start, end))
+                continue
+            if start == end:
+                continue
+
+            logger.warning('<%s> is missing answers %d to %d, adding them' % (expert.name, start, end))
+            for first in range(start, end, batch_size):
+                answer_ids = [int(i) for i in self.dictionary.answer_ids[first:min(first + batch_size, end)]]
+                session = DBSession()
+                try:
+                    contents = dict(session.query(Answer.id, Answer.content).filter(Answer.id.in_(answer_ids)))
+                finally:
+                    session.close()
+
+                expected = range(first, first + len(answer_ids))
+                expert_ids = list(expert.add_documents([self.dictionary.doc2vec(contents[i]) for i in answer_ids]))
+                assert expert_ids == expected, '<%s> assigned ids %r, expected %r' % (expert.name, expert_ids, expected)
+
+    def close(self):
+        """ Stop the expert worker threads """
+        for pool in self.pools.values():
+            pool.close()
+            pool.join()
 
 
 if __name__ == '__main__':
@@ -46,9 +404,10 @@ if __name__ == '__main__':
     dic = CorpusDictionary(prefix='v20000')
 
     moe = MixtureOfExperts(dic, experts)
+    if not os.path.exists(moe.fusion_path):
+        moe.calibrate()
 
     while True:
         d = raw_input('Enter a question: ')
         docs = moe.top_n_documents(d, 5)
         print(docs)
-
@@ -0,0 +1,180 @@
+"""
+Pure-numpy inference for the LSTM QA model of `models/lstm_for_nonfactoid_qa.py`
+
+`export` writes the weights of a trained model to an `.npz` file (this is the only step that needs Keras);
+`NumpyQAModel` then reproduces the forward pass of both towers (embeddings, bidirectional LSTMs, pooling and dense
+layers) with numpy alone. It starts as fast as the file loads, needs no compilation, holds no Theano state (so it can
+be shared by forked worker processes) and spends its time in BLAS, which releases the GIL.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+import config
+from models.lstm_for_nonfactoid_qa import QAModel, TokenEncoder, build_model, bucket_width, bucketed_weights_path, \
+    pool_length, vocab_path
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the LSTM nodes of `build_model` (the same in both variants)
+LSTM_NODES = ('q_flstm1', 'q_blstm1', 'a_flstm1', 'a_blstm1')
+
+
+def npz_path(weights):
+    """ Where the numpy weights exported from the Keras weights `weights` are stored """
+    return os.path.splitext(weights)[0] + '.npz'
+
+
+def export(weights=None, fname=None, vocab=vocab_path, bucketed=False):
+    """
+    Export the weights of a trained model to an `.npz` file for `NumpyQAModel`: every array of every node, as
+    '<node>:<index>', plus whether the model is the bucketed variant.
+
+    :param weights: The saved Keras weights (defaults to those of the chosen variant)
+    :param fname: The file to write (defaults to `npz_path(weights)`)
+    :param vocab: The vocabulary the model was trained with
+    :param bucketed: Export the length-bucketed variant (see `build_model`)
+    :return: The name of the written file
+    """
+    if weights is None:
+        weights = bucketed_weights_path if bucketed else config.MODELS['lstm_cnn']
+    if fname is None:
+        fname = npz_path(weights)
+
+    model = build_model(TokenEncoder.load(vocab).max_char, bucketed=bucketed)
+    model.load_weights(weights)
+
+    arrays = {'bucketed': np.asarray(bucketed)}
+    for name, node in model.nodes.items():
+        for i, array in enumerate(node.get_weights()):
+            arrays['%s:%d' % (name, i)] = array
+
+    logger.info('Exporting <lstm_cnn> weights from "%s" to "%s"' % (weights, fname))
+    np.savez(fname, **arrays)
+    return fname
+
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0., 1.)
+
+
+def lstm(x, W, U, b, go_backwards=False):
+    """
+    Run a Keras LSTM over a batch of sequences.
+
+    :param x: The (batch, steps, input_dim) inputs
+    :param W: The input weights of the input, forget, cell and output gates, side by side
+    :param U: The recurrent weights, in the same order
+    :param b: The biases, in the same order
+    :param go_backwards: Run from the last step to the first; the outputs are then in that (reversed) order, like
+                         Keras returns them
+    :return: The (batch, steps, output_dim) outputs
+    """
+    n, steps, input_dim = x.shape
+    dims = U.shape[0]
+
+    # the input part of every gate at every step with a single matrix product
+    xw = (np.dot(x.reshape(n * steps, input_dim), W) + b).reshape(n, steps, 4 * dims)
+
+    h = np.zeros((n, dims), dtype=np.float32)
+    c = np.zeros((n, dims), dtype=np.float32)
+    outputs = np.empty((n, steps, dims), dtype=np.float32)
+    for t in range(steps):
+        z = xw[:, steps - 1 - t if go_backwards else t] + np.dot(h, U)
+        i = hard_sigmoid(z[:, :dims])
+        f = hard_sigmoid(z[:, dims:2 * dims])
+        c = f * c + i * np.tanh(z[:, 2 * dims:3 * dims])
+        h = hard_sigmoid(z[:, 3 * dims:]) * np.tanh(c)
+        outputs[:, t] = h
+    return outputs
+
+
+def pool(x, length, function):
+    """ Keras' (valid, non-overlapping) 1D max or average pooling over the time steps of a batch """
+    n, steps, dims = x.shape
+    windows = steps // length
+    return function(x[:, :windows * length].reshape(n, windows, length, dims), axis=2)
+
+
+class NumpyQAModel(QAModel):
+    def __init__(self, params, encoder, weights=config.MODELS['lstm_cnn']):
+        """
+        A `QAModel` (same encoding and ranking methods) whose towers are computed with numpy from exported weights.
+
+        :param params: The arrays written by `export`
+        :param encoder: The `TokenEncoder` the model was trained with
+        :param weights: The Keras weights the parameters were exported from (its answer encodings are cached next to
+                        them, and are the same for both engines)
+        """
+        self.model = None
+        self.encoder = encoder
+        self.weights = weights
+        self.bucketed = bool(params['bucketed'])
+        self.bucket_width = bucket_width if self.bucketed else None
+        self.joined = self.bucketed
+
+        embeddings = ['q_emb', 'a_emb'] if self.joined else ['qt_emb', 'qc_emb', 'a_emb']
+        self.embeddings = dict((name, params[name + ':0']) for name in embeddings)
+        self.dense = dict((name, (params[name + ':0'], params[name + ':1'])) for name in ('q_out', 'a_out'))
+
+        # the Keras weights are [W_i, U_i, b_i, W_c, U_c, b_c, W_f, U_f, b_f, W_o, U_o, b_o]; stack the gates in the
+        # order `lstm` reads them: input, forget, cell, output
+        self.lstms = {}
+        for name in LSTM_NODES:
+            W_i, U_i, b_i, W_c, U_c, b_c, W_f, U_f, b_f, W_o, U_o, b_o = [params['%s:%d' % (name, i)] for i in range(12)]
+            self.lstms[name] = (np.hstack([W_i, W_f, W_c, W_o]), np.hstack([U_i, U_f, U_c, U_o]),
+                                np.concatenate([b_i, b_f, b_c, b_o]))
+
+        self.question_tower = lambda inputs: [self._question(*inputs)]
+        self.answer_tower = lambda inputs: [self._tower('a', self.embeddings['a_emb'][inputs[0]], 2)]
+
+    @staticmethod
+    def load(fname=None, vocab=vocab_path, bucketed=False):
+        """
+        Load exported weights (see `export`)
+
+        :param fname: The exported weights (defaults to those of the chosen variant)
+        :param vocab: The vocabulary the model was trained with
+        :param bucketed: Load the length-bucketed variant
+        """
+        weights = bucketed_weights_path if bucketed else config.MODELS['lstm_cnn']
+        if fname is None:
+            fname = npz_path(weights)
+
+        logger.info('Loading numpy <lstm_cnn> weights from "%s"' % fname)
+        params = np.load(fname)
+        return NumpyQAModel(dict((key, params[key]) for key in params.files), TokenEncoder.load(vocab), weights)
+
+    def _question(self, *inputs):
+        if self.joined:
+            x = self.embeddings['q_emb'][inputs[0]]
+        else:
+            x = np.concatenate([self.embeddings['qt_emb'][inputs[0]], self.embeddings['qc_emb'][inputs[1]]], axis=1)
+        return self._tower('q', x, pool_length)
+
+    def _tower(self, tower, x, length):
+        """ The bidirectional LSTM, pooling and dense layers of one tower over its embedded inputs """
+        forward = lstm(x, *self.lstms[tower + '_flstm1'])
+        backward = lstm(x, *self.lstms[tower + '_blstm1'], go_backwards=True)
+        sequence = (forward + backward) / 2
+
+        if self.bucketed:
+            features = np.concatenate([sequence.max(axis=1), sequence.mean(axis=1)], axis=1)
+        else:
+            features = np.concatenate([pool(sequence, length, np.max), pool(sequence, length, np.mean)], axis=2)
+            features = features.reshape(len(features), -1)
+
+        W, b = self.dense[tower + '_out']
+        return np.tanh(np.dot(features, W) + b)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the weights of the trained LSTM QA model for numpy inference')
+    parser.add_argument('--weights', help='the saved Keras weights (default: those of the chosen variant)')
+    parser.add_argument('--bucketed', action='store_true', help='export the length-bucketed variant')
+    args = parser.parse_args()
+
+    export(args.weights, bucketed=args.bucketed)
@@ -0,0 +1,359 @@
+""" Pre-encoded question / answer pairs and a prefetching batch pipeline for training the QA models """
+
+import itertools
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from models.tracing import span
+from serialization.sqldb import DBSession, Answer, Question
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def pad(seqs, maxlen, value=0):
+    """ Pad (at the front) or truncate (keeping the end) sequences to `maxlen`, like keras' `pad_sequences` """
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+    tokens = np.concatenate(seqs) if lengths.sum() > 0 else np.zeros(0, dtype=np.int32)
+    return pad_flat(tokens, lengths, maxlen, value)
+
+
+def pad_flat(tokens, lengths, maxlen, value=0):
+    """
+    Like `pad` for sequences stored back to back in one array, with a single scatter instead of a copy per sequence.
+
+    :param tokens: The concatenated sequences
+    :param lengths: Length of each sequence (longer than `maxlen` are truncated, keeping the end)
+    :param maxlen: Length to pad to
+    :return: A (len(lengths), maxlen) int32 array
+    """
+    tokens = np.asarray(tokens)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    x = np.empty((len(lengths), maxlen), dtype=np.int32)
+    x.fill(value)
+
+    # position of every token counted back from the end of its sequence, which ends at the last column
+    ends = np.cumsum(lengths)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    from_end = np.repeat(ends, lengths) - np.arange(len(tokens)) - 1
+    if len(lengths) > 0 and lengths.max() > maxlen:
+        keep = from_end < maxlen
+        rows, from_end, tokens = rows[keep], from_end[keep], tokens[keep]
+    x[rows, maxlen - 1 - from_end] = tokens
+    return x
+
+
+def bucket_length(length, max_len, bucket_width):
+    """
+    The padded length of a batch whose longest sequence has `length` items: rounded up to a multiple of
+    `bucket_width` (so batches share a few shapes), at least one step and at most `max_len`.
+    """
+    return int(min(max(-(-length // bucket_width) * bucket_width, 1), max_len))
+
+
+def pad_batch(seqs, max_len, bucket_width=None):
+    """ Pad to `max_len`, or with `bucket_width` only to the bucket of the batch's longest sequence """
+    if bucket_width is not None:
+        max_len = bucket_length(max([len(seq) for seq in seqs] or [0]), max_len, bucket_width)
+    return pad(seqs, max_len)
+
+
+class EncodedQACorpus(object):
+    FIELDS = ('answer', 'question_title', 'question_content')
+
+    def __init__(self, path):
+        """
+        Token ids of every answer and of its question's title and content, each field stored as one flat int32 array
+        plus offsets so that training never touches the database.
+
+        :param path: Prefix of the files holding the encoded corpus
+        """
+        self.path = path
+        self.tokens = {}
+        self.offsets = {}
+        self.answer_ids = None
+        self.question_ids = None
+        self.negatives = None
+
+        if self.exists():
+            self.load()
+
+    def _file(self, field, what):
+        return '%s.%s.%s.npy' % (self.path, field, what)
+
+    def _files(self):
+        return [self._file(field, what) for field in EncodedQACorpus.FIELDS for what in ('tokens', 'offsets')] + \
+               [self._file('answer', 'ids'), self._file('question', 'ids')]
+
+    def exists(self):
+        return all(os.path.exists(fname) for fname in self._files())
+
+    def load(self):
+        logger.info('Loading encoded QA corpus from "%s"' % self.path)
+        for field in EncodedQACorpus.FIELDS:
+            self.tokens[field] = np.load(self._file(field, 'tokens'), mmap_mode='r')
+            self.offsets[field] = np.load(self._file(field, 'offsets'), mmap_mode='r')
+        self.answer_ids = np.load(self._file('answer', 'ids'), mmap_mode='r')
+        self.question_ids = np.load(self._file('question', 'ids'), mmap_mode='r')
+
+        # hard negatives are optional (see `mine_negatives`)
+        if os.path.exists(self._file('answer', 'negatives')):
+            self.negatives = np.load(self._file('answer', 'negatives'), mmap_mode='r')
+
+    def build(self, encode, max_lens, yield_per=1000, print_per=10000):
+        """
+        Encode the database in one pass (answers joined with their questions, so nothing is lazy-loaded).
+
+        :param encode: Function mapping (text, max_len) to an array of token ids
+        :param max_lens: Maximum number of tokens to keep for each field
+        :param yield_per: Number of rows to retrieve from the database at once
+        :param print_per: Number of rows between progress messages
+        """
+        session = DBSession()
+        rows = session.query(Answer.content, Question.title, Question.content, Question.id, Answer.id) \
+                      .join(Question, Answer.question_id == Question.id) \
+                      .order_by(Answer.id).yield_per(yield_per)
+
+        chunks = dict((field, []) for field in EncodedQACorpus.FIELDS)
+        lengths = dict((field, []) for field in EncodedQACorpus.FIELDS)
+        answer_ids = []
+        question_ids = []
+
+        for i, row in enumerate(rows):
+            if (i + 1) % print_per == 0:
+                logger.info('Encoded %d answers' % (i + 1))
+
+            for field, text in zip(EncodedQACorpus.FIELDS, row[:3]):
+                enc = np.asarray(encode(text, max_lens[field]), dtype=np.int32)
+                chunks[field].append(enc)
+                lengths[field].append(len(enc))
+            question_ids.append(row[3])
+            answer_ids.append(row[4])
+
+        session.close()
+
+        for field in EncodedQACorpus.FIELDS:
+            offsets = np.zeros(len(lengths[field]) + 1, dtype=np.int64)
+            np.cumsum(lengths[field], out=offsets[1:])
+            tokens = np.concatenate(chunks[field]) if len(chunks[field]) > 0 else np.zeros(0, dtype=np.int32)
+            np.save(self._file(field, 'tokens'), tokens)
+            np.save(self._file(field, 'offsets'), offsets)
+        np.save(self._file('answer', 'ids'), np.asarray(answer_ids, dtype=np.int64))
+        np.save(self._file('question', 'ids'), np.asarray(question_ids, dtype=np.int64))
+
+        self.load()
+
+    def mine_negatives(self, retrieval, dictionary, n_negatives=10, depth=50, batch_size=256, print_per=10000):
+        """
+        Precompute hard negatives for every answer: answers that a retrieval model ranks high for its question, but
+        that were given to other questions. Each question is queried once, `batch_size` questions at a time.
+
+        :param retrieval: A gensim retrieval model over the answer corpus (e.g. `TfidfRetrieval`)
+        :param dictionary: The `CorpusDictionary` the retrieval model's index was built from
+        :param n_negatives: Number of negatives to keep per answer (missing ones are -1)
+        :param depth: Number of answers to retrieve per question
+        :param batch_size: Number of questions to query at once
+        :param print_per: Number of questions between progress messages
+        """
+        negatives = np.empty((len(self), n_negatives), dtype=np.int32)
+        negatives.fill(-1)
+
+        # the rows of each question (answers are stored in id order, not grouped by question)
+        order = np.argsort(self.question_ids, kind='mergesort')
+        question_ids = np.asarray(self.question_ids)[order]
+        starts = np.concatenate(([0], np.flatnonzero(question_ids[1:] != question_ids[:-1]) + 1, [len(order)]))
+
+        session = DBSession()
+        for first in range(0, len(starts) - 1, batch_size):
+            groups = range(first, min(first + batch_size, len(starts) - 1))
+            batch_ids = [int(question_ids[starts[g]]) for g in groups]
+            texts = dict((question_id, title if content is None else title + ' ' + content)
+                         for question_id, title, content in
+                         session.query(Question.id, Question.title, Question.content).filter(Question.id.in_(batch_ids)))
+
+            queries = [dictionary.doc2vec(texts.get(question_id) or '') for question_id in batch_ids]
+            for g, question_id, (positions, _) in zip(groups, batch_ids, retrieval.top_n_batch_arrays(queries, depth)):
+                # index positions -> database ids -> rows of this corpus
+                answer_ids = np.asarray(dictionary.answer_ids)[positions[positions < len(dictionary.answer_ids)]]
+                rows = np.minimum(np.searchsorted(self.answer_ids, answer_ids), len(self) - 1)
+                rows = rows[(self.answer_ids[rows] == answer_ids) & (self.question_ids[rows] != question_id)]
+                negatives[order[starts[g]:starts[g + 1]], :min(len(rows), n_negatives)] = rows[:n_negatives]
+
+            if (first // batch_size + 1) % max(print_per // batch_size, 1) == 0:
+                logger.info('Mined hard negatives for %d / %d questions' % (first + len(groups), len(starts) - 1))
+
+        session.close()
+
+        np.save(self._file('answer', 'negatives'), negatives)
+        self.negatives = np.load(self._file('answer', 'negatives'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.question_ids)
+
+    def get(self, field, i):
+        return self.tokens[field][self.offsets[field][i]:self.offsets[field][i + 1]]
+
+
+def _assemble(titles, contents, answers, n, max_lens, rng, bucket_width):
+    targets = np.asarray([1] * n + [-1] * n)
+    order = rng.permutation(2 * n)
+
+    if bucket_width is not None:
+        # the bucketed model reads each question as one sequence, its title followed by its content
+        questions = [np.concatenate([titles[i], contents[i]]) for i in order]
+        return {'question': pad_batch(questions, max_lens['question_title'] + max_lens['question_content'],
+                                      bucket_width),
+                'answer': pad_batch([answers[i] for i in order], max_lens['answer'], bucket_width),
+                'output': targets[order]}
+
+    return {'question_title': pad_batch([titles[i] for i in order], max_lens['question_title'], bucket_width),
+            'question_content': pad_batch([contents[i] for i in order], max_lens['question_content'], bucket_width),
+            'answer': pad_batch([answers[i] for i in order], max_lens['answer'], bucket_width),
+            'output': targets[order]}
+
+
+def make_batch(corpus, indices, max_lens, rng, bucket_width=None):
+    """
+    Build a training batch: every answer with its own question (target 1) and with the next one's (target -1).
+
+    :param corpus: The `EncodedQACorpus`
+    :param indices: Answers in the batch
+    :param max_lens: Length to pad each field to
+    :param rng: Random state used to shuffle the batch
+    :param bucket_width: Pad each field only to the bucket of its longest sequence instead (see `pad_batch`), for
+                         the bucketed model (which takes the question title and content as one 'question' input)
+    :return: A dictionary of model inputs and targets
+    """
+    rotated = np.roll(indices, -1)
+
+    answers = [corpus.get('answer', i) for i in indices] * 2
+    titles = [corpus.get('question_title', i) for i in itertools.chain(indices, rotated)]
+    contents = [corpus.get('question_content', i) for i in itertools.chain(indices, rotated)]
+    return _assemble(titles, contents, answers, len(indices), max_lens, rng, bucket_width)
+
+
+def make_hard_batch(corpus, indices, max_lens, rng, bucket_width=None):
+    """
+    Like `make_batch`, but each question's negative is one of its mined hard negatives (see
+    `EncodedQACorpus.mine_negatives`), falling back to the next question's answer when it has none.
+    """
+    rotated = np.roll(indices, -1)
+
+    negatives = []
+    for i, fallback in zip(indices, rotated):
+        candidates = corpus.negatives[i]
+        candidates = candidates[candidates >= 0]
+        negatives.append(candidates[rng.randint(len(candidates))] if len(candidates) > 0 else fallback)
+
+    answers = [corpus.get('answer', i) for i in itertools.chain(indices, negatives)]
+    titles = [corpus.get('question_title', i) for i in indices] * 2
+    contents = [corpus.get('question_content', i) for i in indices] * 2
+    return _assemble(titles, contents, answers, len(indices), max_lens, rng, bucket_width)
+
+
+def _batch_worker(corpus, max_lens, make, bucket_width, tasks, batches, seed):
+    rng = np.random.RandomState(seed)
+    while True:
+        batches.put(make(corpus, tasks.get(), max_lens, rng, bucket_width))
+
+
+class BatchPipeline(object):
+    def __init__(self, corpus, batch_size, max_lens, workers=2, prefetch=16, seed=None, make=make_batch,
+                 report_every=100, bucket_width=None, bucket_window=50):
+        """
+        Endless stream of shuffled training batches, assembled by background worker processes. Each epoch visits the
+        answers in a new random permutation; at most `prefetch` finished batches are kept waiting.
+
+        :param corpus: The `EncodedQACorpus` (memory-mapped, so the workers share its pages)
+        :param batch_size: Number of samples per batch (half of them positive)
+        :param max_lens: Length to pad each field to
+        :param workers: Number of worker processes
+        :param prefetch: Maximum number of batches waiting to be consumed
+        :param seed: Seed for the permutations and shuffling
+        :param make: Function assembling a batch from (corpus, indices, max_lens, rng, bucket_width)
+        :param report_every: Number of batches between throughput messages
+        :param bucket_width: Batch answers of similar length together and pad each batch only to its own bucket
+                             (multiples of `bucket_width`) instead of the maximum lengths
+        :param bucket_window: Number of batches whose answers are sorted by length together; batches are still drawn
+                              from a random permutation, `bucket_window` of them at a time
+        """
+        assert batch_size % 2 == 0, 'Must provide an even number of points to generate'
+        assert len(corpus) >= batch_size // 2, 'The corpus has fewer answers (%d) than a batch needs (%d)' % (
+            len(corpus), batch_size // 2)
+
+        self.corpus = corpus
+        self.batch_size = batch_size
+        self.max_lens = max_lens
+        self.prefetch = prefetch
+        self.rng = np.random.RandomState(seed)
+        self.report_every = report_every
+        self.bucket_width = bucket_width
+        self.bucket_window = bucket_window
+        if bucket_width is not None:
+            # the number of steps each answer and its question take through the model
+            self.lengths = sum(np.diff(corpus.offsets[field]) for field in EncodedQACorpus.FIELDS)
+
+        self.tasks = multiprocessing.Queue(prefetch)
+        self.batches = multiprocessing.Queue(prefetch)
+        self.workers = [multiprocessing.Process(target=_batch_worker,
+                                                args=(corpus, max_lens, make, bucket_width, self.tasks, self.batches,
+                                                      self.rng.randint(2 ** 31)))
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        self.n_samples = 0
+        self.start_time = time.time()
+
+    def _schedule(self):
+        """ Feed the workers batch indices, one shuffled epoch after the other """
+        per_batch = self.batch_size // 2
+        while True:
+            permutation = self.rng.permutation(len(self.corpus))
+            batches = [permutation[start:start + per_batch]
+                       for start in range(0, len(permutation) - per_batch + 1, per_batch)]
+            if self.bucket_width is not None:
+                batches = self._bucket(permutation[:len(batches) * per_batch], per_batch)
+            for batch in batches:
+                yield batch
+
+    def _bucket(self, permutation, per_batch):
+        """ Regroup shuffled answers into batches of similar (answer plus question) length, in a random order """
+        window = per_batch * self.bucket_window
+
+        batches = []
+        for start in range(0, len(permutation), window):
+            chunk = permutation[start:start + window]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind='mergesort')]
+            batches.extend(chunk[i:i + per_batch] for i in range(0, len(chunk), per_batch))
+        return [batches[i] for i in self.rng.permutation(len(batches))]
+
+    def samples_per_second(self):
+        return self.n_samples / max(time.time() - self.start_time, 1e-8)
+
+    def __iter__(self):
+        schedule = self._schedule()
+
+        # keep the workers busy: one task in flight for every batch we can hold
+        for _ in range(self.prefetch):
+            self.tasks.put(next(schedule))
+
+        for i in itertools.count(1):
+            # time the training loop waits for the workers
+            with span('BatchPipeline.next'):
+                batch = self.batches.get()
+            self.tasks.put(next(schedule))
+
+            self.n_samples += len(batch['output'])
+            if i % self.report_every == 0:
+                logger.info('Batch pipeline: %.1f samples / sec' % self.samples_per_second())
+
+            yield batch
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
@@ -0,0 +1,47 @@
+""" Query preprocessing shared by all experts """
+
+import time
+
+from models.metrics import stage_histogram
+from models.tracing import span
+from serialization.dictionary import CorpusDictionary
+
+TOKENIZE_SECONDS = stage_histogram('tokenize')
+
+
+class QueryPlan(object):
+    def __init__(self, dictionary, text):
+        """
+        Preprocessed form of a single question: tokenized and encoded once, then transformed at most once per model.
+        Pass it to `top_n_documents` in place of a bag-of-words document.
+
+        :param dictionary: The `CorpusDictionary` used to encode the question
+        :param text: The question
+        """
+        start = time.time()
+
+        self.text = text
+        self.tokens = list(CorpusDictionary.tokenize(text))
+        self.bow = dictionary.vocab.doc2bow(self.tokens)
+        self.vectors = {}
+
+        # seconds spent preprocessing, keyed by stage ('encode' or the name of a model)
+        self.timings = {'encode': time.time() - start}
+        TOKENIZE_SECONDS.observe(self.timings['encode'])
+
+    def vector(self, expert):
+        """
+        The question in the vector space of an expert's model.
+
+        :param expert: A `GensimInterface` expert (or another `RetrievalInterface` with a `transform`)
+        :return: The transformed question (cached after the first call)
+        """
+        if expert.name not in self.vectors:
+            start = time.time()
+            with span('transform', expert=expert.name):
+                self.vectors[expert.name] = expert.transform(self.text if expert.transforms_text else self.bow)
+            self.timings[expert.name] = time.time() - start
+        return self.vectors[expert.name]
+
+    def preprocess_time(self):
+        return sum(self.timings.values())
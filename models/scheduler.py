@@ -0,0 +1,186 @@
+""" Choosing which experts to run so that a question is answered within its time budget """
+
+import math
+import threading
+import time
+
+
+class LatencyProfile(object):
+    def __init__(self, initial=0.0, alpha=0.1):
+        """
+        Exponentially weighted moving mean and variance of a latency
+
+        :param initial: Latency (in seconds) assumed before anything is observed
+        :param alpha: Weight of each new observation
+        """
+        self.alpha = alpha
+        self.mean = initial
+        self.var = 0.0
+        self.count = 0
+        self.updated = None
+
+    def update(self, seconds):
+        if self.count == 0:
+            self.mean = seconds
+        else:
+            diff = seconds - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.count += 1
+        self.updated = time.time()
+
+    def fresh(self, max_age):
+        """ Whether the profile was observed in the last `max_age` seconds """
+        return self.updated is not None and time.time() - self.updated <= max_age
+
+    def estimate(self, z=2.0):
+        """ A pessimistic estimate of the next latency: `z` standard deviations above the mean """
+        return self.mean + z * math.sqrt(self.var)
+
+
+class ExpertScheduler(object):
+    FULL = None
+    DEPTHS = (FULL, 2000, 1000, 500, 200)
+
+    def __init__(self, expert_names, first_stage='tfidf', priorities=None, depths=DEPTHS, corpus_size=None,
+                 safety=0.8, z=2.0, alpha=0.1, max_age=60.0, probe_interval=1.0):
+        """
+        Tracks the latency of each expert at each candidate depth and picks, for every question, the most complete
+        set of experts and the deepest candidate list that should fit in the question's time budget.
+
+        Observed latencies already include the slowdown from concurrent questions. A depth that was never observed
+        (or not recently) is estimated from the expert's nearest recently observed depth, scaled by the number of
+        candidates; if there is none it is assumed not to fit. To keep the profiles current, at most one question
+        every `probe_interval` seconds also runs one stale expert, or goes one depth deeper, than planned.
+
+        :param expert_names: Names of the experts that can be scheduled
+        :param first_stage: The expert that generates candidates at a limited depth (it is always scheduled)
+        :param priorities: Which experts to keep first when not all of them fit, keyed by name (higher is kept first)
+        :param depths: Candidate depths to choose from, best first (`FULL` means every expert scans the whole corpus)
+        :param corpus_size: Number of documents, used to scale latencies between `FULL` and limited depths
+        :param safety: Fraction of the budget that the schedule may use
+        :param z: Standard deviations above the mean latency to plan for
+        :param alpha: Weight of each new latency observation
+        :param max_age: Seconds after which a latency profile is no longer trusted on its own
+        :param probe_interval: Minimum number of seconds between two questions that probe a stale profile
+        """
+        self.expert_names = list(expert_names)
+        self.first_stage = first_stage
+        self.priorities = priorities if priorities is not None else {}
+        self.depths = depths
+        self.corpus_size = corpus_size
+        self.safety = safety
+        self.z = z
+        self.max_age = max_age
+        self.probe_interval = probe_interval
+
+        # latency profiles keyed by (expert name, depth)
+        self.alpha = alpha
+        self.profiles = {}
+
+        self.last_probe = 0.0
+        self._lock = threading.Lock()
+
+    def profile(self, name, depth):
+        if (name, depth) not in self.profiles:
+            self.profiles[(name, depth)] = LatencyProfile(alpha=self.alpha)
+        return self.profiles[(name, depth)]
+
+    def record(self, name, depth, seconds):
+        with self._lock:
+            self.profile(name, depth).update(seconds)
+
+    def _size(self, depth):
+        return (self.corpus_size or None) if depth is ExpertScheduler.FULL else depth
+
+    def estimate(self, name, depth):
+        """ Pessimistic latency of an expert at a depth, or infinity if nothing is known about it """
+        profile = self.profile(name, depth)
+        if profile.fresh(self.max_age):
+            return profile.estimate(self.z)
+
+        # scale the nearest depth observed recently by the number of candidates
+        size = self._size(depth)
+        if size is not None:
+            neighbours = [(abs(math.log(float(self._size(other)) / size)), other) for other in self.depths
+                          if other != depth and self._size(other) is not None and
+                          self.profile(name, other).fresh(self.max_age)]
+            if len(neighbours) > 0:
+                _, nearest = min(neighbours)
+                return self.profile(name, nearest).estimate(self.z) * size / self._size(nearest)
+
+        return profile.estimate(self.z) if profile.count > 0 else float('inf')
+
+    def _by_priority(self, names):
+        return sorted(names, key=lambda name: -self.priorities.get(name, 0))
+
+    def _fitting(self, depth, available):
+        """ The experts that should fit in `available` seconds at `depth`, or `None` if not even the first does """
+        if depth is ExpertScheduler.FULL:
+            # every expert scans the whole corpus concurrently
+            names = [name for name in self._by_priority(self.expert_names) if self.estimate(name, depth) <= available]
+            return names if len(names) > 0 else None
+
+        # the first stage runs before the others, which then run concurrently
+        first = self.estimate(self.first_stage, depth)
+        if first > available:
+            return None
+        others = self._by_priority(name for name in self.expert_names if name != self.first_stage)
+        return [self.first_stage] + [name for name in others if first + self.estimate(name, depth) <= available]
+
+    def _worth_probing(self, name, depth, budget):
+        # unknown latencies have to be measured; known ones only if they might fit
+        estimate = self.estimate(name, depth)
+        return estimate == float('inf') or estimate <= budget
+
+    def _probe(self, names, depth, budget):
+        """ Add one expert, or one level of depth, whose profile is stale (at most once every `probe_interval`) """
+        now = time.time()
+        with self._lock:
+            if now - self.last_probe < self.probe_interval:
+                return names, depth
+
+            for name in self.expert_names:
+                if name not in names and not self.profile(name, depth).fresh(self.max_age) and \
+                        self._worth_probing(name, depth, budget):
+                    self.last_probe = now
+                    return names + [name], depth
+
+            deeper = self.depths[:list(self.depths).index(depth)]
+            if len(deeper) > 0 and \
+                    not all(self.profile(name, deeper[-1]).fresh(self.max_age) for name in names) and \
+                    all(self._worth_probing(name, deeper[-1], budget) for name in names):
+                self.last_probe = now
+                return names, deeper[-1]
+
+        return names, depth
+
+    def schedule(self, budget):
+        """
+        Choose the experts and candidate depth for a question.
+
+        :param budget: Seconds available to answer the question
+        :return: The names of the experts to run and the candidate depth (`FULL` for no first stage)
+        """
+        available = budget * self.safety
+
+        # prefer running more experts over a deeper candidate list, then the deepest list
+        best = None
+        for depth in self.depths:
+            if depth is not ExpertScheduler.FULL and self.first_stage is None:
+                continue
+            names = self._fitting(depth, available)
+            if names is not None and (best is None or len(names) > len(best[0])):
+                best = names, depth
+
+        if best is None:
+            # nothing fits: the cheapest possible answer
+            limited = [depth for depth in self.depths if depth is not ExpertScheduler.FULL]
+            if self.first_stage is not None and len(limited) > 0:
+                best = [self.first_stage], min(limited)
+            else:
+                best = [self.first_stage or self._by_priority(self.expert_names)[0]], ExpertScheduler.FULL
+
+        names, depth = best
+        return self._probe(names, depth, budget)
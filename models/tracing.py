@@ -0,0 +1,155 @@
+"""
+Lightweight tracing of the pipeline: nested spans recorded as Chrome trace events (open the file in chrome://tracing or
+https://ui.perfetto.dev, which draw them as a flame graph per thread), and optionally a cProfile of a sample of the
+outermost spans (saved next to the trace, for `pstats`, snakeviz or gprof2dot).
+
+Tracing is off until `start` is called, or the `TRACE` environment variable names the trace file (`TRACE_PROFILE_RATE`
+sets the fraction of spans profiled); until then `span` returns a shared no-op context manager and `traced` functions
+only check a flag, so the instrumented code costs a fraction of a microsecond per call. The trace is written by the
+process that started it, on exit: forked workers and `BatchPipeline` worker processes are not traced.
+"""
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import random
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ('tracer', 'name', 'args', 'start', 'profile')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.profile = None
+
+    def __enter__(self):
+        local = self.tracer._local
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+
+        # cProfile cannot nest: only whole outermost spans (per thread) are profiled
+        if depth == 0 and self.tracer.profile_rate > 0 and random.random() < self.tracer.profile_rate:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        if self.profile is not None:
+            self.profile.disable()
+            self.tracer._add_profile(self.profile)
+        self.tracer._local.depth -= 1
+
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer._add_event({'name': self.name, 'ph': 'X', 'ts': self.start * 1e6, 'dur': (end - self.start) * 1e6,
+                                'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': self.args})
+        return False
+
+
+class Tracer(object):
+    def __init__(self):
+        """ Records spans while started (see `start`) """
+        self.enabled = False
+        self.path = None
+        self.profile_rate = 0.
+        self.max_events = 0
+        self.events = []
+        self.dropped = 0
+        self.stats = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, path, profile_rate=0., max_events=1000000):
+        """
+        Start recording spans
+
+        :param path: File to write the trace to (on `stop`), and the profile to with a `.prof` extension
+        :param profile_rate: Fraction of the outermost spans to profile with cProfile
+        :param max_events: Maximum number of spans to keep (later ones are counted but not kept)
+        """
+        self.path = path
+        self.profile_rate = profile_rate
+        self.max_events = max_events
+        self.events, self.dropped, self.stats = [], 0, None
+        self.enabled = True
+
+    def stop(self):
+        """ Stop recording and write the trace (and profile) """
+        if not self.enabled:
+            return
+        self.enabled = False
+
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+        logger.info('Wrote %d spans to "%s"%s' % (len(self.events), self.path,
+                                                   ' (%d dropped)' % self.dropped if self.dropped > 0 else ''))
+        if self.stats is not None:
+            self.stats.dump_stats(self.path + '.prof')
+            logger.info('Wrote the profile of the sampled spans to "%s.prof"' % self.path)
+
+    def span(self, name, **args):
+        """ Context manager that records the time spent in its block as a span named `name`, with `args` """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, args)
+
+    def _add_event(self, event):
+        if len(self.events) < self.max_events:
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def _add_profile(self, profile):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+
+# the tracer the pipeline records into
+TRACER = Tracer()
+span = TRACER.span
+
+
+def traced(name=None):
+    """ Decorator that records every call of a function as a span (named after the function by default) """
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            with TRACER.span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get('TRACE'):
+    TRACER.start(os.environ['TRACE'], float(os.environ.get('TRACE_PROFILE_RATE', 0)))
+    atexit.register(TRACER.stop)
@@ -0,0 +1,71 @@
+""" Training entry point for the character-level language model defined in `models/deep_models.py` """
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+from models.deep_models import CharIndex, CharLanguageModel, build_model, encode_reuters, max_len, \
+    model_save_location, pad_char, reuters_enc_path
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def load_reuters():
+    """ The character index, category indicators and character ids of every Reuters document (created on first use) """
+    if not os.path.exists(reuters_enc_path):
+        return encode_reuters()
+
+    logging.info('Loading reuters encodings from "%s"' % reuters_enc_path)
+    np_file = np.load(reuters_enc_path)
+    return CharIndex.load(), np_file['arr_0'], np_file['arr_1']
+
+
+def iterate_batches(docs, n_chars, batch_size=128, seed=None):
+    """
+    Endless stream of shuffled training batches: the character ids of each document as input, the one-hot next
+    characters as targets, and per-step sample weights that mask the padding after the end of each document (its
+    targets are all zero, so compile the model with `sample_weight_mode='temporal'`). Only one batch is ever one-hot
+    encoded at a time.
+
+    :param docs: The (n_docs, max_len+2) character ids from `encode_reuters`
+    :param n_chars: Number of character ids
+    :param batch_size: Number of documents per batch
+    :param seed: Seed for the permutations
+    """
+    rng = np.random.RandomState(seed)
+
+    while True:
+        permutation = rng.permutation(len(docs))
+        for start in range(0, len(permutation), batch_size):
+            batch = docs[permutation[start:start+batch_size]]
+
+            X = batch[:, :max_len-1].astype(np.int32)
+            targets = batch[:, 1:max_len]
+            rows, cols = np.nonzero(targets != pad_char)
+            y = np.zeros((len(batch), max_len-1, n_chars), dtype=np.bool)
+            y[rows, cols, targets[rows, cols]] = 1
+            yield X, y, (targets != pad_char).astype(np.float32)
+
+
+if __name__ == '__main__':
+    char_index, cats, docs = load_reuters()
+
+    model = build_model(char_index.n_chars)
+
+    logging.info('Compiling model...')
+    model.compile(loss='categorical_crossentropy', optimizer='rmsprop', sample_weight_mode='temporal')
+
+    if os.path.exists(model_save_location):
+        model.load_weights(model_save_location)
+
+    language_model = CharLanguageModel(model, char_index)
+    batches = iterate_batches(docs, char_index.n_chars)
+
+    logging.info('Fitting model...')
+    for i in range(10):
+        language_model.evaluate()
+        model.fit_generator(batches, samples_per_epoch=len(docs), nb_epoch=10, verbose=True)
+        model.save_weights(model_save_location, overwrite=True)
@@ -0,0 +1,134 @@
+""" Training entry point for the LSTM QA model defined in `models/lstm_for_nonfactoid_qa.py` """
+
+from __future__ import print_function
+
+import argparse
+import os
+
+from sqlalchemy import func
+
+import config
+from models.gensim_models import TfidfRetrieval
+from models.lstm_for_nonfactoid_qa import TokenEncoder, QAModel, AnswerEncodingCache, build_model, load_qa_model, \
+    max_lens, bucket_width, bucketed_weights_path
+from models.numpy_qa import export
+from models.qa_data import EncodedQACorpus, BatchPipeline, make_batch, make_hard_batch
+from serialization.dictionary import CorpusDictionary
+from serialization.sqldb import DBSession, Answer, Question
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def compile_model(model):
+    logger.info('Compiling...')
+    model.compile(optimizer='rmsprop', loss={'output': 'mean_squared_error'})
+    logger.info('Done!')
+
+
+#################################
+# generate training set from db #
+#################################
+
+
+def load_qa_corpus(encoder):
+    """ Token ids of every answer and question, encoded once so training never waits on the database """
+    qa_corpus = EncodedQACorpus(os.path.join(config.BASE_DATA_PATH, 'dicts', 'v20000_qa'))
+    if not qa_corpus.exists():
+        qa_corpus.build(encoder.encode_doc, max_lens)
+    return qa_corpus
+
+
+def mine_hard_negatives(qa_corpus):
+    """ Precompute TF-IDF hard negatives for the corpus (once; they are saved next to it) """
+    if qa_corpus.negatives is None:
+        dictionary = CorpusDictionary(prefix='v20000')
+        qa_corpus.mine_negatives(TfidfRetrieval(dictionary), dictionary)
+
+
+def generate_data(qa_corpus, generate_every=50, hard_negatives=False, bucketed=False):
+    """
+    Endless stream of shuffled training batches of `generate_every` samples, half of them positive, assembled by
+    background workers (see `BatchPipeline`, which also logs the samples / sec). Negatives are other questions'
+    answers; with `hard_negatives`, ones that TF-IDF ranks high for the question (see `mine_hard_negatives`). With
+    `bucketed` (for the bucketed model), samples of similar length are batched together and padded only to their
+    bucket.
+    """
+    logger.info('Generating QA sessions')
+    make = make_hard_batch if hard_negatives else make_batch
+    return iter(BatchPipeline(qa_corpus, generate_every, max_lens, make=make,
+                              bucket_width=bucket_width if bucketed else None))
+
+
+def test(qa_model):
+    logger.info('Starting session...')
+    session = DBSession()
+
+    for question in session.query(Question).order_by(func.random()).limit(5):
+
+        print('\n\nQUESTION\n--------')
+        print('Question title: {}'.format(question.title))
+        print('Question content: {}'.format(question.content))
+
+        good = [answer.content for answer in session.query(Answer).filter(Answer.question_id == question.id)]
+        bad = [answer.content for answer in
+               session.query(Answer).filter(Answer.question_id != question.id).order_by(func.random()).limit(5)]
+        scores = qa_model.rank(question.title, question.content, good + bad)
+
+        for label, content, score in zip(['ANSWER'] * len(good) + ['BAD ANSWER'] * len(bad), good + bad, scores):
+            print('{}\n{}\n{}'.format(label, '-' * len(label), content))
+            print(score)
+
+    session.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the LSTM QA model and cache its answer encodings')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='training rounds; 0 loads the saved weights and only re-exports them and rebuilds the cache '
+                             '(default=%(default)s)')
+    parser.add_argument('--hard-negatives', action='store_true',
+                        help='train against TF-IDF hard negatives instead of random answers')
+    parser.add_argument('--bucketed', action='store_true',
+                        help='train the variable-length model on length-bucketed batches (saved separately)')
+    args = parser.parse_args()
+
+    samples_per_epoch = 1000
+    nb_epoch = 1000
+
+    # 10 * 100 * 1000 = 1,000,000
+    # looks at every data set at least once
+
+    if args.rounds == 0:
+        # the numpy engine encodes the answers without compiling anything
+        export(bucketed=args.bucketed)
+        qa_model = load_qa_model(bucketed=args.bucketed)
+        AnswerEncodingCache(qa_model.weights + '.answers').build(qa_model)
+    else:
+        encoder = TokenEncoder.load()
+        model = build_model(encoder.max_char, bucketed=args.bucketed)
+        compile_model(model)
+        if args.bucketed:
+            qa_model = QAModel(model, encoder, weights=bucketed_weights_path, bucket_width=bucket_width)
+        else:
+            qa_model = QAModel(model, encoder)
+        cache = AnswerEncodingCache(qa_model.weights + '.answers')
+
+        qa_corpus = load_qa_corpus(encoder)
+        if args.hard_negatives:
+            mine_hard_negatives(qa_corpus)
+
+    for i in range(args.rounds):
+        model.fit_generator(generate_data(qa_corpus, hard_negatives=args.hard_negatives, bucketed=args.bucketed),
+                            samples_per_epoch, nb_epoch,
+                            validation_data=generate_data(qa_corpus, hard_negatives=args.hard_negatives,
+                                                          bucketed=args.bucketed),
+                            nb_val_samples=10)
+        model.save_weights(qa_model.weights, overwrite=True)
+        export(qa_model.weights, bucketed=args.bucketed)
+
+        # the cached encodings are only valid for the weights they were computed with
+        cache.build(qa_model)
+        test(qa_model)
+
+    logger.info('Done training')
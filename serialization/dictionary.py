@@ -7,14 +7,13 @@ import os
 import gensim
 import itertools
 
-import theano
 from gensim.corpora import Dictionary
-from keras.preprocessing.sequence import pad_sequences
 import numpy as np
 import cPickle as pickle
 
 import config
 
+from models.tracing import span, traced
 from serialization.sqldb import DBSession, Category, Question, Answer
 
 import logging
@@ -28,6 +27,7 @@ class WordsTagsPair:
 
 
 class CorpusDictionary:
+    @traced('CorpusDictionary')
     def __init__(self,
                  prefix='',
                  yield_per=100,
@@ -51,7 +51,9 @@ class CorpusDictionary:
             'cat': os.path.join(config.BASE_DATA_PATH, 'dicts', self.prefix + 'categories.pkl'),
             'mm_question_corpus': os.path.join(config.BASE_DATA_PATH, 'dicts', self.prefix + 'question_corpus.mm'),
             'mm_answer_corpus': os.path.join(config.BASE_DATA_PATH, 'dicts', self.prefix + 'answer_corpus.mm'),
+            'answer_ids': os.path.join(config.BASE_DATA_PATH, 'dicts', self.prefix + 'answer_ids.npy'),
         }
+        self.answer_ids_path = files['answer_ids']
 
         # start a db session
         session = DBSession()
@@ -115,10 +117,12 @@ class CorpusDictionary:
                 yield self.vocab.doc2bow(doc)
 
         if not os.path.exists(files['mm_question_corpus']):
-            gensim.corpora.MmCorpus.serialize(files['mm_question_corpus'], corpus(Question))
+            with span('CorpusDictionary.corpus', corpus='question'):
+                gensim.corpora.MmCorpus.serialize(files['mm_question_corpus'], corpus(Question))
 
         if not os.path.exists(files['mm_answer_corpus']):
-            gensim.corpora.MmCorpus.serialize(files['mm_answer_corpus'], corpus(Answer))
+            with span('CorpusDictionary.corpus', corpus='answer'):
+                gensim.corpora.MmCorpus.serialize(files['mm_answer_corpus'], corpus(Answer))
 
         # load the corpus
         logger.info('Loading corpus from "%s"' % files['mm_question_corpus'])
@@ -127,6 +131,17 @@ class CorpusDictionary:
         logger.info('Loading corpus from "%s"' % files['mm_answer_corpus'])
         self.mm_answer_corpus = gensim.corpora.MmCorpus(files['mm_answer_corpus'])
 
+        # database ids of the answers in the answer corpus (and so in the retrieval indexes), by position
+        if os.path.exists(files['answer_ids']):
+            logger.info('Loading answer ids from "%s"' % files['answer_ids'])
+            self.answer_ids = np.load(files['answer_ids'], mmap_mode='r')
+        else:
+            logger.info('Generating answer ids')
+            with span('CorpusDictionary.answer_ids'):
+                self.answer_ids = np.fromiter((a.id for a in session.query(Answer.id, Answer.content)
+                                               .yield_per(self.yield_per) if a.content is not None), dtype=np.int64)
+                np.save(files['answer_ids'], self.answer_ids)
+
         # commit and close the session
         session.close()
 
@@ -140,6 +155,7 @@ class CorpusDictionary:
         """
         return gensim.utils.tokenize(text, to_lower=True)
 
+    @traced('CorpusDictionary.vocabulary')
     def _generate_vocabulary(self):
         vocab = Dictionary()
         session = DBSession()
@@ -191,6 +207,44 @@ class CorpusDictionary:
 
         session.close()
 
+    def add_answers(self, answers):
+        """
+        Store new answers in the database, after the ones already in the answer corpus.
+
+        :param answers: A list of `Answer` objects (with content)
+        :return: The positions of the new answers, i.e. the ids the retrieval indexes should give them
+        """
+        session = DBSession()
+        session.add_all(answers)
+        session.commit()
+        ids = [answer.id for answer in answers]
+        session.close()
+
+        first = len(self.answer_ids)
+        self.answer_ids = np.concatenate([self.answer_ids, np.asarray(ids, dtype=np.int64)])
+
+        # the saved ids are memory-mapped (possibly by other processes), so replace the file instead of rewriting it
+        with open(self.answer_ids_path + '.tmp', 'wb') as f:
+            np.save(f, self.answer_ids)
+        os.rename(self.answer_ids_path + '.tmp', self.answer_ids_path)
+
+        return range(first, len(self.answer_ids))
+
+    def answer_positions(self, ids):
+        """
+        Map database `Answer.id` values to positions in the answer corpus (the ids used by the retrieval indexes).
+
+        :param ids: `Answer.id` values
+        :return: An array with the position of each answer, -1 for answers that are not in the corpus
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self.answer_ids) == 0:
+            return -np.ones(len(ids), dtype=np.int64)
+
+        # answers are added in id order, so the ids are sorted
+        positions = np.minimum(np.searchsorted(self.answer_ids, ids), len(self.answer_ids) - 1)
+        return np.where(self.answer_ids[positions] == ids, positions, -1)
+
     def doc2vec(self, doc):
         return self.vocab.doc2bow(CorpusDictionary.tokenize(doc))
 
@@ -265,6 +319,10 @@ class CorpusDictionary:
 
         session.close()
 
+        # only needed here, and they take seconds to import: keep them out of the serving processes
+        import theano
+        from keras.preprocessing.sequence import pad_sequences
+
         question_length = config.STRING_LENGTHS['question_title'] + config.STRING_LENGTHS['question_content']
         return pad_sequences(answers, config.STRING_LENGTHS['answer_content'], dtype=theano.config.floatX),\
                pad_sequences(questions, question_length, dtype=theano.config.floatX)
@@ -2,6 +2,7 @@
 
 import os
 import string
+import threading
 
 import config
 
@@ -83,9 +84,28 @@ class Answer(Base):
                                                                              self.is_best,
                                                                              self.question_id)
 
-_engine = create_engine('sqlite:///' + config.DATABASES['yahoo'])
-Base.metadata.bind = _engine
-DBSession = sessionmaker(bind=_engine)
+# the engine is only created when a session is first needed, so importing the models stays cheap (and uses the
+# database configured by then)
+_engine = None
+_engine_lock = threading.Lock()
+_Session = sessionmaker()
+
+
+def get_engine():
+    """ The engine of the database at config.DATABASES['yahoo'], created on first use """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine('sqlite:///' + config.DATABASES['yahoo'])
+                Base.metadata.bind = engine
+                _engine = engine
+    return _engine
+
+
+def DBSession(**kwargs):
+    """ A new session on the database (see `get_engine`) """
+    return _Session(bind=get_engine(), **kwargs)
 
 
 def init_db(db_path, test=False, test_num=10):
@@ -100,7 +120,7 @@ def init_db(db_path, test=False, test_num=10):
         os.remove(db_path)
 
     logger.info('Creating database at "%s"...' % db_path)
-    Base.metadata.create_all(_engine)
+    Base.metadata.create_all(get_engine())
 
     def test_db(num):
         """ Run after creating a new database to ensure that it works as anticipated. """
@@ -0,0 +1,26 @@
+#!/bin/bash
+#
+# Start the LiveQA answer server in the background, with pre-forked workers.
+# Usage: answer-server-start.sh [port] [processes] [other contest_interface.py options]
+#
+cd "$(dirname "$0")/.."
+Port=${1:-8080}
+Processes=${2:-4}
+shift $(( $# < 2 ? $# : 2 ))
+LogDir=$(pwd)/server/logs
+PidFile=$LogDir/answer-server-$Port.pid
+mkdir -p $LogDir
+if [ -f $PidFile ] ; then
+    Pid=$(cat $PidFile)
+    if kill -0 $Pid 2>&1 >/dev/null ; then
+	echo "ERROR: answer server is already running, PID=$Pid"
+	exit 1
+    else
+	# The process does not exist, remove the pid file.
+	rm -f $PidFile
+    fi
+fi
+# the workers' threads allocate from one malloc arena, instead of one each that stays mostly private to the worker
+export MALLOC_ARENA_MAX=${MALLOC_ARENA_MAX:-1}
+python2 contest_interface.py --port $Port --processes $Processes --daemonize $LogDir "$@"
+echo "started, logs in $LogDir"
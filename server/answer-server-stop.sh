@@ -0,0 +1,26 @@
+#!/bin/bash
+#
+# Stop the LiveQA answer server: the master stops its workers, then exits.
+# Usage: answer-server-stop.sh [port]
+#
+cd "$(dirname "$0")/.."
+Port=${1:-8080}
+PidFile=$(pwd)/server/logs/answer-server-$Port.pid
+if [ -f $PidFile ] ; then
+    Pid=$(cat $PidFile)
+    if kill -0 $Pid 2>&1 >/dev/null ; then
+	echo "stopping $Pid"
+	kill -TERM $Pid
+	for i in $(seq 30) ; do
+	    kill -0 $Pid 2>/dev/null || break
+	    sleep 1
+	done
+	if kill -0 $Pid 2>/dev/null ; then
+	    echo "not stopped after 30s, killing $Pid and its workers"
+	    pkill -9 -P $Pid
+	    kill -9 $Pid
+	fi
+    fi
+    rm -f $PidFile
+fi
+echo "stopped"
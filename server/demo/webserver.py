@@ -100,14 +100,108 @@ example:
 #   1.0  initial release
 #   1.1  replace req with self in request handler, add favicon
 #   1.2  added directory listings, added --no-dirlist, fixed plain text displays, logging level control, daemonize
-VERSION = '1.2'
+#   1.3  buffered responses, sendfile, ETag/Last-Modified conditional GETs, small file cache, threads and keep-alive
+VERSION = '1.3'
 
 import argparse
 import BaseHTTPServer
 import cgi
+import ctypes
+import ctypes.util
+import email.utils
+import errno
 import logging
 import os
+import select
+import shutil
+import SocketServer
 import sys
+import threading
+
+
+CONTENT_TYPES = {
+    '.css': 'text/css',
+    '.gif': 'image/gif',
+    '.htm': 'text/html',
+    '.html': 'text/html',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpg',
+    '.js': 'text/javascript',
+    '.png': 'image/png',
+    '.text': 'text/plain',
+    '.txt': 'text/plain',
+}
+
+
+def _libc_sendfile():
+    '''
+    Python 2 has no os.sendfile, call the C library's (Linux) instead.
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = libc.sendfile
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_long), ctypes.c_size_t]
+    func.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_long(offset)
+        sent = func(out_fd, in_fd, ctypes.byref(off), count)
+        if sent < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return sent
+    return sendfile
+
+
+# zero-copy file to socket transfer: sendfile(out_fd, in_fd, offset, count), or None if unavailable
+sendfile = getattr(os, 'sendfile', None) or (_libc_sendfile() if sys.platform.startswith('linux') else None)
+
+
+class FileCache(object):
+    '''
+    In-memory cache of small, frequently requested files.
+
+    Entries are validated against the file's modification time and
+    size on every request, so edited files are never served stale.
+    '''
+    def __init__(self, max_file_size, max_size):
+        self.max_file_size = max_file_size
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {}  # path -> (mtime, size, data)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, stat):
+        '''
+        Return the contents of a small file, from the cache if they
+        are current, or None if the file is too big to be cached.
+        '''
+        if stat.st_size > self.max_file_size:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        with open(path, 'rb') as ifp:
+            data = ifp.read()
+
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[2])
+            if self.size + len(data) <= self.max_size:
+                self.entries[path] = (stat.st_mtime, stat.st_size, data)
+                self.size += len(data)
+        return data
 
 
 def make_request_handler_class(opts):
@@ -123,15 +217,37 @@ def make_request_handler_class(opts):
         additional class variables.
         '''
         m_opts = opts
+        m_cache = FileCache(opts.cache_max_file, opts.cache_size)
+
+        # HTTP/1.1 keeps connections open between requests (every
+        # response has a Content-Length), idle ones are closed after
+        # the timeout.
+        protocol_version = 'HTTP/1.1'
+        timeout = opts.keep_alive
+
+        # Buffer the status line, headers and body of a response and
+        # send them together; the base class flushes after each
+        # request.
+        wbufsize = 64 * 1024
+
+        def send_page(self, status, body, content_type='text/html'):
+            '''
+            Send a complete response whose body has been built in
+            memory.
+            '''
+            self.send_response(status)
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
 
         def do_HEAD(self):
             '''
             Handle a HEAD request.
             '''
             logging.debug('HEADER %s' % (self.path))
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
+            self.do_GET()
 
         def info(self):
             '''
@@ -139,41 +255,95 @@ def make_request_handler_class(opts):
 
             http://127.0.0.1:8080/info
             '''
-            self.wfile.write('<html>')
-            self.wfile.write('  <head>')
-            self.wfile.write('    <title>Server Info</title>')
-            self.wfile.write('  </head>')
-            self.wfile.write('  <body>')
-            self.wfile.write('    <table>')
-            self.wfile.write('      <tbody>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>client_address</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.client_address)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>command</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.command)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>headers</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.headers)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>path</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.path)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>server_version</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.server_version)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('        <tr>')
-            self.wfile.write('          <td>sys_version</td>')
-            self.wfile.write('          <td>%r</td>' % (repr(self.sys_version)))
-            self.wfile.write('        </tr>')
-            self.wfile.write('      </tbody>')
-            self.wfile.write('    </table>')
-            self.wfile.write('  </body>')
-            self.wfile.write('</html>')
+            rows = [('client_address', self.client_address),
+                    ('command', self.command),
+                    ('headers', self.headers),
+                    ('path', self.path),
+                    ('server_version', self.server_version),
+                    ('sys_version', self.sys_version),
+                    ('cache', 'hits=%d misses=%d size=%d' % (self.m_cache.hits, self.m_cache.misses,
+                                                            self.m_cache.size)),
+                    ]
+            html = ['<html>',
+                    '  <head>',
+                    '    <title>Server Info</title>',
+                    '  </head>',
+                    '  <body>',
+                    '    <table>',
+                    '      <tbody>']
+            for name, value in rows:
+                html.append('        <tr>')
+                html.append('          <td>%s</td>' % (name))
+                html.append('          <td>%r</td>' % (repr(value)))
+                html.append('        </tr>')
+            html.extend(['      </tbody>',
+                         '    </table>',
+                         '  </body>',
+                         '</html>'])
+            self.send_page(200, '\n'.join(html))
+
+        def not_modified(self, etag, mtime):
+            '''
+            Whether the client's copy of a file (identified by the
+            If-None-Match or If-Modified-Since headers) is current.
+            '''
+            if 'if-none-match' in self.headers:
+                tags = [tag.strip() for tag in self.headers['if-none-match'].split(',')]
+                return etag in tags or '*' in tags
+            if 'if-modified-since' in self.headers:
+                since = email.utils.parsedate_tz(self.headers['if-modified-since'])
+                return since is not None and int(mtime) <= email.utils.mktime_tz(since)
+            return False
+
+        def send_file(self, path, content_type):
+            '''
+            Send a file: small files from the in-memory cache, others
+            straight from the file system to the socket (sendfile).
+            Conditional requests for an unchanged file get a 304.
+            '''
+            stat = os.stat(path)
+            etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)  # Not Modified
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            data = self.m_cache.get(path, stat)
+
+            self.send_response(200)  # OK
+            self.send_header('Content-type', content_type)
+            self.send_header('Content-Length', str(stat.st_size if data is None else len(data)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+
+            if data is not None:
+                self.wfile.write(data)
+                return
+
+            with open(path, 'rb') as ifp:
+                self.wfile.flush()  # the headers go first
+                if sendfile is None:
+                    shutil.copyfileobj(ifp, self.wfile, 64 * 1024)
+                    return
+
+                offset = 0
+                while offset < stat.st_size:
+                    try:
+                        sent = sendfile(self.connection.fileno(), ifp.fileno(), offset, stat.st_size - offset)
+                    except OSError as e:
+                        # the socket has a timeout, which makes it non-blocking
+                        if e.errno != errno.EAGAIN:
+                            raise
+                        select.select([], [self.connection], [], self.timeout)
+                        continue
+                    if sent == 0:
+                        break  # the file was truncated
+                    offset += sent
 
         def do_GET(self):
             '''
@@ -210,9 +380,6 @@ def make_request_handler_class(opts):
             # There is special handling for http://127.0.0.1/info. That URL
             # displays some internal information.
             if self.path == '/info' or self.path == '/info/':
-                self.send_response(200)  # OK
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
                 self.info()
             else:
                 # Get the file path.
@@ -239,71 +406,34 @@ def make_request_handler_class(opts):
                 if os.path.exists(path) and os.path.isfile(path):
                     # This is valid file, send it as the response
                     # after determining whether it is a type that
-                    # the server recognizes.
+                    # the server recognizes. Unknown file types are
+                    # treated as plain text.
                     _, ext = os.path.splitext(path)
-                    ext = ext.lower()
-                    content_type = {
-                        '.css': 'text/css',
-                        '.gif': 'image/gif',
-                        '.htm': 'text/html',
-                        '.html': 'text/html',
-                        '.jpeg': 'image/jpeg',
-                        '.jpg': 'image/jpg',
-                        '.js': 'text/javascript',
-                        '.png': 'image/png',
-                        '.text': 'text/plain',
-                        '.txt': 'text/plain',
-                    }
-
-                    # If it is a known extension, set the correct
-                    # content type in the response.
-                    if ext in content_type:
-                        self.send_response(200)  # OK
-                        self.send_header('Content-type', content_type[ext])
-                        self.end_headers()
-
-                        with open(path) as ifp:
-                            self.wfile.write(ifp.read())
-                    else:
-                        # Unknown file type or a directory.
-                        # Treat it as plain text.
-                        self.send_response(200)  # OK
-                        self.send_header('Content-type', 'text/plain')
-                        self.end_headers()
-
-                        with open(path) as ifp:
-                            self.wfile.write(ifp.read())
+                    self.send_file(path, CONTENT_TYPES.get(ext.lower(), 'text/plain'))
                 else:
                     if dirpath is None or self.m_opts.no_dirlist == True:
                         # Invalid file path, respond with a server access error
-                        self.send_response(500)  # generic server error for now
-                        self.send_header('Content-type', 'text/html')
-                        self.end_headers()
-
-                        self.wfile.write('<html>')
-                        self.wfile.write('  <head>')
-                        self.wfile.write('    <title>Server Access Error</title>')
-                        self.wfile.write('  </head>')
-                        self.wfile.write('  <body>')
-                        self.wfile.write('    <p>Server access error.</p>')
-                        self.wfile.write('    <p>%r</p>' % (repr(self.path)))
-                        self.wfile.write('    <p><a href="%s">Back</a></p>' % (rpath))
-                        self.wfile.write('  </body>')
-                        self.wfile.write('</html>')
+                        self.send_page(500, '\n'.join([  # generic server error for now
+                            '<html>',
+                            '  <head>',
+                            '    <title>Server Access Error</title>',
+                            '  </head>',
+                            '  <body>',
+                            '    <p>Server access error.</p>',
+                            '    <p>%r</p>' % (repr(self.path)),
+                            '    <p><a href="%s">Back</a></p>' % (rpath),
+                            '  </body>',
+                            '</html>']))
                     else:
                         # List the directory contents. Allow simple navigation.
                         logging.debug('DIR %s' % (dirpath))
 
-                        self.send_response(200)  # OK
-                        self.send_header('Content-type', 'text/html')
-                        self.end_headers()
-                        
-                        self.wfile.write('<html>')
-                        self.wfile.write('  <head>')
-                        self.wfile.write('    <title>%s</title>' % (dirpath))
-                        self.wfile.write('  </head>')
-                        self.wfile.write('  <body>')
-                        self.wfile.write('    <a href="%s">Home</a><br>' % ('/'));
+                        html = ['<html>',
+                                '  <head>',
+                                '    <title>%s</title>' % (dirpath),
+                                '  </head>',
+                                '  <body>',
+                                '    <a href="%s">Home</a><br>' % ('/')]
 
                         # Make the directory path navigable.
                         dirstr = ''
@@ -315,30 +445,31 @@ def make_request_handler_class(opts):
                                 href = href + '/' + seg
                                 dirstr += '/'
                             dirstr += '<a href="%s">%s</a>' % (href, seg)
-                        self.wfile.write('    <p>Directory: %s</p>' % (dirstr))
+                        html.append('    <p>Directory: %s</p>' % (dirstr))
 
                         # Write out the simple directory list (name and size).
-                        self.wfile.write('    <table border="0">')
-                        self.wfile.write('      <tbody>')
+                        html.append('    <table border="0">')
+                        html.append('      <tbody>')
                         fnames = ['..']
                         fnames.extend(sorted(os.listdir(dirpath), key=str.lower))
                         for fname in fnames:
-                            self.wfile.write('        <tr>')
-                            self.wfile.write('          <td align="left">')
+                            html.append('        <tr>')
+                            html.append('          <td align="left">')
                             path = rpath + '/' + fname
                             fpath = os.path.join(dirpath, fname)
                             if os.path.isdir(path):
-                                self.wfile.write('            <a href="%s">%s/</a>' % (path, fname))
+                                html.append('            <a href="%s">%s/</a>' % (path, fname))
                             else:
-                                self.wfile.write('            <a href="%s">%s</a>' % (path, fname))
-                            self.wfile.write('          <td>&nbsp;&nbsp;</td>')
-                            self.wfile.write('          </td>')
-                            self.wfile.write('          <td align="right">%d</td>' % (os.path.getsize(fpath)))
-                            self.wfile.write('        </tr>')
-                        self.wfile.write('      </tbody>')
-                        self.wfile.write('    </table>')
-                        self.wfile.write('  </body>')
-                        self.wfile.write('</html>')
+                                html.append('            <a href="%s">%s</a>' % (path, fname))
+                            html.append('          <td>&nbsp;&nbsp;</td>')
+                            html.append('          </td>')
+                            html.append('          <td align="right">%d</td>' % (os.path.getsize(fpath)))
+                            html.append('        </tr>')
+                        html.extend(['      </tbody>',
+                                     '    </table>',
+                                     '  </body>',
+                                     '</html>'])
+                        self.send_page(200, '\n'.join(html))
 
         def do_POST(self):
             '''
@@ -347,13 +478,16 @@ def make_request_handler_class(opts):
             logging.debug('POST %s' % (self.path))
 
             # CITATION: http://stackoverflow.com/questions/4233218/python-basehttprequesthandler-post-variables
-            ctype, pdict = cgi.parse_header(self.headers['content-type'])
+            ctype, pdict = cgi.parse_header(self.headers.get('content-type', ''))
             if ctype == 'multipart/form-data':
                 postvars = cgi.parse_multipart(self.rfile, pdict)
             elif ctype == 'application/x-www-form-urlencoded':
                 length = int(self.headers['content-length'])
                 postvars = cgi.parse_qs(self.rfile.read(length), keep_blank_values=1)
             else:
+                # Read (and ignore) the body, the connection is kept open
+                # for the next request.
+                self.rfile.read(int(self.headers.get('content-length', 0)))
                 postvars = {}
 
             # Get the "Back" link.
@@ -369,39 +503,35 @@ def make_request_handler_class(opts):
                     logging.debug('ARG[%d] %s=%s' % (i, key, postvars[key]))
                     i += 1
 
-            # Tell the browser everything is okay and that there is
-            # HTML to display.
-            self.send_response(200)  # OK
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-
-            # Display the POST variables.
-            self.wfile.write('<html>')
-            self.wfile.write('  <head>')
-            self.wfile.write('    <title>Server POST Response</title>')
-            self.wfile.write('  </head>')
-            self.wfile.write('  <body>')
-            self.wfile.write('    <p>POST variables (%d).</p>' % (len(postvars)))
+            # Tell the browser everything is okay and display the POST
+            # variables.
+            html = ['<html>',
+                    '  <head>',
+                    '    <title>Server POST Response</title>',
+                    '  </head>',
+                    '  <body>',
+                    '    <p>POST variables (%d).</p>' % (len(postvars))]
 
             if len(postvars):
                 # Write out the POST variables in 3 columns.
-                self.wfile.write('    <table>')
-                self.wfile.write('      <tbody>')
+                html.append('    <table>')
+                html.append('      <tbody>')
                 i = 0
                 for key in sorted(postvars):
                     i += 1
                     val = postvars[key]
-                    self.wfile.write('        <tr>')
-                    self.wfile.write('          <td align="right">%d</td>' % (i))
-                    self.wfile.write('          <td align="right">%s</td>' % key)
-                    self.wfile.write('          <td align="left">%s</td>' % val)
-                    self.wfile.write('        </tr>')
-                self.wfile.write('      </tbody>')
-                self.wfile.write('    </table>')
-
-            self.wfile.write('    <p><a href="%s">Back</a></p>' % (back))
-            self.wfile.write('  </body>')
-            self.wfile.write('</html>')
+                    html.append('        <tr>')
+                    html.append('          <td align="right">%d</td>' % (i))
+                    html.append('          <td align="right">%s</td>' % key)
+                    html.append('          <td align="left">%s</td>' % val)
+                    html.append('        </tr>')
+                html.append('      </tbody>')
+                html.append('    </table>')
+
+            html.extend(['    <p><a href="%s">Back</a></p>' % (back),
+                         '  </body>',
+                         '</html>'])
+            self.send_page(200, '\n'.join(html))
 
     return MyRequestHandler
 
@@ -435,12 +565,33 @@ def getopts():
                         metavar='DIR',
                         help='daemonize this process, store the 3 run files (.log, .err, .pid) in DIR (default "%(default)s")')
 
+    parser.add_argument('--cache-max-file',
+                        action='store',
+                        type=int,
+                        default=256 * 1024,
+                        metavar='BYTES',
+                        help='largest file kept in the in-memory cache, default=%(default)s')
+
+    parser.add_argument('--cache-size',
+                        action='store',
+                        type=int,
+                        default=32 * 1024 * 1024,
+                        metavar='BYTES',
+                        help='total size of the in-memory file cache, default=%(default)s')
+
     parser.add_argument('-H', '--host',
                         action='store',
                         type=str,
                         default='localhost',
                         help='hostname, default=%(default)s')
 
+    parser.add_argument('-k', '--keep-alive',
+                        action='store',
+                        type=float,
+                        default=15.0,
+                        metavar='SECONDS',
+                        help='close idle keep-alive connections after SECONDS, default=%(default)s')
+
     parser.add_argument('-l', '--level',
                         action='store',
                         type=str,
@@ -481,12 +632,20 @@ def getopts():
     return opts
 
 
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server with a thread per connection, so that a kept-alive
+    connection does not block the others.
+    '''
+    daemon_threads = True
+
+
 def httpd(opts):
     '''
     HTTP server
     '''
     RequestHandlerClass = make_request_handler_class(opts)
-    server = BaseHTTPServer.HTTPServer((opts.host, opts.port), RequestHandlerClass)
+    server = ThreadedHTTPServer((opts.host, opts.port), RequestHandlerClass)
     logging.info('Server starting %s:%s (level=%s)' % (opts.host, opts.port, opts.level))
     try:
         server.serve_forever()
@@ -0,0 +1,177 @@
+"""
+Pre-fork serving: a master process loads everything once, binds the listening socket and forks worker processes that
+accept from it, then supervises them.
+
+The workers share the master's memory copy-on-write, and the retrieval indexes, models and answer ids are memory-mapped
+files, so an extra worker only costs the pages it writes to (its own threads, buffers and request state).
+"""
+
+import errno
+import gc
+import os
+import signal
+import sys
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def memory_usage(pid):
+    """
+    Private and shared resident memory of a process, in kB (from `/proc/<pid>/smaps`, so Linux only)
+
+    :return: A (private, shared) pair, or `None` if it cannot be read
+    """
+    private, shared = 0, 0
+    try:
+        with open('/proc/%d/smaps' % pid) as f:
+            for line in f:
+                if line.startswith('Private_'):
+                    private += int(line.split()[1])
+                elif line.startswith('Shared_'):
+                    shared += int(line.split()[1])
+    except (IOError, OSError):
+        return None
+    return private, shared
+
+
+class PreforkSupervisor(object):
+    def __init__(self, run_worker, processes=4, restart_delay=1.0, report_interval=300.0):
+        """
+        Forks worker processes and restarts the ones that exit, until the master is sent SIGTERM or SIGINT (which it
+        forwards to the workers).
+
+        :param run_worker: Called in each worker process with the worker's number; the worker exits when it returns
+        :param processes: Number of worker processes
+        :param restart_delay: Minimum seconds between two starts of the same worker, so a crashing worker does not spin
+        :param report_interval: Seconds between two logs of the memory used by each process
+        """
+        self.run_worker = run_worker
+        self.processes = processes
+        self.restart_delay = restart_delay
+        self.report_interval = report_interval
+
+        # running workers: pid -> (worker number, start time)
+        self.workers = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def _spawn(self, number):
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = (number, time.time())
+            return pid
+
+        # in the worker: never return into the master's code
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            self.run_worker(number)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.exception('Worker %d failed' % number)
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def report_memory(self):
+        for name, pid in [('master', os.getpid())] + [('worker %d' % number, pid)
+                                                      for pid, (number, _) in sorted(self.workers.items())]:
+            usage = memory_usage(pid)
+            if usage is not None:
+                logger.info('%s (pid %d): %.1f MB private, %.1f MB shared' % (
+                    name, pid, usage[0] / 1024., usage[1] / 1024.))
+
+    def _reap(self):
+        """ Collect the workers that exited, and restart them unless stopping """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            number, started = self.workers.pop(pid)
+            if self.stopping:
+                continue
+
+            logger.warning('Worker %d (pid %d) exited with status %d, restarting it' % (number, pid, status))
+            time.sleep(max(0, started + self.restart_delay - time.time()))
+            self.restarts += 1
+            self._spawn(number)
+
+    def run(self):
+        """ Start the workers and supervise them until stopped """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        # everything loaded so far is shared with the workers: don't leave garbage for them to collect (and copy)
+        gc.collect()
+        for number in range(self.processes):
+            self._spawn(number)
+        logger.info('Started %d workers: %s' % (self.processes, ', '.join(str(pid) for pid in sorted(self.workers))))
+
+        last_report = time.time()
+        while not self.stopping:
+            self._reap()
+            if time.time() - last_report >= self.report_interval:
+                self.report_memory()
+                last_report = time.time()
+            time.sleep(0.5)
+
+        logger.info('Stopping %d workers' % len(self.workers))
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while len(self.workers) > 0:
+            self._reap()
+            time.sleep(0.1)
+
+
+def daemonize(directory, name):
+    """
+    Detach from the terminal, like `server/demo/webserver.py`: stdout and stderr go to `<name>.log` and `<name>.err`
+    in `directory`, and the process id is written to `<name>.pid`.
+
+    :return: The name of the pid file (to remove on exit)
+    """
+    if not os.path.isdir(directory):
+        sys.exit('not a directory: ' + directory)
+
+    outfile, errfile, pidfile = [os.path.abspath(os.path.join(directory, name + ext))
+                                 for ext in ('.log', '.err', '.pid')]
+    if os.path.exists(pidfile):
+        sys.exit('pid file exists, cannot continue: ' + pidfile)
+
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdin = open('/dev/null', 'r')
+    stdout = open(outfile, 'a+')
+    stderr = open(errfile, 'a+', 0)
+    os.dup2(stdin.fileno(), sys.stdin.fileno())
+    os.dup2(stdout.fileno(), sys.stdout.fileno())
+    os.dup2(stderr.fileno(), sys.stderr.fileno())
+
+    with open(pidfile, 'w') as f:
+        f.write('%d' % os.getpid())
+    return pidfile
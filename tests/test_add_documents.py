@@ -0,0 +1,97 @@
+""" Adding answers to a live `MixtureOfExperts`, across restarts (run with `python -m unittest discover tests`) """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import config
+
+
+class AddDocumentsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # a small database and indexes in a temporary directory (see `benchmarks/pipeline.py`)
+        cls.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.workdir, 'dicts'))
+        cls.config = config.BASE_DATA_PATH, config.DATABASES, getattr(config, 'MODELS', {})
+        config.BASE_DATA_PATH = cls.workdir
+        config.DATABASES = dict(config.DATABASES, yahoo=os.path.join(cls.workdir, 'yahoo.sqlite3'))
+        config.MODELS = dict(cls.config[2], tfidf=os.path.join(cls.workdir, 'tfidf'))
+
+        from benchmarks.pipeline import synthetic_xml
+        from serialization.convert_to_sqlite_db import convert
+
+        xml = os.path.join(cls.workdir, 'synthetic.xml')
+        synthetic_xml(xml, 300, vocabulary=1000)
+        convert(xml, test=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        config.BASE_DATA_PATH, config.DATABASES, config.MODELS = cls.config
+        shutil.rmtree(cls.workdir)
+
+    def start(self):
+        """ Load the answer store and the experts from disk, as a restarted server does """
+        from models.gensim_models import TfidfRetrieval
+        from models.mixture_of_experts import MixtureOfExperts
+        from serialization.dictionary import CorpusDictionary
+
+        moe = MixtureOfExperts(CorpusDictionary(), [TfidfRetrieval], first_stage=None,
+                               fusion_path=os.path.join(self.workdir, 'fusion_weights.pkl'))
+        self.addCleanup(moe.close)
+        return moe
+
+    def add(self, moe, content):
+        from serialization.sqldb import Answer
+        return moe.add_documents([Answer(content=content, question_id=1)])
+
+    @staticmethod
+    def rare_words(moe, num):
+        """ The `num` words of the vocabulary found in the fewest documents, which identify an answer using them """
+        vocab = moe.dictionary.vocab
+        return [vocab.id2token[i] for i in sorted(vocab.dfs, key=lambda i: (vocab.dfs[i], i))[:num]]
+
+    def assertInStep(self, moe):
+        for expert in moe.experts:
+            self.assertEqual(len(expert), len(moe.dictionary.answer_ids))
+
+    def test_restart_between_adds(self):
+        moe = self.start()
+        words = self.rare_words(moe, 4)
+        texts = [u' '.join(words[:2] * 3), u' '.join(words[2:] * 3)]
+        first = self.add(moe, texts[0])
+        self.assertInStep(moe)
+
+        # the expert only kept the answer in memory: the restarted one must get it back from the answer store
+        moe.close()
+        moe = self.start()
+        self.assertInStep(moe)
+        second = self.add(moe, texts[1])
+        self.assertEqual(second, [first[0] + 1])
+        self.assertInStep(moe)
+
+        tfidf = moe.get_expert('tfidf')
+        for ids, text in [(first, texts[0]), (second, texts[1])]:
+            best, _ = tfidf.top_n_arrays(moe.dictionary.doc2vec(text), tfidf.num_best or 1)
+            self.assertEqual(best[:1].tolist(), ids)
+
+    def test_failed_expert_is_caught_up(self):
+        moe = self.start()
+        tfidf = moe.get_expert('tfidf')
+        add_documents = tfidf.add_documents
+
+        def fail(documents):
+            raise IOError('disk full')
+
+        tfidf.add_documents = fail
+        self.add(moe, u'lost answer')
+        self.assertEqual(len(tfidf), len(moe.dictionary.answer_ids) - 1)
+
+        tfidf.add_documents = add_documents
+        self.add(moe, u'next answer')
+        self.assertInStep(moe)
+
+
+if __name__ == '__main__':
+    unittest.main()